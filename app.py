@@ -4,28 +4,58 @@ NaturIA Chile - Identifica insectos y plantas de Chile con IA
 """
 
 import os
-from flask import Flask, render_template, request, jsonify, session
+from flask import (Flask, render_template, request, jsonify, session, Response, url_for, send_from_directory,
+                   send_file, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from datetime import datetime
+from sqlalchemy import and_, or_, insert, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from datetime import datetime, timedelta
+import base64
+import hmac
+import click
+import mimetypes
+import threading
+import time
 from dotenv import load_dotenv
-from utils.gemini_client import analizar_imagen, buscar_por_texto
+from utils.gemini_client import analizar_imagen, buscar_por_texto, enrutador
 from utils.image_search import obtener_imagen_especie
-from utils.sound_search import buscar_sonido
+from utils.sound_search import AVES_CHILE, buscar_sonido
+from utils.database import configurar_base_de_datos, migrar_esquema
+from utils.cache import CACHE_BACKEND, CACHE_SQLITE_RUTA, crear_almacen
+from utils.ranking import VENTANAS, clave_ventana, inicio_ventana, crear_ranking
+from utils.catalogo import CatalogoEspecies
+from utils.geo import (codificar_geohash, celdas_para_bbox, bbox_de_radio,
+                       distancia_km, precision_para_zoom)
+from utils.assets import ManifiestoAssets, construir_assets
+from utils.subida import SolicitudConImagenes, ErrorSubida
+from utils.trazas import instalar_en_flask
+from utils.coalescencia import vuelo_unico
+from utils import enriquecimiento
+from utils.huellas import indice_huellas
+from utils.precalentar import especies_a_precalentar, precalentar
+from utils.autocompletar import Autocompletado
+from utils.exportar import FORMATOS as FORMATOS_EXPORTACION, exportar as exportar_filas
+from utils.puntos_diferidos import BufferPuntos, PUNTOS_LOG_DIR
 
 # Cargar variables de entorno
 load_dotenv()
 
 # Crear aplicación Flask
 app = Flask(__name__)
+# Las imágenes de /analizar se validan mientras llegan (ver utils/subida.py)
+app.request_class = SolicitudConImagenes
+# Server-Timing con los tiempos de Gemini, APIs externas y base de datos (ver utils/trazas.py)
+instalar_en_flask(app)
 
 # Configuración
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'naturia-chile-super-secret-key')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Límite de 16MB para uploads
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///naturia.db')
-if app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres://"):
-    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace("postgres://", "postgresql://", 1)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Base de datos: URL, pool y PRAGMA de SQLite (ver utils/database.py)
+configurar_base_de_datos(app)
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
@@ -33,6 +63,29 @@ login_manager.login_view = 'index'
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
+# Catálogo de especies con índices precalculados (data/especies_chile.json)
+catalogo = CatalogoEspecies()
+
+# Assets con huella de contenido (static/dist, ver utils/assets.py)
+assets = ManifiestoAssets()
+ASSETS_CACHE_SEGUNDOS = 60 * 60 * 24 * 365
+
+# Identificaciones anteriores por huella visual (ver utils/huellas.py)
+if not indice_huellas.archivo:
+    indice_huellas.archivo = os.path.join(app.instance_path, 'huellas.jsonl')
+
+# Almacén de las cachés de búsquedas, imágenes y sonidos (memoria, sqlite o redis; ver utils/cache.py)
+enriquecimiento.usar_almacen(crear_almacen(
+    CACHE_BACKEND, CACHE_SQLITE_RUTA or os.path.join(app.instance_path, 'cache.sqlite3')))
+
+# Imágenes, sonidos y búsquedas ya resueltas, p. ej. por `flask precalentar` (ver utils/enriquecimiento.py)
+ARCHIVO_ENRIQUECIMIENTO = enriquecimiento.ENRIQUECIMIENTO_ARCHIVO or os.path.join(app.instance_path, 'enriquecimiento.json')
+enriquecimiento.cargar_archivo(ARCHIVO_ENRIQUECIMIENTO)
+
+# Ranking precalculado (Redis si hay REDIS_URL, memoria del proceso si no)
+ranking = crear_ranking(os.getenv('REDIS_URL'))
+RANKING_RECONSTRUCCION_SEGUNDOS = int(os.getenv('RANKING_RECONSTRUCCION_SEGUNDOS', 600))
+
 # ========================================
 # MODELOS DE BASE DE DATOS
 # ========================================
@@ -44,6 +97,8 @@ class User(UserMixin, db.Model):
     correo = db.Column(db.String(100), unique=True, nullable=False)
     telefono = db.Column(db.String(20), nullable=True)
     total_puntos = db.Column(db.Integer, default=0)
+    # Contador mantenido al guardar descubrimientos (evita COUNT(*) en cada perfil)
+    total_descubrimientos = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relación con descubrimientos
@@ -58,14 +113,134 @@ class Discovery(db.Model):
     imagen_url = db.Column(db.String(255), nullable=True)
     puntos = db.Column(db.Integer, default=0)
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
+    # Clave generada por el cliente para que los reintentos offline no dupliquen filas
+    clave_idempotencia = db.Column(db.String(64), nullable=True)
+    # Ubicación opcional: región (nombre oficial) y coordenadas redondeadas (~1 km)
+    region = db.Column(db.String(50), nullable=True)
+    latitud = db.Column(db.Float, nullable=True)
+    longitud = db.Column(db.Float, nullable=True)
+    # Geohash de (latitud, longitud): las búsquedas por zona son rangos de este índice
+    geohash = db.Column(db.String(12), nullable=True)
+
+    # Índice compuesto para listar la Naturadex de un usuario ordenada por fecha
+    __table_args__ = (
+        db.Index('ix_discovery_user_fecha', 'user_id', 'fecha'),
+        db.Index('ix_discovery_geohash', 'geohash'),
+        db.UniqueConstraint('user_id', 'clave_idempotencia', name='uq_discovery_user_clave'),
+    )
+
+    def to_dict(self):
+        """Representación JSON de un descubrimiento."""
+        return {
+            'id': self.id,
+            'nombre': self.nombre_especie,
+            'cientifico': self.nombre_cientifico,
+            'tipo': self.tipo,
+            'imagen_url': self.imagen_url,
+            'puntos': self.puntos,
+            'fecha': self.fecha.isoformat() if self.fecha else None,
+            'region': self.region,
+            'latitud': self.latitud,
+            'longitud': self.longitud
+        }
+
+class RegionRollup(db.Model):
+    """Conteo de descubrimientos por (región, tipo, especie, día), mantenido al insertar."""
+    id = db.Column(db.Integer, primary_key=True)
+    region = db.Column(db.String(50), nullable=False)
+    tipo = db.Column(db.String(50), nullable=False)
+    nombre_cientifico = db.Column(db.String(100), nullable=False)
+    dia = db.Column(db.Date, nullable=False)
+    cantidad = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('region', 'tipo', 'nombre_cientifico', 'dia', name='uq_region_rollup'),
+        db.Index('ix_region_rollup_dia', 'dia'),
+    )
+
+# Caché por proceso de los usuarios cargados por Flask-Login: evita un SELECT
+# por petición autenticada. El TTL corto acota lo que puede ver otro worker;
+# las rutas que modifican al usuario invalidan su entrada en este proceso.
+USUARIO_CACHE_TTL = float(os.getenv('USUARIO_CACHE_TTL', 10))
+USUARIO_CACHE_MAXIMO = 10000
+_usuarios_cache = {}
+
+def invalidar_usuario(user_id):
+    """Descarta la copia en caché de un usuario tras modificarlo."""
+    _usuarios_cache.pop(user_id, None)
+
+def guardar_usuario_en_cache(usuario):
+    if len(_usuarios_cache) >= USUARIO_CACHE_MAXIMO:
+        _usuarios_cache.clear()
+    columnas = {c.key: getattr(usuario, c.key) for c in User.__table__.columns}
+    _usuarios_cache[usuario.id] = (time.monotonic() + USUARIO_CACHE_TTL, columnas)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    entrada = _usuarios_cache.get(user_id)
+    if entrada and entrada[0] > time.monotonic():
+        # Reconstruir la instancia y adjuntarla a la sesión sin consultar la DB,
+        # así las rutas pueden seguir modificando current_user y hacer commit
+        usuario = User(**entrada[1])
+        make_transient_to_detached(usuario)
+        return con_puntos_pendientes(db.session.merge(usuario, load=False))
+    
+    # Un solo SELECT trae también el contador de descubrimientos (columna propia)
+    usuario = db.session.get(User, user_id)
+    if usuario:
+        guardar_usuario_en_cache(usuario)
+        con_puntos_pendientes(usuario)
+    return usuario
+
+# Los totales de /sincronizar_puntos se escriben en lote, no en una transacción
+# por llamada (ver utils/puntos_diferidos.py)
+def escribir_puntos(totales):
+    """Escribe {user_id: total_puntos} en una sola transacción."""
+    with app.app_context():
+        db.session.execute(update(User), [{'id': uid, 'total_puntos': p} for uid, p in totales.items()])
+        db.session.commit()
+    for user_id in totales:
+        invalidar_usuario(user_id)
+
+puntos_diferidos = BufferPuntos(escribir_puntos,
+                                carpeta_log=PUNTOS_LOG_DIR or os.path.join(app.instance_path, 'puntos'))
+puntos_diferidos.recuperar()
+puntos_diferidos.instalar_atexit()
+
+def con_puntos_pendientes(usuario):
+    """Refleja en el usuario cargado su total aún no escrito (sin marcarlo como modificado)."""
+    pendiente = puntos_diferidos.pendiente(usuario.id)
+    if pendiente is not None:
+        set_committed_value(usuario, 'total_puntos', pendiente)
+    return usuario
 
-# Crear tablas
-with app.app_context():
-    db.create_all()
+def registrar_puntos(usuario, puntos):
+    """Anota el nuevo total del usuario para el próximo lote y actualiza el ranking."""
+    puntos_diferidos.registrar(usuario.id, puntos)
+    set_committed_value(usuario, 'total_puntos', puntos)
+    actualizar_ranking_global(usuario.id, puntos)
+
+def inicializar_base_de_datos():
+    """
+    Crea las tablas que falten y migra las existentes (columnas e índices
+    nuevos). Se ejecuta una vez por despliegue, no al importar. Idempotente.
+    """
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conexion:
+            agregadas = migrar_esquema(conexion, db.metadata)
+            if 'user.total_descubrimientos' in agregadas:
+                # El contador parte del conteo real de los descubrimientos ya guardados
+                conexion.execute(update(User).values(total_descubrimientos=db.select(func.count(Discovery.id))
+                                                     .where(Discovery.user_id == User.id).scalar_subquery()))
+        return agregadas
+
+@app.cli.command('init-db')
+def init_db_comando():
+    """Crea las tablas de la base de datos y agrega las columnas e índices que falten."""
+    agregadas = inicializar_base_de_datos()
+    print("✅ Tablas creadas" + (f" (columnas agregadas: {', '.join(agregadas)})" if agregadas else ""))
 
 # ========================================
 # RUTAS DE AUTENTICACIÓN
@@ -100,6 +275,8 @@ def registro():
         
         db.session.add(nuevo_usuario)
         db.session.commit()
+        invalidar_usuario(nuevo_usuario.id)
+        actualizar_ranking_global(nuevo_usuario.id, nuevo_usuario.total_puntos)
         
         login_user(nuevo_usuario)
         
@@ -129,6 +306,7 @@ def login():
         if not usuario:
             return jsonify({'error': 'Correo no encontrado. ¡Regístrate para comenzar!'}), 404
             
+        con_puntos_pendientes(usuario)
         login_user(usuario)
         
         return jsonify({
@@ -153,7 +331,7 @@ def obtener_perfil():
         'apellido': current_user.apellido,
         'correo': current_user.correo,
         'puntos': current_user.total_puntos,
-        'descubrimientos_count': Discovery.query.filter_by(user_id=current_user.id).count()
+        'descubrimientos_count': current_user.total_descubrimientos or 0
     })
 
 @app.route('/logout')
@@ -166,13 +344,16 @@ def logout():
 @app.route('/sincronizar_puntos', methods=['POST'])
 @login_required
 def sincronizar_puntos():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or data.get('puntos') is None:
+        return jsonify({'error': 'Falta el campo puntos'}), 400
     try:
-        data = request.get_json()
-        puntos = data.get('puntos')
-        if puntos is not None:
-            current_user.total_puntos = int(puntos)
-            db.session.commit()
-            return jsonify({'success': True})
+        puntos = int(data['puntos'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'El campo puntos debe ser un número'}), 400
+    try:
+        registrar_puntos(current_user, puntos)
+        return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -184,6 +365,11 @@ def guardar_descubrimiento():
         data = request.get_json()
         if not data:
             return jsonify({'error': 'No se recibieron datos'}), 400
+        clave = None
+        if data.get('clave') not in (None, ''):
+            clave = clave_valida(data['clave'])
+            if clave is None:
+                return jsonify({'error': 'La clave del descubrimiento no es válida'}), 400
             
         nuevo_descubrimiento = Discovery(
             user_id=current_user.id,
@@ -191,27 +377,703 @@ def guardar_descubrimiento():
             nombre_cientifico=data.get('cientifico'),
             tipo=data.get('tipo'),
             imagen_url=data.get('imagen_url'),
-            puntos=int(data.get('puntos', 0))
+            puntos=int(data.get('puntos', 0)),
+            clave_idempotencia=clave,
+            fecha=datetime.utcnow(),
+            **datos_ubicacion(data)
         )
         
-        db.session.add(nuevo_descubrimiento)
-        db.session.commit()
+        try:
+            # El agregado y el contador hacen autoflush del INSERT: una clave repetida falla aquí
+            db.session.add(nuevo_descubrimiento)
+            sumar_a_agregados([(nuevo_descubrimiento.region, nuevo_descubrimiento.tipo,
+                                nuevo_descubrimiento.nombre_cientifico, nuevo_descubrimiento.fecha)])
+            # Incremento atómico en SQL para no perder conteos entre workers
+            User.query.filter_by(id=current_user.id).update(
+                {User.total_descubrimientos: User.total_descubrimientos + 1},
+                synchronize_session=False
+            )
+            db.session.commit()
+        except IntegrityError:
+            # Reintento de un descubrimiento ya guardado con la misma clave
+            db.session.rollback()
+            return jsonify({
+                'success': True,
+                'duplicado': True,
+                'mensaje': 'Este descubrimiento ya estaba en tu Naturadex',
+                'descubrimientos_count': current_user.total_descubrimientos
+            }), 200
+        
+        invalidar_usuario(current_user.id)
+        actualizar_ranking_ventanas(current_user.id, nuevo_descubrimiento.fecha, nuevo_descubrimiento.puntos)
         
         return jsonify({
             'success': True,
             'mensaje': '¡Descubrimiento guardado en tu Naturadex!',
-            'descubrimientos_count': Discovery.query.filter_by(user_id=current_user.id).count()
+            'descubrimientos_count': current_user.total_descubrimientos
         }), 201
         
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+LOTE_MAXIMO = 500
+CLAVE_MAXIMA = 64  # Largo de Discovery.clave_idempotencia
+COORDENADAS_DECIMALES = 2  # ~1 km: suficiente para el mapa sin exponer la ubicación exacta
+
+def clave_valida(valor):
+    """La clave de idempotencia como texto limpio, o None si no es un texto (o número) de 1 a 64 caracteres."""
+    if isinstance(valor, bool) or not isinstance(valor, (str, int)):
+        return None
+    valor = str(valor).strip()
+    return valor if 0 < len(valor) <= CLAVE_MAXIMA else None
+
+def datos_ubicacion(data):
+    """Extrae región y coordenadas opcionales de un descubrimiento enviado por el cliente."""
+    ubicacion = {'region': None, 'latitud': None, 'longitud': None, 'geohash': None}
+    if data.get('region'):
+        ubicacion['region'] = catalogo.nombre_region(str(data['region']))
+    try:
+        latitud = float(data['latitud'])
+        longitud = float(data['longitud'])
+        if -90 <= latitud <= 90 and -180 <= longitud <= 180:
+            ubicacion['latitud'] = round(latitud, COORDENADAS_DECIMALES)
+            ubicacion['longitud'] = round(longitud, COORDENADAS_DECIMALES)
+            ubicacion['geohash'] = codificar_geohash(ubicacion['latitud'], ubicacion['longitud'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return ubicacion
+
+def sumar_a_agregados(descubrimientos):
+    """
+    Suma descubrimientos recién insertados a RegionRollup con un upsert
+    (INSERT ... ON CONFLICT DO UPDATE), dentro de la transacción en curso.
+    Recibe tuplas (region, tipo, nombre_cientifico, fecha); se ignoran las sin región.
+    """
+    conteos = {}
+    for region, tipo, cientifico, fecha in descubrimientos:
+        if region:
+            clave = (region, tipo, cientifico, fecha.date())
+            conteos[clave] = conteos.get(clave, 0) + 1
+    if not conteos:
+        return
+    
+    filas = [
+        {'region': region, 'tipo': tipo, 'nombre_cientifico': cientifico, 'dia': dia, 'cantidad': cantidad}
+        for (region, tipo, cientifico, dia), cantidad in conteos.items()
+    ]
+    dialecto = db.engine.dialect.name
+    if dialecto in ('sqlite', 'postgresql'):
+        stmt = (sqlite if dialecto == 'sqlite' else postgresql).insert(RegionRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['region', 'tipo', 'nombre_cientifico', 'dia'],
+            set_={'cantidad': RegionRollup.cantidad + stmt.excluded.cantidad}
+        )
+        db.session.execute(stmt, filas)
+        return
+    
+    for fila in filas:
+        actualizadas = RegionRollup.query.filter_by(
+            region=fila['region'], tipo=fila['tipo'],
+            nombre_cientifico=fila['nombre_cientifico'], dia=fila['dia']
+        ).update({RegionRollup.cantidad: RegionRollup.cantidad + fila['cantidad']}, synchronize_session=False)
+        if not actualizadas:
+            db.session.add(RegionRollup(**fila))
+
+def insert_ignorando_duplicados(modelo):
+    """INSERT que omite filas que violan una restricción única (SQLite/Postgres)."""
+    dialecto = db.engine.dialect.name
+    if dialecto == 'sqlite':
+        return sqlite.insert(modelo).on_conflict_do_nothing()
+    if dialecto == 'postgresql':
+        return postgresql.insert(modelo).on_conflict_do_nothing()
+    return insert(modelo)
+
+@app.route('/sincronizar_lote', methods=['POST'])
+@login_required
+def sincronizar_lote():
+    """
+    Sincroniza en una sola transacción los descubrimientos acumulados offline.
+    Cada elemento trae una 'clave' generada por el cliente; las claves ya
+    guardadas se omiten, así que reenviar el mismo lote es seguro.
+    """
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data, dict):
+            return jsonify({'error': 'No se recibieron datos'}), 400
+        
+        items = data.get('descubrimientos') or []
+        if not isinstance(items, list):
+            return jsonify({'error': 'descubrimientos debe ser una lista'}), 400
+        if len(items) > LOTE_MAXIMO:
+            return jsonify({'error': f'Máximo {LOTE_MAXIMO} descubrimientos por lote'}), 400
+        puntos_totales = None
+        if data.get('puntos') is not None:
+            try:
+                puntos_totales = int(data['puntos'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'El campo puntos debe ser un número'}), 400
+        
+        # Validar y deduplicar dentro del propio lote (gana la última aparición)
+        filas = {}
+        for item in items:
+            if not isinstance(item, dict):
+                return jsonify({'error': 'Cada descubrimiento debe ser un objeto'}), 400
+            clave = clave_valida(item.get('clave'))
+            if clave is None:
+                return jsonify({'error': 'Cada descubrimiento necesita una clave válida'}), 400
+            for field in ['nombre', 'cientifico', 'tipo']:
+                if not item.get(field):
+                    return jsonify({'error': f'El campo {field} es obligatorio'}), 400
+            try:
+                fecha = datetime.fromisoformat(item['fecha']) if item.get('fecha') else datetime.utcnow()
+            except (TypeError, ValueError):
+                return jsonify({'error': f'Fecha inválida en {clave}'}), 400
+            try:
+                puntos = int(item.get('puntos', 0))
+            except (TypeError, ValueError):
+                return jsonify({'error': f'Puntos inválidos en {clave}'}), 400
+            filas[clave] = {
+                'user_id': current_user.id,
+                'nombre_especie': item['nombre'],
+                'nombre_cientifico': item['cientifico'],
+                'tipo': item['tipo'],
+                'imagen_url': item.get('imagen_url'),
+                'puntos': puntos,
+                'fecha': fecha,
+                'clave_idempotencia': clave,
+                **datos_ubicacion(item)
+            }
+        
+        insertados = 0
+        filas_insertadas = []
+        if filas:
+            existentes = {
+                clave for (clave,) in db.session.query(Discovery.clave_idempotencia).filter(
+                    Discovery.user_id == current_user.id,
+                    Discovery.clave_idempotencia.in_(list(filas))
+                )
+            }
+            nuevas = [fila for clave, fila in filas.items() if clave not in existentes]
+            if nuevas:
+                # executemany; la restricción única cubre lotes concurrentes con las mismas claves
+                resultado = db.session.execute(
+                    insert_ignorando_duplicados(Discovery).returning(
+                        Discovery.fecha, Discovery.puntos, Discovery.region,
+                        Discovery.tipo, Discovery.nombre_cientifico
+                    ), nuevas
+                )
+                filas_insertadas = resultado.all()
+                insertados = len(filas_insertadas)
+                sumar_a_agregados([(f.region, f.tipo, f.nombre_cientifico, f.fecha) for f in filas_insertadas])
+        
+        cambios = {}
+        if insertados:
+            cambios[User.total_descubrimientos] = User.total_descubrimientos + insertados
+        if cambios:
+            User.query.filter_by(id=current_user.id).update(cambios, synchronize_session=False)
+        db.session.commit()
+        if cambios:
+            invalidar_usuario(current_user.id)
+        
+        for fila in filas_insertadas:
+            actualizar_ranking_ventanas(current_user.id, fila.fecha, fila.puntos)
+        if puntos_totales is not None:
+            registrar_puntos(current_user, puntos_totales)
+        
+        return jsonify({
+            'success': True,
+            'insertados': insertados,
+            'duplicados': len(items) - insertados,
+            'descubrimientos_count': current_user.total_descubrimientos,
+            'puntos': current_user.total_puntos
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+# ========================================
+# RUTAS DE NATURADEX
+# ========================================
+
+NATURADEX_LIMITE_DEFECTO = 20
+NATURADEX_LIMITE_MAXIMO = 100
+
+def codificar_cursor(descubrimiento):
+    """Genera un cursor opaco (fecha|id) a partir del último elemento de una página."""
+    valor = f"{descubrimiento.fecha.isoformat()}|{descubrimiento.id}"
+    return base64.urlsafe_b64encode(valor.encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor):
+    """Convierte un cursor en (fecha, id). Lanza ValueError si es inválido."""
+    try:
+        valor = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        fecha_str, id_str = valor.split('|', 1)
+        return datetime.fromisoformat(fecha_str), int(id_str)
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+@app.route('/naturadex', methods=['GET'])
+@login_required
+def listar_naturadex():
+    """
+    Lista los descubrimientos del usuario, del más reciente al más antiguo.
+    Usa paginación por cursor (keyset) sobre (fecha, id) para que cada página
+    sea una lectura por rango del índice ix_discovery_user_fecha.
+    """
+    try:
+        limite = int(request.args.get('limite', NATURADEX_LIMITE_DEFECTO))
+    except ValueError:
+        return jsonify({'error': 'El parámetro limite debe ser un número'}), 400
+    limite = max(1, min(limite, NATURADEX_LIMITE_MAXIMO))
+    
+    consulta = Discovery.query.filter(Discovery.user_id == current_user.id)
+    
+    tipo = request.args.get('tipo')
+    if tipo:
+        consulta = consulta.filter(Discovery.tipo == tipo)
+    
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            fecha_cursor, id_cursor = decodificar_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        consulta = consulta.filter(or_(
+            Discovery.fecha < fecha_cursor,
+            and_(Discovery.fecha == fecha_cursor, Discovery.id < id_cursor)
+        ))
+    
+    # Pedimos uno extra para saber si existe una página siguiente
+    filas = consulta.order_by(Discovery.fecha.desc(), Discovery.id.desc()).limit(limite + 1).all()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    
+    return jsonify({
+        'descubrimientos': [d.to_dict() for d in filas],
+        'siguiente_cursor': codificar_cursor(filas[-1]) if hay_mas else None,
+        'total': current_user.total_descubrimientos or 0
+    })
+
+# Token (Authorization: Bearer ...) con el que los docentes exportan descubrimientos de sus alumnos
+NATURADEX_EXPORT_TOKEN = os.getenv('NATURADEX_EXPORT_TOKEN')
+# Filas que se traen de la base de datos por lote al exportar
+EXPORTACION_FILAS_POR_LOTE = 1000
+
+def es_docente():
+    """True si la petición trae el token de exportación."""
+    if not NATURADEX_EXPORT_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {NATURADEX_EXPORT_TOKEN}')
+
+@app.route('/naturadex/export', methods=['GET'])
+def exportar_naturadex():
+    """
+    Descarga descubrimientos en CSV o NDJSON (formato=csv|ndjson), en
+    streaming: las filas se leen de a lotes con yield_per (cursor del lado
+    del servidor en PostgreSQL) y se envían a medida que se leen, así que la
+    memoria no crece con la cantidad de filas. Con Accept-Encoding: gzip se
+    comprime al vuelo.
+    Filtros: tipo, desde y hasta (YYYY-MM-DD, inclusivos) y, con el token de
+    docente, usuario (ids separados por coma); sin él, solo los propios.
+    """
+    docente = es_docente()
+    if not docente and not current_user.is_authenticated:
+        return login_manager.unauthorized()
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS_EXPORTACION:
+        return jsonify({'error': 'El formato debe ser csv o ndjson'}), 400
+
+    consulta = db.select(Discovery.id, Discovery.user_id, User.nombre + ' ' + User.apellido,
+                         Discovery.nombre_especie, Discovery.nombre_cientifico, Discovery.tipo,
+                         Discovery.puntos, Discovery.fecha, Discovery.region, Discovery.latitud,
+                         Discovery.longitud, Discovery.imagen_url).join(User, User.id == Discovery.user_id)
+    try:
+        if docente:
+            if request.args.get('usuario'):
+                usuarios = [int(u) for u in request.args['usuario'].split(',')]
+                consulta = consulta.where(Discovery.user_id.in_(usuarios))
+        else:
+            consulta = consulta.where(Discovery.user_id == current_user.id)
+    except ValueError:
+        return jsonify({'error': 'usuario debe ser una lista de ids separados por coma'}), 400
+    try:
+        if request.args.get('desde'):
+            consulta = consulta.where(Discovery.fecha >= datetime.strptime(request.args['desde'], '%Y-%m-%d'))
+        if request.args.get('hasta'):
+            hasta = datetime.strptime(request.args['hasta'], '%Y-%m-%d') + timedelta(days=1)
+            consulta = consulta.where(Discovery.fecha < hasta)
+    except ValueError:
+        return jsonify({'error': 'Las fechas deben tener formato YYYY-MM-DD'}), 400
+    if request.args.get('tipo'):
+        consulta = consulta.where(Discovery.tipo == request.args['tipo'])
+    consulta = consulta.order_by(Discovery.fecha, Discovery.id) \
+        .execution_options(yield_per=EXPORTACION_FILAS_POR_LOTE)
+
+    usar_gzip = 'gzip' in request.accept_encodings
+    cabeceras = {'Content-Disposition': f'attachment; filename=naturadex-{datetime.utcnow():%Y%m%d}.{formato}',
+                 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-store'}
+    if usar_gzip:
+        cabeceras['Content-Encoding'] = 'gzip'
+    trozos = exportar_filas(db.session.execute(consulta), formato, usar_gzip)
+    # stream_with_context mantiene la sesión de base de datos abierta mientras se envía
+    return Response(stream_with_context(trozos), mimetype=FORMATOS_EXPORTACION[formato], headers=cabeceras)
+
+# ========================================
+# RANKING DE EXPLORADORES
+# ========================================
+
+def actualizar_ranking_global(user_id, puntos):
+    """Refleja el total de puntos de un usuario en el ranking global."""
+    try:
+        ranking.fijar('global', user_id, puntos or 0)
+    except Exception as e:
+        # La reconstrucción periódica corrige cualquier actualización perdida
+        print(f"Error actualizando ranking global: {e}")
+
+def actualizar_ranking_ventanas(user_id, fecha, puntos):
+    """Suma los puntos de un descubrimiento a las ventanas (semana/mes) en curso."""
+    try:
+        for ventana in ('semana', 'mes'):
+            clave = clave_ventana(ventana, fecha)
+            if clave == clave_ventana(ventana):
+                ranking.incrementar(clave, user_id, puntos or 0)
+    except Exception as e:
+        print(f"Error actualizando ranking por ventana: {e}")
+
+def reconstruir_ranking():
+    """Recalcula todas las tablas desde la base de datos (control de consistencia)."""
+    puntos_diferidos.vaciar()
+    tablas = {'global': {uid: puntos or 0 for uid, puntos in db.session.query(User.id, User.total_puntos)}}
+    for ventana in ('semana', 'mes'):
+        filas = db.session.query(Discovery.user_id, func.sum(Discovery.puntos)) \
+            .filter(Discovery.fecha >= inicio_ventana(ventana)) \
+            .group_by(Discovery.user_id)
+        tablas[clave_ventana(ventana)] = {uid: total or 0 for uid, total in filas}
+    ranking.reemplazar(tablas)
+
+_reconstruyendo_ranking = threading.Lock()
+
+def reconstruir_ranking_en_fondo():
+    """Lanza la reconstrucción en un hilo; mientras tanto /ranking sigue leyendo las tablas actuales."""
+    if not _reconstruyendo_ranking.acquire(blocking=False):
+        return None
+    def reconstruir():
+        try:
+            with app.app_context():
+                reconstruir_ranking()
+        except Exception as e:
+            print(f"Error reconstruyendo el ranking: {e}")
+        finally:
+            _reconstruyendo_ranking.release()
+    hilo = threading.Thread(target=reconstruir, name='reconstruir-ranking', daemon=True)
+    hilo.start()
+    return hilo
+
+@app.cli.command('reconstruir-ranking')
+def reconstruir_ranking_comando():
+    """Reconstruye el ranking desde cero."""
+    reconstruir_ranking()
+    print("✅ Ranking reconstruido")
+
+@app.route('/ranking', methods=['GET'])
+def obtener_ranking():
+    """
+    Tabla de posiciones de exploradores (global, semana o mes).
+    Se sirve desde el ranking precalculado; si hay sesión incluye la posición del usuario.
+    La reconstrucción periódica corre en segundo plano, nunca dentro de la petición.
+    """
+    ventana = request.args.get('ventana', 'global')
+    if ventana not in VENTANAS:
+        return jsonify({'error': f'Ventana inválida. Usa: {", ".join(VENTANAS)}'}), 400
+    try:
+        limite = max(1, min(int(request.args.get('limite', 10)), 100))
+    except ValueError:
+        return jsonify({'error': 'El parámetro limite debe ser un número'}), 400
+    
+    try:
+        if ranking.reclamar_reconstruccion(RANKING_RECONSTRUCCION_SEGUNDOS):
+            reconstruir_ranking_en_fondo()
+        
+        clave = clave_ventana(ventana)
+        top = ranking.top(clave, limite)
+        nombres = {
+            u.id: f"{u.nombre} {u.apellido[:1]}.".strip()
+            for u in User.query.filter(User.id.in_([uid for uid, _ in top]))
+        } if top else {}
+        
+        tabla = []
+        for i, (user_id, puntos) in enumerate(top):
+            # Los empates comparten posición
+            posicion = tabla[-1]['posicion'] if tabla and tabla[-1]['puntos'] == puntos else i + 1
+            tabla.append({'posicion': posicion, 'nombre': nombres.get(user_id, 'Explorador'), 'puntos': puntos})
+        
+        mi_posicion = None
+        if current_user.is_authenticated:
+            encontrado = ranking.posicion(clave, current_user.id)
+            if encontrado:
+                mi_posicion = {'posicion': encontrado[0], 'puntos': encontrado[1]}
+        
+        return jsonify({'ventana': ventana, 'ranking': tabla, 'mi_posicion': mi_posicion})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ========================================
+# MAPA DE DESCUBRIMIENTOS
+# ========================================
+
+def reconstruir_agregados():
+    """Recalcula RegionRollup completo desde Discovery (mantenimiento)."""
+    dia = func.date(Discovery.fecha)
+    origen = db.select(Discovery.region, Discovery.tipo, Discovery.nombre_cientifico, dia, func.count()) \
+        .where(Discovery.region.isnot(None)) \
+        .group_by(Discovery.region, Discovery.tipo, Discovery.nombre_cientifico, dia)
+    RegionRollup.query.delete()
+    db.session.execute(insert(RegionRollup).from_select(
+        ['region', 'tipo', 'nombre_cientifico', 'dia', 'cantidad'], origen))
+    db.session.commit()
+
+@app.cli.command('reconstruir-agregados')
+def reconstruir_agregados_comando():
+    """Reconstruye los agregados del mapa desde cero."""
+    reconstruir_agregados()
+    print(f"✅ Agregados reconstruidos: {RegionRollup.query.count()} filas")
+
+@app.route('/mapa/agregados', methods=['GET'])
+def mapa_agregados():
+    """
+    Descubrimientos por región para colorear el mapa de Chile.
+    Lee solo RegionRollup; filtros opcionales: tipo, especie (nombre científico),
+    desde y hasta (YYYY-MM-DD, inclusivos).
+    """
+    consulta = db.session.query(RegionRollup.region, RegionRollup.tipo, func.sum(RegionRollup.cantidad))
+    try:
+        if request.args.get('desde'):
+            consulta = consulta.filter(RegionRollup.dia >= datetime.strptime(request.args['desde'], '%Y-%m-%d').date())
+        if request.args.get('hasta'):
+            consulta = consulta.filter(RegionRollup.dia <= datetime.strptime(request.args['hasta'], '%Y-%m-%d').date())
+    except ValueError:
+        return jsonify({'error': 'Las fechas deben tener formato YYYY-MM-DD'}), 400
+    if request.args.get('tipo'):
+        consulta = consulta.filter(RegionRollup.tipo == request.args['tipo'])
+    if request.args.get('especie'):
+        consulta = consulta.filter(RegionRollup.nombre_cientifico == request.args['especie'])
+    
+    regiones = {}
+    for region, tipo, cantidad in consulta.group_by(RegionRollup.region, RegionRollup.tipo):
+        entrada = regiones.setdefault(region, {'total': 0, 'por_tipo': {}})
+        entrada['total'] += int(cantidad)
+        entrada['por_tipo'][tipo] = int(cantidad)
+    
+    return jsonify({
+        'regiones': regiones,
+        'maximo': max((r['total'] for r in regiones.values()), default=0)
+    })
+
+CERCA_LIMITE_PUNTOS = 500
+
+def leer_coordenadas(*nombres):
+    """Lee parámetros numéricos de la query string; None si falta alguno."""
+    try:
+        return tuple(float(request.args[n]) for n in nombres)
+    except (KeyError, ValueError):
+        return None
+
+@app.route('/descubrimientos/cerca', methods=['GET'])
+def descubrimientos_cerca():
+    """
+    Descubrimientos dentro de un rectángulo (sur, oeste, norte, este) o de un
+    radio (lat, lng, radio_km). El área se cubre con prefijos de geohash, así
+    que la base solo recorre rangos del índice ix_discovery_geohash.
+    Con ?zoom= bajo, los puntos se agrupan por celda en el servidor.
+    """
+    bbox = leer_coordenadas('sur', 'oeste', 'norte', 'este')
+    centro = leer_coordenadas('lat', 'lng', 'radio_km')
+    if centro:
+        lat, lng, radio_km = centro
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not 0 < radio_km <= 500:
+            return jsonify({'error': 'Centro o radio fuera de rango (radio máximo 500 km)'}), 400
+        bbox = bbox_de_radio(lat, lng, radio_km)
+    elif not bbox:
+        return jsonify({'error': 'Indica sur, oeste, norte y este, o lat, lng y radio_km'}), 400
+    sur, oeste, norte, este = bbox
+    # Las comparaciones también descartan nan e inf (float() los acepta)
+    if not (-90 <= sur <= 90 and -90 <= norte <= 90 and -180 <= oeste <= 180 and -180 <= este <= 180):
+        return jsonify({'error': 'Rectángulo fuera de rango (latitud ±90, longitud ±180)'}), 400
+    if sur > norte or oeste > este:
+        return jsonify({'error': 'El rectángulo está invertido'}), 400
+    
+    rangos = [
+        and_(Discovery.geohash >= prefijo, Discovery.geohash < prefijo + '~')
+        for prefijo in celdas_para_bbox(sur, oeste, norte, este)
+    ]
+    filtros = [
+        or_(*rangos),
+        Discovery.latitud.between(sur, norte),
+        Discovery.longitud.between(oeste, este)
+    ]
+    if request.args.get('tipo'):
+        filtros.append(Discovery.tipo == request.args['tipo'])
+    
+    try:
+        zoom = int(request.args.get('zoom', 20))
+    except ValueError:
+        return jsonify({'error': 'El parámetro zoom debe ser un número'}), 400
+    precision = precision_para_zoom(zoom)
+    
+    if precision:
+        # Agrupación en SQL: una fila por celda en vez de miles de puntos
+        # (en búsquedas por radio se agrupa sobre el rectángulo que lo contiene)
+        celda = func.substr(Discovery.geohash, 1, precision)
+        filas = db.session.query(celda, func.count(), func.avg(Discovery.latitud), func.avg(Discovery.longitud)) \
+            .filter(*filtros).group_by(celda).all()
+        return jsonify({
+            'clusters': [
+                {'geohash': g, 'cantidad': n, 'latitud': round(la, 4), 'longitud': round(lo, 4)}
+                for g, n, la, lo in filas
+            ],
+            'total': sum(f[1] for f in filas)
+        })
+    
+    filas = db.session.query(
+        Discovery.id, Discovery.nombre_especie, Discovery.nombre_cientifico,
+        Discovery.tipo, Discovery.latitud, Discovery.longitud
+    ).filter(*filtros).order_by(Discovery.id.desc()).limit(CERCA_LIMITE_PUNTOS * 2).all()
+    if centro:
+        filas = [f for f in filas if distancia_km(lat, lng, f.latitud, f.longitud) <= radio_km]
+    filas = filas[:CERCA_LIMITE_PUNTOS]
+    
+    return jsonify({
+        'puntos': [
+            {'id': f.id, 'nombre': f.nombre_especie, 'cientifico': f.nombre_cientifico,
+             'tipo': f.tipo, 'latitud': f.latitud, 'longitud': f.longitud}
+            for f in filas
+        ],
+        'total': len(filas)
+    })
+
+# ========================================
+# CATÁLOGO DE ESPECIES Y REGIONES
+# ========================================
+
+def responder_precalculado(respuesta, max_age=60):
+    """
+    Envía una respuesta del catálogo ya serializada.
+    Usa la variante gzip si el cliente la acepta y responde 304 si su ETag coincide.
+    """
+    usar_gzip = 'gzip' in request.accept_encodings
+    # Cada codificación es una representación distinta, con su propio ETag fuerte
+    etag = f'{respuesta.etag}-gz' if usar_gzip else respuesta.etag
+    cabeceras = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': f'public, max-age={max_age}',
+        'Vary': 'Accept-Encoding'
+    }
+    if etag in request.if_none_match:
+        return Response(status=304, headers=cabeceras)
+    
+    if usar_gzip:
+        cabeceras['Content-Encoding'] = 'gzip'
+    cuerpo = respuesta.cuerpo_gzip if usar_gzip else respuesta.cuerpo
+    return Response(cuerpo, status=200, mimetype='application/json', headers=cabeceras)
+
+@app.route('/especies', methods=['GET'])
+def listar_especies():
+    """Catálogo de especies de Chile, opcionalmente filtrado por ?tipo=."""
+    return responder_precalculado(catalogo.especies(request.args.get('tipo') or None))
+
+@app.route('/especies/<especie_id>', methods=['GET'])
+def obtener_especie(especie_id):
+    """Ficha de una especie del catálogo por su id."""
+    respuesta = catalogo.especie(especie_id)
+    if respuesta is None:
+        return jsonify({'error': 'Especie no encontrada'}), 404
+    return responder_precalculado(respuesta)
+
+@app.route('/regiones/<region>/especies', methods=['GET'])
+def especies_por_region(region):
+    """Especies que habitan una región (acepta nombre o slug, p. ej. 'la-araucania')."""
+    respuesta = catalogo.especies_region(region, request.args.get('tipo') or None)
+    if respuesta is None:
+        return jsonify({'error': 'Región no encontrada'}), 404
+    return responder_precalculado(respuesta)
+
 def allowed_file(filename):
     """Verifica si la extensión del archivo es permitida."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# ========================================
+# ASSETS ESTÁTICOS
+# ========================================
+
+@app.template_global()
+def asset_url(ruta):
+    """URL de un archivo de static/: con huella si está compilado, la de siempre si no."""
+    return assets.url(ruta) or url_for('static', filename=ruta)
+
+@app.route('/assets/<path:nombre>')
+def servir_asset(nombre):
+    """
+    Archivo compilado con huella. Elige la variante precomprimida (br o gzip)
+    según Accept-Encoding; el contenido nunca cambia, así que la caché es inmutable.
+    """
+    if nombre not in assets.publicados:
+        return jsonify({'error': 'Archivo no encontrado'}), 404
+    
+    codificacion, extension = None, ''
+    for candidata, sufijo in (('br', '.br'), ('gzip', '.gz')):
+        if candidata in request.accept_encodings and os.path.exists(os.path.join(assets.carpeta, nombre + sufijo)):
+            codificacion, extension = candidata, sufijo
+            break
+    
+    respuesta = send_from_directory(assets.carpeta, nombre + extension,
+                                    mimetype=mimetypes.guess_type(nombre)[0],
+                                    max_age=ASSETS_CACHE_SEGUNDOS)
+    respuesta.headers['Cache-Control'] = f'public, max-age={ASSETS_CACHE_SEGUNDOS}, immutable'
+    respuesta.headers['Vary'] = 'Accept-Encoding'
+    if codificacion:
+        respuesta.headers['Content-Encoding'] = codificacion
+    return respuesta
+
+@app.route('/sw.js')
+def service_worker():
+    """Service worker en la raíz (alcance '/'); el compilado conoce las URLs con huella."""
+    ruta = assets.ruta_service_worker() or os.path.join(app.static_folder, 'sw.js')
+    respuesta = send_file(ruta, mimetype='application/javascript', max_age=0)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
+
+@app.cli.command('build-assets')
+def build_assets_comando():
+    """Minifica, optimiza y precomprime static/ en static/dist."""
+    manifiesto = construir_assets()
+    assets.cargar()
+    antes = sum(t['original'] for t in manifiesto['tamanos'].values())
+    despues = sum(min(t.values()) for t in manifiesto['tamanos'].values())
+    print(f"✅ {len(manifiesto['archivos'])} archivos en static/dist "
+          f"({antes / 1024:.0f} KB → {despues / 1024:.0f} KB con br/gzip)")
+
+@app.cli.command('precalentar')
+@click.option('--populares', default=50, show_default=True, help='Especies más descubiertas a incluir.')
+@click.option('--hilos', default=4, show_default=True)
+@click.option('--por-segundo', default=2.0, show_default=True, help='Límite de llamadas externas por segundo.')
+@click.option('--sin-gemini', is_flag=True, help='Solo imágenes y sonidos (sin búsquedas por texto).')
+@click.option('--reiniciar', is_flag=True, help='Ignorar el avance guardado y empezar de cero.')
+def precalentar_comando(populares, hilos, por_segundo, sin_gemini, reiniciar):
+    """Llena las cachés de búsquedas, imágenes y sonidos de las especies populares."""
+    frecuentes = db.session.query(func.min(Discovery.nombre_especie), Discovery.nombre_cientifico, Discovery.tipo) \
+        .group_by(Discovery.nombre_cientifico, Discovery.tipo) \
+        .order_by(func.count().desc()).limit(populares).all()
+    especies = especies_a_precalentar(list(catalogo.por_id.values()), [tuple(f) for f in frecuentes])
+    resumen = precalentar(especies, os.path.join(app.instance_path, 'precalentar.json'), ARCHIVO_ENRIQUECIMIENTO,
+                          hilos=hilos, por_segundo=por_segundo, con_gemini=not sin_gemini, reiniciar=reiniciar)
+    print(f"✅ {resumen['especies']} especies, {resumen['llamadas']} llamadas en {resumen['segundos']} s")
+    if resumen['errores']:
+        print(f"   {resumen['errores']} con error: se reintentan en la próxima corrida")
+
 @app.route('/')
 def index():
     """Página principal de la aplicación."""
@@ -219,13 +1081,75 @@ def index():
 
 @app.route('/favicon.ico')
 def favicon():
-    import os
-    from flask import send_from_directory
     return send_from_directory(os.path.join(app.root_path, 'static', 'icons'),
                                'icon-192.png', mimetype='image/png')
 
 
 
+TIPOS_VALIDOS = ['insecto', 'planta', 'ave', 'animal']
+
+def normalizar_tipo(tipo):
+    """Tipo de análisis válido, o 'insecto' por defecto."""
+    return tipo if tipo in TIPOS_VALIDOS else 'insecto'
+
+def estado_resultado(resultado):
+    """Código HTTP para un resultado de Gemini con error."""
+    return 400 if resultado.get('codigo_error') in ['QUOTA_EXCEEDED', 'API_KEY_ERROR'] else 200
+
+# Validaciones compartidas por las rutas Flask y las de asgi.py.
+# Retornan los valores limpios o un (cuerpo_de_error, código).
+
+def validar_imagen(filename):
+    """Valida el archivo recibido en /analizar."""
+    if filename is None:
+        return {'error': '¡Ups! No recibí ninguna imagen. ¿Puedes intentar de nuevo?'}, 400
+    
+    # Verificar que el archivo tiene nombre
+    if filename == '':
+        return {'error': '¡Ups! La imagen no tiene nombre. Intenta con otra.'}, 400
+    
+    # Verificar extensión permitida
+    if not allowed_file(filename):
+        return {'error': '¡Ups! Solo acepto imágenes (PNG, JPG, GIF o WEBP).'}, 400
+    return None
+
+def validar_busqueda(data):
+    """Valida el JSON de /buscar. Retorna ((consulta, tipo), None) o (None, error)."""
+    if not data:
+        return None, ({'error': '¡Ups! No recibí datos. Intenta de nuevo.'}, 400)
+    
+    consulta = data.get('consulta', '').strip()
+    if not consulta:
+        return None, ({'error': '¡Escribe o di el nombre de lo que quieres buscar!'}, 400)
+    
+    return (consulta, normalizar_tipo(data.get('tipo', 'insecto'))), None
+
+def validar_sonido(data):
+    """Valida el JSON de /sonido. Retorna ((nombre, cientifico, tipo), None) o (None, error)."""
+    if not data:
+        return None, ({'error': 'No se recibieron datos'}, 400)
+    
+    nombre = data.get('nombre', '').strip()
+    cientifico = data.get('cientifico', '').strip()
+    
+    if not nombre and not cientifico:
+        return None, ({'error': 'Se requiere nombre o nombre científico'}, 400)
+    
+    return (nombre, cientifico, data.get('tipo', 'insecto')), None
+
+def respuesta_sonido(resultado):
+    """Cuerpo de respuesta de /sonido."""
+    if resultado:
+        return {
+            'encontrado': True,
+            'sonido': resultado
+        }
+    return {
+        'encontrado': False,
+        'mensaje': 'No se encontró sonido para esta especie'
+    }
+
+
 @app.route('/analizar', methods=['POST'])
 def analizar():
     """
@@ -235,40 +1159,24 @@ def analizar():
     """
     try:
         # Verificar que se envió un archivo
-        if 'imagen' not in request.files:
-            return jsonify({
-                'error': '¡Ups! No recibí ninguna imagen. ¿Puedes intentar de nuevo?'
-            }), 400
-        
-        file = request.files['imagen']
-        
-        # Verificar que el archivo tiene nombre
-        if file.filename == '':
-            return jsonify({
-                'error': '¡Ups! La imagen no tiene nombre. Intenta con otra.'
-            }), 400
-        
-        # Verificar extensión permitida
-        if not allowed_file(file.filename):
-            return jsonify({
-                'error': '¡Ups! Solo acepto imágenes (PNG, JPG, GIF o WEBP).'
-            }), 400
+        file = request.files.get('imagen')
+        error = validar_imagen(file.filename if file else None)
+        if error:
+            return jsonify(error[0]), error[1]
         
         # Obtener el tipo de análisis (insecto, planta, ave o animal)
-        tipo = request.form.get('tipo', 'insecto')
-        if tipo not in ['insecto', 'planta', 'ave', 'animal']:
-            tipo = 'insecto'
+        tipo = normalizar_tipo(request.form.get('tipo', 'insecto'))
         
-        # Leer los bytes de la imagen
-        image_data = file.read()
+        # La imagen ya se validó al recibirla; se pasa como archivo, sin copiarla a memoria
+        imagen = file.stream.finalizar()
         
         # Analizar con Gemini
-        resultado = analizar_imagen(image_data, tipo)
+        resultado = analizar_imagen(imagen, tipo)
         
         # Verificar si hubo error
         if 'error' in resultado:
-            status_code = 400 if resultado.get('codigo_error') in ['QUOTA_EXCEEDED', 'API_KEY_ERROR'] else 200
-            return jsonify(resultado), status_code
+            return jsonify(resultado), estado_resultado(resultado)
+        autocompletado.aprender(resultado.get('nombre'), resultado.get('cientifico'), tipo)
         
         # Buscar imagen de la especie identificada
         imagen_url = obtener_imagen_especie(
@@ -280,6 +1188,8 @@ def analizar():
         
         return jsonify(resultado), 200
         
+    except ErrorSubida as e:
+        return jsonify({'error': e.mensaje}), e.codigo
     except Exception as e:
         return jsonify({
             'error': f'¡Algo salió mal! {str(e)}'
@@ -295,31 +1205,18 @@ def buscar():
     """
     try:
         # Obtener datos del JSON
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({
-                'error': '¡Ups! No recibí datos. Intenta de nuevo.'
-            }), 400
-        
-        consulta = data.get('consulta', '').strip()
-        tipo = data.get('tipo', 'insecto')
-        
-        if not consulta:
-            return jsonify({
-                'error': '¡Escribe o di el nombre de lo que quieres buscar!'
-            }), 400
-        
-        if tipo not in ['insecto', 'planta', 'ave', 'animal']:
-            tipo = 'insecto'
+        valores, error = validar_busqueda(request.get_json())
+        if error:
+            return jsonify(error[0]), error[1]
+        consulta, tipo = valores
         
         # Buscar con Gemini
         resultado = buscar_por_texto(consulta, tipo)
         
         # Verificar si hubo error
         if 'error' in resultado:
-            status_code = 400 if resultado.get('codigo_error') in ['QUOTA_EXCEEDED', 'API_KEY_ERROR'] else 200
-            return jsonify(resultado), status_code
+            return jsonify(resultado), estado_resultado(resultado)
+        autocompletado.aprender(resultado.get('nombre'), resultado.get('cientifico'), tipo)
             
         # Buscar imagen
         imagen_url = obtener_imagen_especie(
@@ -337,6 +1234,39 @@ def buscar():
         }), 500
 
 
+def fuentes_autocompletado():
+    """(nombre, científico, tipo, popularidad) de todas las especies conocidas."""
+    with app.app_context():
+        descubiertas = db.session.query(func.min(Discovery.nombre_especie), Discovery.nombre_cientifico,
+                                        Discovery.tipo, func.count()) \
+            .group_by(Discovery.nombre_cientifico, Discovery.tipo).all()
+    especies = [tuple(fila) for fila in descubiertas]
+    especies += [(e['nombre_comun'], e['nombre_cientifico'], e['tipo'], 1) for e in catalogo.por_id.values()]
+    especies += [(nombre.capitalize(), cientifico, 'ave', 0) for nombre, cientifico in AVES_CHILE.items()]
+    # Lo que ya respondió Gemini (y quedó en la caché de búsquedas)
+    for _, registro in enriquecimiento.busquedas.almacen.registros(enriquecimiento.busquedas.nombre):
+        valor = registro['valor']
+        if isinstance(valor, dict) and valor.get('nombre') and valor.get('tipo'):
+            especies.append((valor['nombre'], valor.get('cientifico'), valor['tipo'], 0))
+    return especies
+
+autocompletado = Autocompletado(fuentes_autocompletado)
+
+@app.route('/autocompletar', methods=['GET'])
+def autocompletar():
+    """
+    Sugerencias de especies conocidas para la caja de búsqueda (por prefijo
+    y aproximadas). Parámetros: q, tipo (opcional) y limite (máx. 20).
+    """
+    consulta = request.args.get('q', '')
+    tipo = request.args.get('tipo')
+    limite = min(request.args.get('limite', 8, type=int), 20)
+    sugerencias = autocompletado.sugerir(consulta, tipo if tipo in TIPOS_VALIDOS else None, limite)
+    response = jsonify({'consulta': consulta, 'sugerencias': sugerencias})
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
+
+
 @app.route('/sonido', methods=['POST'])
 def obtener_sonido():
     """
@@ -344,31 +1274,14 @@ def obtener_sonido():
     Utiliza la API de Xeno-Canto para aves chilenas.
     """
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({'error': 'No se recibieron datos'}), 400
-        
-        nombre = data.get('nombre', '').strip()
-        cientifico = data.get('cientifico', '').strip()
-        tipo = data.get('tipo', 'insecto')
-        
-        if not nombre and not cientifico:
-            return jsonify({'error': 'Se requiere nombre o nombre científico'}), 400
+        valores, error = validar_sonido(request.get_json())
+        if error:
+            return jsonify(error[0]), error[1]
         
         # Buscar sonido
-        resultado = buscar_sonido(nombre, cientifico, tipo)
+        resultado = buscar_sonido(*valores)
         
-        if resultado:
-            return jsonify({
-                'encontrado': True,
-                'sonido': resultado
-            }), 200
-        else:
-            return jsonify({
-                'encontrado': False,
-                'mensaje': 'No se encontró sonido para esta especie'
-            }), 200
+        return jsonify(respuesta_sonido(resultado)), 200
             
     except Exception as e:
         return jsonify({
@@ -386,12 +1299,28 @@ def health_check():
     })
 
 
+@app.route('/metricas')
+def metricas():
+    """
+    Contadores de este worker: cuántas llamadas a Gemini, Wikipedia y
+    Xeno-Canto se coalescieron con otra idéntica en curso, cómo se
+    respondieron las imágenes y sonidos (frescos, viejos o esperando), y en
+    qué orden se están probando los modelos de Gemini.
+    """
+    return jsonify({'coalescencia': vuelo_unico.metricas(),
+                    'enriquecimiento': enriquecimiento.estadisticas(),
+                    'huellas': indice_huellas.estadisticas(),
+                    'modelos': enrutador.estado()})
+
+
 if __name__ == '__main__':
     # Verificar que existe la API key
     if not os.getenv('GOOGLE_API_KEY'):
         print("⚠️  ADVERTENCIA: No se encontró GOOGLE_API_KEY en el archivo .env")
         print("   Crea un archivo .env con tu API key de Google Gemini")
     
+    inicializar_base_de_datos()
+    
     # Ejecutar servidor
     debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
     port = int(os.environ.get('PORT', 5001))
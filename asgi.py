@@ -0,0 +1,166 @@
+"""
+NaturIA Chile - Modo asíncrono (ASGI)
+
+Sirve /analizar, /buscar y /sonido con handlers async: mientras esperan a
+Gemini, Wikipedia, Wikimedia o Xeno-Canto no ocupan un worker, así que un
+solo proceso atiende cientos de peticiones concurrentes. El resto de la app
+(sesiones, Naturadex, ranking, catálogo...) sigue siendo la app Flask,
+montada tal cual.
+
+Requiere requirements-async.txt. Para ejecutar:
+    uvicorn asgi:app --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+"""
+
+from contextlib import asynccontextmanager
+
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+from app import (app as flask_app, validar_imagen, validar_busqueda, validar_sonido,
+                 respuesta_sonido, normalizar_tipo, estado_resultado, autocompletado)
+from utils.gemini_client import analizar_imagen_async, buscar_por_texto_async
+from utils.image_search import obtener_imagen_especie_async
+from utils.sound_search import buscar_sonido_async
+from utils.http_async import cerrar_cliente_http
+from utils.subida import ErrorSubida, validar_archivo
+from utils.trazas import CABECERA_FORZAR, debe_trazar, iniciar_traza, terminar_traza, traza_forzada
+
+
+def trazado(handler):
+    """Igual que en Flask: traza la petición (si toca) y agrega Server-Timing."""
+    async def envoltura(request):
+        if not debe_trazar(traza_forzada(request.headers.get(CABECERA_FORZAR), flask_app.debug)):
+            return await handler(request)
+        iniciar_traza(request.url.path, request.method)
+        estado = 500
+        try:
+            response = await handler(request)
+            estado = response.status_code
+        finally:
+            traza = terminar_traza(estado)
+        response.headers['Server-Timing'] = traza.server_timing()
+        return response
+    return envoltura
+
+
+async def leer_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+DEMASIADO_GRANDE = '¡Ups! La imagen es demasiado grande (máximo 16 MB).'
+
+
+def con_limite(request, limite: int) -> Request:
+    """
+    La misma petición, pero su cuerpo se corta al pasar `limite` bytes.
+    Content-Length solo no basta: una subida chunked no lo trae.
+    """
+    recibidos = 0
+
+    async def recibir():
+        nonlocal recibidos
+        mensaje = await request.receive()
+        if mensaje['type'] == 'http.request':
+            recibidos += len(mensaje.get('body', b''))
+            if recibidos > limite:
+                raise ErrorSubida(DEMASIADO_GRANDE, 413)
+        return mensaje
+
+    return Request(request.scope, recibir)
+
+
+async def analizar(request):
+    """Versión async de /analizar."""
+    try:
+        limite = flask_app.config['MAX_CONTENT_LENGTH']
+        try:
+            largo = int(request.headers.get('content-length', 0))
+        except ValueError:
+            return JSONResponse({'error': 'Cabecera Content-Length inválida'}, 400)
+        if largo > limite:
+            return JSONResponse({'error': DEMASIADO_GRANDE}, 413)
+
+        form = await con_limite(request, limite).form()
+        file = form.get('imagen')
+        error = validar_imagen(getattr(file, 'filename', None) if file else None)
+        if error:
+            return JSONResponse(*error)
+
+        tipo = normalizar_tipo(form.get('tipo', 'insecto'))
+        # Starlette ya dejó el archivo en un SpooledTemporaryFile; solo se lee la cabecera
+        await run_in_threadpool(validar_archivo, file.file)
+
+        resultado = await analizar_imagen_async(file.file, tipo)
+        if 'error' in resultado:
+            return JSONResponse(resultado, estado_resultado(resultado))
+        autocompletado.aprender(resultado.get('nombre'), resultado.get('cientifico'), tipo)
+
+        resultado['imagen_url'] = await obtener_imagen_especie_async(
+            resultado.get('cientifico', ''),
+            resultado.get('nombre', ''),
+            tipo
+        )
+        return JSONResponse(resultado)
+    except ErrorSubida as e:
+        return JSONResponse({'error': e.mensaje}, e.codigo)
+    except Exception as e:
+        return JSONResponse({'error': f'¡Algo salió mal! {str(e)}'}, 500)
+
+
+async def buscar(request):
+    """Versión async de /buscar."""
+    try:
+        valores, error = validar_busqueda(await leer_json(request))
+        if error:
+            return JSONResponse(*error)
+        consulta, tipo = valores
+
+        resultado = await buscar_por_texto_async(consulta, tipo)
+        if 'error' in resultado:
+            return JSONResponse(resultado, estado_resultado(resultado))
+        autocompletado.aprender(resultado.get('nombre'), resultado.get('cientifico'), tipo)
+
+        resultado['imagen_url'] = await obtener_imagen_especie_async(
+            resultado.get('cientifico', ''),
+            resultado.get('nombre', ''),
+            tipo
+        )
+        return JSONResponse(resultado)
+    except Exception as e:
+        return JSONResponse({'error': f'¡Algo salió mal! {str(e)}'}, 500)
+
+
+async def sonido(request):
+    """Versión async de /sonido."""
+    try:
+        valores, error = validar_sonido(await leer_json(request))
+        if error:
+            return JSONResponse(*error)
+        return JSONResponse(respuesta_sonido(await buscar_sonido_async(*valores)))
+    except Exception as e:
+        return JSONResponse({'error': f'Error buscando sonido: {str(e)}'}, 500)
+
+
+@asynccontextmanager
+async def ciclo_de_vida(app):
+    yield
+    await cerrar_cliente_http()
+
+
+app = Starlette(
+    routes=[
+        Route('/analizar', trazado(analizar), methods=['POST']),
+        Route('/buscar', trazado(buscar), methods=['POST']),
+        Route('/sonido', trazado(sonido), methods=['POST']),
+        Mount('/', app=WsgiToAsgi(flask_app)),
+    ],
+    lifespan=ciclo_de_vida,
+)
@@ -0,0 +1,89 @@
+"""
+Benchmark de arranque en frío de un worker.
+Cada medición corre en un proceso nuevo e informa:
+  - tiempo de `import app`
+  - latencia de la primera petición (por defecto /salud)
+  - memoria residente (RSS) del worker después de esa petición
+
+Uso:
+    python benchmarks/arranque.py --repeticiones 5 --ruta /salud
+    python benchmarks/arranque.py --con-gemini   # fuerza la carga del SDK para comparar
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HIJO = r'''
+import json, os, resource, sys, time
+sys.path.insert(0, {raiz!r})
+inicio = time.perf_counter()
+import app as modulo
+importar = time.perf_counter() - inicio
+if {con_gemini!r}:
+    from utils.gemini_client import cargar_genai
+    cargar_genai()
+    importar = time.perf_counter() - inicio
+modulo.inicializar_base_de_datos()
+cliente = modulo.app.test_client()
+inicio = time.perf_counter()
+respuesta = cliente.get({ruta!r})
+primera = time.perf_counter() - inicio
+rss_kb = None
+try:
+    with open('/proc/self/status') as f:
+        for linea in f:
+            if linea.startswith('VmRSS:'):
+                rss_kb = int(linea.split()[1])
+except OSError:
+    # macOS reporta ru_maxrss en bytes, Linux en KB
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+print(json.dumps({{'importar': importar, 'primera': primera, 'rss_kb': rss_kb, 'estado': respuesta.status_code}}))
+'''
+
+
+def medir(ruta, con_gemini):
+    with tempfile.TemporaryDirectory() as carpeta:
+        entorno = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(carpeta, 'bench.db')}",
+                       PYTHONWARNINGS='ignore')
+        salida = subprocess.run(
+            [sys.executable, '-c', HIJO.format(raiz=RAIZ, ruta=ruta, con_gemini=con_gemini)],
+            capture_output=True, text=True, env=entorno, cwd=carpeta, check=True
+        )
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--ruta', default='/salud')
+    parser.add_argument('--con-gemini', action='store_true', help='importar también google.generativeai')
+    parser.add_argument('--json', action='store_true', help='imprimir el resultado como JSON')
+    args = parser.parse_args()
+
+    muestras = [medir(args.ruta, args.con_gemini) for _ in range(args.repeticiones)]
+    resultado = {
+        'ruta': args.ruta,
+        'con_gemini': args.con_gemini,
+        'importar_ms': statistics.median(m['importar'] for m in muestras) * 1000,
+        'primera_peticion_ms': statistics.median(m['primera'] for m in muestras) * 1000,
+        'rss_mb': statistics.median(m['rss_kb'] for m in muestras) / 1024,
+    }
+
+    if args.json:
+        print(json.dumps(resultado))
+        return
+    print(f"Ruta {args.ruta}  ·  {args.repeticiones} procesos  ·  SDK Gemini: {'sí' if args.con_gemini else 'no'}")
+    print(f"  import app          {resultado['importar_ms']:8.1f} ms")
+    print(f"  primera petición    {resultado['primera_peticion_ms']:8.1f} ms")
+    print(f"  RSS del worker      {resultado['rss_mb']:8.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark de throughput en tráfico I/O: modo síncrono (gunicorn, workers sync)
+contra modo asíncrono (uvicorn + asgi.py), con el mismo número de procesos.
+
+El servidor simulado (utils/upstream_simulado.py) reproduce la grabación de
+Xeno-Canto con una latencia fija, así que la prueba no depende de la red.
+Se dispara /sonido (tipo ave) con N peticiones concurrentes y se reporta
+peticiones/s y latencias p50/p95.
+
+Requiere requirements-async.txt. Uso:
+    python benchmarks/async_vs_sync.py --workers 2 --concurrencia 200 --peticiones 1000 --latencia-ms 200
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_puerto(puerto):
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', puerto), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+
+def iniciar_upstream(latencia):
+    """Servidor simulado (utils/upstream_simulado.py) en su propio proceso, reproduciendo data/grabaciones."""
+    puerto = puerto_libre()
+    proceso = subprocess.Popen([sys.executable, '-m', 'utils.upstream_simulado', '--puerto', str(puerto),
+                                '--latencia-ms', str(latencia * 1000)],
+                               cwd=RAIZ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    esperar_puerto(puerto)
+    return proceso, f'http://127.0.0.1:{puerto}'
+
+
+def iniciar_servidor(modo, workers, upstream, carpeta):
+    puerto = puerto_libre()
+    entorno = {k: v for k, v in os.environ.items()
+               if k not in ('XENO_CANTO_API', 'WIKIMEDIA_API', 'WIKIPEDIA_EN', 'WIKIPEDIA_ES')}
+    entorno.update(NATURIA_UPSTREAM_SIMULADO=upstream, PYTHONWARNINGS='ignore',
+                   DATABASE_URL=f"sqlite:///{os.path.join(carpeta, f'{modo}.db')}")
+    if modo == 'sync':
+        comando = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{puerto}',
+                   '--backlog', '2048', '--timeout', '120', 'app:app']
+    else:
+        comando = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(workers),
+                   '--port', str(puerto), '--backlog', '2048', '--log-level', 'warning']
+    proceso = subprocess.Popen(comando, cwd=RAIZ, env=entorno,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{puerto}'
+    for _ in range(100):
+        try:
+            if httpx.get(f'{url}/salud', timeout=1).status_code == 200:
+                return proceso, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proceso.terminate()
+    raise RuntimeError(f'El servidor {modo} no arrancó')
+
+
+async def cargar(url, peticiones, concurrencia):
+    cuerpo = {'nombre': 'chincol', 'cientifico': 'Zonotrichia capensis', 'tipo': 'ave'}
+    latencias, errores = [], 0
+    semaforo = asyncio.Semaphore(concurrencia)
+    limites = httpx.Limits(max_connections=concurrencia, max_keepalive_connections=concurrencia)
+
+    async with httpx.AsyncClient(limits=limites, timeout=120) as cliente:
+        async def una():
+            nonlocal errores
+            async with semaforo:
+                inicio = time.perf_counter()
+                try:
+                    r = await cliente.post(f'{url}/sonido', json=cuerpo)
+                    if r.status_code != 200 or not r.json().get('encontrado'):
+                        errores += 1
+                        return
+                    latencias.append(time.perf_counter() - inicio)
+                except httpx.HTTPError:
+                    errores += 1
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(una() for _ in range(peticiones)))
+        duracion = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        'peticiones_por_segundo': len(latencias) / duracion,
+        'p50_ms': statistics.median(latencias) * 1000 if latencias else 0,
+        'p95_ms': latencias[int(len(latencias) * 0.95) - 1] * 1000 if latencias else 0,
+        'errores': errores,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrencia', type=int, default=200)
+    parser.add_argument('--peticiones', type=int, default=1000)
+    parser.add_argument('--latencia-ms', type=int, default=200, help='latencia simulada de Xeno-Canto')
+    args = parser.parse_args()
+
+    upstream, upstream_url = iniciar_upstream(args.latencia_ms / 1000)
+    print(f"Workers: {args.workers}  ·  concurrencia: {args.concurrencia}  ·  "
+          f"peticiones: {args.peticiones}  ·  latencia upstream: {args.latencia_ms} ms")
+    print(f"{'modo':<8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errores':>10}")
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        for modo in ('sync', 'async'):
+            proceso, url = iniciar_servidor(modo, args.workers, upstream_url, carpeta)
+            try:
+                r = asyncio.run(cargar(url, args.peticiones, args.concurrencia))
+            finally:
+                proceso.terminate()
+                proceso.wait()
+            print(f"{modo:<8}{r['peticiones_por_segundo']:>10.1f}{r['p50_ms']:>10.0f}"
+                  f"{r['p95_ms']:>10.0f}{r['errores']:>10}")
+    upstream.terminate()
+    upstream.wait()
+
+
+if __name__ == '__main__':
+    main()
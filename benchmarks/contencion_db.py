@@ -0,0 +1,107 @@
+"""
+Benchmark de contención de escrituras en SQLite.
+Simula varios workers de gunicorn guardando descubrimientos a la vez
+(INSERT + UPDATE del contador del usuario, un commit por petición) y compara
+la configuración estándar (rollback journal) con la de utils/database.py (WAL).
+
+Uso:
+    python benchmarks/contencion_db.py --workers 4 --escrituras 300
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import aplicar_pragmas_sqlite
+
+
+def preparar(ruta):
+    conn = sqlite3.connect(ruta)
+    conn.executescript("""
+        CREATE TABLE user (id INTEGER PRIMARY KEY, total_puntos INTEGER, total_descubrimientos INTEGER);
+        CREATE TABLE discovery (id INTEGER PRIMARY KEY, user_id INTEGER, nombre_especie TEXT,
+                                puntos INTEGER, fecha TEXT);
+        CREATE INDEX ix_discovery_user_fecha ON discovery (user_id, fecha);
+    """)
+    conn.executemany("INSERT INTO user VALUES (?, 0, 0)", [(i,) for i in range(1, 101)])
+    conn.commit()
+    conn.close()
+
+
+def worker(ruta, ajustado, escrituras, semilla, resultados):
+    # Timeout estándar del driver (5 s), igual que Flask-SQLAlchemy sin configurar
+    conn = sqlite3.connect(ruta, timeout=5.0, isolation_level=None)
+    if ajustado:
+        aplicar_pragmas_sqlite(conn, wal=True)
+    bloqueos = 0
+    latencias = []
+    for i in range(escrituras):
+        user_id = (semilla * 7 + i) % 100 + 1
+        inicio = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO discovery (user_id, nombre_especie, puntos, fecha) "
+                         "VALUES (?, 'Chinita', 10, datetime('now'))", (user_id,))
+            conn.execute("UPDATE user SET total_descubrimientos = total_descubrimientos + 1, "
+                         "total_puntos = total_puntos + 10 WHERE id = ?", (user_id,))
+            # Lectura típica de /perfil dentro de la misma petición
+            conn.execute("SELECT total_puntos FROM user WHERE id = ?", (user_id,)).fetchone()
+            conn.execute("COMMIT")
+            latencias.append(time.perf_counter() - inicio)
+        except sqlite3.OperationalError:
+            bloqueos += 1
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass
+    conn.close()
+    resultados.put((bloqueos, latencias))
+
+
+def ejecutar(ajustado, workers, escrituras):
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, 'bench.db')
+        preparar(ruta)
+        resultados = multiprocessing.Queue()
+        procesos = [multiprocessing.Process(target=worker, args=(ruta, ajustado, escrituras, n, resultados))
+                    for n in range(workers)]
+        inicio = time.perf_counter()
+        for p in procesos:
+            p.start()
+        salida = [resultados.get() for _ in procesos]
+        for p in procesos:
+            p.join()
+        duracion = time.perf_counter() - inicio
+
+    bloqueos = sum(b for b, _ in salida)
+    latencias = sorted(l for _, ls in salida for l in ls)
+    p95 = latencias[int(len(latencias) * 0.95) - 1] * 1000 if latencias else 0
+    return {
+        'commits': len(latencias),
+        'bloqueos': bloqueos,
+        'commits_por_segundo': len(latencias) / duracion,
+        'p95_ms': p95,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--escrituras', type=int, default=300, help='commits por worker')
+    args = parser.parse_args()
+
+    print(f"Workers: {args.workers}  ·  commits por worker: {args.escrituras}")
+    print(f"{'modo':<12}{'commits/s':>12}{'p95 ms':>10}{'bloqueos':>10}")
+    for nombre, ajustado in (('estándar', False), ('ajustado', True)):
+        r = ejecutar(ajustado, args.workers, args.escrituras)
+        print(f"{nombre:<12}{r['commits_por_segundo']:>12.0f}{r['p95_ms']:>10.2f}{r['bloqueos']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Suite de benchmarks de las rutas calientes de Python.
+
+Micro: parseo de la respuesta de Gemini (con ```json```), armado de prompts,
+resolución de nombres de aves e insectos para los sonidos, lectura de
+cabecera y decodificación de la imagen de /analizar.
+Macro: latencia de rutas completas con el cliente de pruebas de Flask.
+Gemini se reemplaza por una respuesta fija y Wikipedia/Xeno-Canto por el
+servidor simulado (utils/upstream_simulado.py) sin latencia.
+
+Los resultados (mediana y mínimo por llamada) se escriben en JSON y se comparan
+con la línea base guardada; una mediana más lenta que la base por encima de
+la tolerancia se marca como regresión y el proceso termina con código 1.
+
+Uso:
+    python benchmarks/suite.py                        # correr y comparar con la línea base
+    python benchmarks/suite.py --filtro macro         # solo algunos casos
+    python benchmarks/suite.py --guardar-linea-base   # fijar la línea base (en la máquina de referencia)
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+LINEA_BASE = os.path.join(RAIZ, 'benchmarks', 'linea_base.json')
+RESULTADOS = os.path.join(RAIZ, 'benchmarks', 'resultados.json')
+
+RESPUESTA_GEMINI = '```json\n' + json.dumps({
+    'nombre': 'Chincol',
+    'cientifico': 'Zonotrichia capensis',
+    'descripcion': 'Un pajarito muy común en Chile que canta desde muy temprano. '
+                   'Tiene un copete y un collar color canela.',
+    'habitat': 'Ciudades, parques y campos de casi todo Chile',
+    'peligrosidad': 'Baja',
+    'estado_conservacion': 'Preocupación Menor',
+    'dato_curioso': 'Su canto cambia según la región, ¡como si tuviera acento!',
+    'puntos': 15
+}, ensure_ascii=False, indent=4) + '\n```'
+
+CASOS = []
+
+
+def caso(nombre):
+    """Registra una función que prepara el caso y retorna lo que se mide."""
+    def registrar(preparar):
+        CASOS.append((nombre, preparar))
+        return preparar
+    return registrar
+
+
+def imagen_jpeg(ancho, alto):
+    from PIL import Image
+    salida = io.BytesIO()
+    Image.new('RGB', (ancho, alto), (46, 139, 87)).save(salida, format='JPEG', quality=90)
+    return salida.getvalue()
+
+
+# ---------- Micro ----------
+
+@caso('micro.parsear_respuesta_gemini')
+def _():
+    from utils.gemini_client import parsear_respuesta
+    return lambda: parsear_respuesta(RESPUESTA_GEMINI)
+
+
+@caso('micro.obtener_prompt')
+def _():
+    from utils.gemini_client import obtener_prompt
+    return lambda: [obtener_prompt(tipo) for tipo in ('insecto', 'planta', 'ave', 'animal')]
+
+
+@caso('micro.obtener_instrucciones_busqueda')
+def _():
+    from utils.gemini_client import obtener_instrucciones_busqueda
+    return lambda: [obtener_instrucciones_busqueda(tipo) for tipo in ('insecto', 'planta', 'ave', 'animal')]
+
+
+@caso('micro.resolver_nombre_ave')
+def _():
+    from utils.sound_search import resolver_cientifico_ave
+    # Exacto, coincidencia parcial y sin coincidencia (recorre todo AVES_CHILE)
+    return lambda: [resolver_cientifico_ave(n) for n in ('chincol', 'un zorzal en el árbol', 'pájaro desconocido')]
+
+
+@caso('micro.resolver_sonido_insecto')
+def _():
+    from utils.sound_search import buscar_sonido_insecto
+    return lambda: [buscar_sonido_insecto(n) for n in ('grillo común', 'insecto desconocido')]
+
+
+@caso('micro.cabecera_imagen')
+def _():
+    from utils.subida import leer_cabecera
+    datos = imagen_jpeg(4000, 3000)
+    return lambda: leer_cabecera(datos)
+
+
+@caso('micro.decodificar_imagen_analizar')
+def _():
+    from utils.gemini_client import abrir_imagen
+    datos = imagen_jpeg(4000, 3000)
+    return lambda: abrir_imagen(datos).load()
+
+
+# ---------- Macro (rutas completas) ----------
+
+def cliente_flask():
+    import app as modulo
+    return modulo, modulo.app.test_client()
+
+
+def ruta(peticion):
+    """Verifica una vez que la ruta responde 200 (un error mediría otra cosa) y la retorna."""
+    respuesta = peticion()
+    if respuesta.status_code != 200:
+        raise RuntimeError(f'{respuesta.status_code}: {respuesta.get_data(as_text=True)[:200]}')
+    return peticion
+
+
+@caso('macro.analizar')
+def _():
+    _, cliente = cliente_flask()
+    datos = imagen_jpeg(1600, 1200)
+    return ruta(lambda: cliente.post('/analizar', content_type='multipart/form-data',
+                                     data={'imagen': (io.BytesIO(datos), 'foto.jpg'), 'tipo': 'ave'}))
+
+
+@caso('macro.buscar')
+def _():
+    _, cliente = cliente_flask()
+    return ruta(lambda: cliente.post('/buscar', json={'consulta': 'chincol', 'tipo': 'ave'}))
+
+
+@caso('macro.sonido_ave')
+def _():
+    _, cliente = cliente_flask()
+    return ruta(lambda: cliente.post('/sonido', json={'nombre': 'chincol', 'tipo': 'ave'}))
+
+
+@caso('macro.especies')
+def _():
+    _, cliente = cliente_flask()
+    return ruta(lambda: cliente.get('/especies', headers={'Accept-Encoding': 'gzip'}))
+
+
+@caso('macro.naturadex')
+def _():
+    modulo, cliente = cliente_flask()
+    with modulo.app.app_context():
+        modulo.db.drop_all()
+        modulo.db.create_all()
+    cliente.post('/registro', json={'nombre': 'Ana', 'apellido': 'Soto', 'correo': 'bench@example.com'})
+    cliente.post('/sincronizar_lote', json={'descubrimientos': [
+        {'clave': f'b{i}', 'nombre': 'Chinita', 'cientifico': 'Eriopis connexa', 'tipo': 'insecto', 'puntos': 10}
+        for i in range(200)
+    ]})
+    return ruta(lambda: cliente.get('/naturadex'))
+
+
+# ---------- Medición ----------
+
+def medir(funcion, rondas, tiempo_ronda):
+    """Tiempo por llamada (µs) en cada ronda, con iteraciones calibradas a tiempo_ronda."""
+    def cronometrar(iteraciones):
+        inicio = time.perf_counter()
+        for _ in range(iteraciones):
+            funcion()
+        return time.perf_counter() - inicio
+
+    funcion()  # Calentamiento
+    iteraciones = 1
+    while True:
+        duracion = cronometrar(iteraciones)
+        if duracion >= tiempo_ronda or iteraciones >= 1_000_000:
+            break
+        iteraciones = max(iteraciones * 2, int(iteraciones * tiempo_ronda / max(duracion, 1e-9)))
+
+    muestras = [cronometrar(iteraciones) / iteraciones * 1e6 for _ in range(rondas)]
+    return {
+        'mediana_us': round(statistics.median(muestras), 3),
+        'minimo_us': round(min(muestras), 3),
+        'iteraciones': iteraciones,
+        'rondas': rondas,
+    }
+
+
+def comparar(resultados, linea_base):
+    """Lista de (caso, base, actual, cambio relativo) para los casos presentes en ambos."""
+    filas = []
+    for nombre, actual in resultados.items():
+        base = linea_base.get(nombre)
+        if base:
+            cambio = actual['mediana_us'] / base['mediana_us'] - 1
+            filas.append((nombre, base['mediana_us'], actual['mediana_us'], cambio))
+    return filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filtro', default='', help='solo casos cuyo nombre contenga este texto')
+    parser.add_argument('--rondas', type=int, default=7)
+    parser.add_argument('--tiempo-ronda', type=float, default=0.2, help='segundos por ronda')
+    parser.add_argument('--tolerancia', type=float, default=0.25, help='empeoramiento permitido (0.25 = 25%%)')
+    parser.add_argument('--salida', default=RESULTADOS)
+    parser.add_argument('--linea-base', default=LINEA_BASE)
+    parser.add_argument('--guardar-linea-base', action='store_true')
+    args = parser.parse_args()
+
+    from utils.upstream_simulado import servidor_simulado
+
+    with tempfile.TemporaryDirectory() as carpeta, servidor_simulado() as upstream:
+        # Antes de importar la app: base temporal, servicios simulados y sin trazas
+        os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(carpeta, 'bench.db')}",
+                          NATURIA_UPSTREAM_SIMULADO=upstream, TRAZAS_MUESTREO='0')
+        for variable in ('XENO_CANTO_API', 'WIKIMEDIA_API', 'WIKIPEDIA_EN', 'WIKIPEDIA_ES'):
+            os.environ.pop(variable, None)
+        import app as modulo
+        modulo.inicializar_base_de_datos()
+
+        gemini = [patch('utils.gemini_client.configure_gemini', return_value=True),
+                  patch('utils.gemini_client.intentar_con_modelo', return_value=(True, RESPUESTA_GEMINI)),
+                  patch('utils.gemini_client.intentar_busqueda_con_modelo', return_value=(True, RESPUESTA_GEMINI))]
+        for parche in gemini:
+            parche.start()
+
+        resultados = {}
+        print(f"{'caso':<36}{'mediana':>14}{'mínimo':>14}")
+        for nombre, preparar in CASOS:
+            if args.filtro not in nombre:
+                continue
+            resultados[nombre] = medir(preparar(), args.rondas, args.tiempo_ronda)
+            r = resultados[nombre]
+            print(f"{nombre:<36}{r['mediana_us']:>11.1f} µs{r['minimo_us']:>11.1f} µs")
+
+        for parche in gemini:
+            parche.stop()
+
+    documento = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'resultados': resultados,
+    }
+    destino = args.linea_base if args.guardar_linea_base else args.salida
+    with open(destino, 'w', encoding='utf-8') as f:
+        json.dump(documento, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados en {os.path.relpath(destino, RAIZ)}")
+    if args.guardar_linea_base:
+        return
+
+    try:
+        with open(args.linea_base, encoding='utf-8') as f:
+            linea_base = json.load(f)['resultados']
+    except FileNotFoundError:
+        print("Sin línea base: guarda una con --guardar-linea-base")
+        return
+
+    regresiones = 0
+    print(f"\n{'caso':<36}{'base':>12}{'actual':>12}{'cambio':>10}")
+    for nombre, base, actual, cambio in comparar(resultados, linea_base):
+        marca = '  ⚠️  REGRESIÓN' if cambio > args.tolerancia else ''
+        regresiones += bool(marca)
+        print(f"{nombre:<36}{base:>12.1f}{actual:>12.1f}{cambio:>+9.0%}{marca}")
+    if regresiones:
+        print(f"\n{regresiones} regresión(es) sobre la tolerancia de {args.tolerancia:.0%}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
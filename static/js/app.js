@@ -48,6 +48,7 @@ const elements = {
     // Búsqueda
     searchZone: document.getElementById('search-zone'),
     searchInput: document.getElementById('search-input'),
+    searchSuggestions: document.getElementById('search-suggestions'),
     searchBtn: document.getElementById('search-btn'),
     voiceBtn: document.getElementById('voice-btn'),
     voiceIcon: document.getElementById('voice-icon'),
@@ -201,7 +202,8 @@ function init() {
     setupAuthListeners();
     loadHistory();
     loadPoints();
-    checkSession();
+    checkSession().then(syncPendingDiscoveries);
+    window.addEventListener('online', syncPendingDiscoveries);
     
     // Insertar mapa SVG
     if (elements.chileMap) {
@@ -404,6 +406,45 @@ function setupSearchZone() {
     });
     
     elements.voiceBtn.addEventListener('click', toggleVoiceRecognition);
+    
+    // Sugerencias de especies conocidas mientras se escribe
+    let temporizador = null;
+    elements.searchInput.addEventListener('input', () => {
+        clearTimeout(temporizador);
+        temporizador = setTimeout(() => updateSuggestions(elements.searchInput.value), 150);
+    });
+}
+
+async function fetchSuggestions(query) {
+    const params = new URLSearchParams({ q: query, tipo: state.selectedType, limite: 8 });
+    const response = await fetch(`/autocompletar?${params}`);
+    if (!response.ok) return [];
+    return (await response.json()).sugerencias;
+}
+
+async function updateSuggestions(query) {
+    if (!elements.searchSuggestions || query.trim().length < 2) return;
+    try {
+        const sugerencias = await fetchSuggestions(query.trim());
+        elements.searchSuggestions.replaceChildren(...sugerencias.map(s => {
+            const opcion = document.createElement('option');
+            opcion.value = s.nombre;
+            if (s.cientifico) opcion.label = s.cientifico;
+            return opcion;
+        }));
+    } catch (error) {
+        // Sin sugerencias no pasa nada: la búsqueda sigue funcionando
+    }
+}
+
+// Lo dictado por voz suele venir incompleto o mal escrito: se cambia por la especie conocida más parecida
+async function bestSuggestion(query) {
+    try {
+        const [primera] = await fetchSuggestions(query);
+        return primera ? primera.nombre : query;
+    } catch (error) {
+        return query;
+    }
 }
 
 // ========================================
@@ -439,10 +480,13 @@ function setupVoiceRecognition() {
         elements.searchInput.value = transcript;
         
         if (event.results[0].isFinal) {
-            elements.voiceStatus.textContent = `✅ Entendí: "${transcript}"`;
-            setTimeout(() => {
-                performTextSearch();
-            }, 500);
+            bestSuggestion(transcript).then(nombre => {
+                elements.searchInput.value = nombre;
+                elements.voiceStatus.textContent = `✅ Entendí: "${nombre}"`;
+                setTimeout(() => {
+                    performTextSearch();
+                }, 500);
+            });
         }
     };
     
@@ -1258,18 +1302,43 @@ function animateTotalValue(start, end) {
     }, stepTime);
 }
 
+function generateDiscoveryKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+}
+
+function getPendingDiscoveries() {
+    try {
+        return JSON.parse(localStorage.getItem('naturia-pendientes')) || [];
+    } catch (error) {
+        return [];
+    }
+}
+
+function queuePendingDiscovery(discovery) {
+    const pending = getPendingDiscoveries();
+    pending.push(discovery);
+    localStorage.setItem('naturia-pendientes', JSON.stringify(pending));
+}
+
 async function saveDiscoveryToServer(data) {
+    const discovery = {
+        clave: generateDiscoveryKey(),
+        nombre: data.nombre,
+        cientifico: data.cientifico,
+        tipo: data.tipo,
+        imagen_url: data.imagen_url,
+        puntos: data.puntos,
+        fecha: new Date().toISOString().slice(0, 19)
+    };
+    
     try {
         const response = await fetch('/guardar_descubrimiento', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                nombre: data.nombre,
-                cientifico: data.cientifico,
-                tipo: data.tipo,
-                imagen_url: data.imagen_url,
-                puntos: data.puntos
-            })
+            body: JSON.stringify(discovery)
         });
         
         const result = await response.json();
@@ -1277,9 +1346,36 @@ async function saveDiscoveryToServer(data) {
             console.log('Descubrimiento guardado:', result.mensaje);
             state.user.descubrimientos_count = result.descubrimientos_count;
             updateAuthUI();
+        } else if (result.offline) {
+            queuePendingDiscovery(discovery);
+        }
+    } catch (error) {
+        // Sin conexión: se guarda para sincronizar en lote al reconectar
+        queuePendingDiscovery(discovery);
+    }
+}
+
+async function syncPendingDiscoveries() {
+    const pending = getPendingDiscoveries();
+    if (!state.isLoggedIn || pending.length === 0) return;
+    
+    try {
+        const response = await fetch('/sincronizar_lote', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ descubrimientos: pending, puntos: state.totalPoints })
+        });
+        
+        const result = await response.json();
+        if (result.success) {
+            // Conservar lo que se haya encolado mientras la petición estaba en curso
+            const remaining = getPendingDiscoveries().slice(pending.length);
+            localStorage.setItem('naturia-pendientes', JSON.stringify(remaining));
+            state.user.descubrimientos_count = result.descubrimientos_count;
+            updateAuthUI();
         }
     } catch (error) {
-        console.error('Error saving discovery:', error);
+        console.error('Error syncing pending discoveries:', error);
     }
 }
 
@@ -1506,6 +1602,7 @@ function handleLoginSuccess(result) {
     
     alert(result.mensaje);
     elements.userModal.classList.remove('active');
+    syncPendingDiscoveries();
 }
 
 function updateAuthUI() {
@@ -47,7 +47,7 @@ self.addEventListener('activate', (event) => {
     );
 });
 
-// Estrategia de caché: Network First con fallback a caché
+// Estrategia de caché: solo recursos estáticos, navegación y el aviso offline de /analizar y /buscar
 self.addEventListener('fetch', (event) => {
     const { request } = event;
     const url = new URL(request.url);
@@ -181,11 +181,9 @@ self.addEventListener('fetch', (event) => {
         return;
     }
     
-    // Para todo lo demás, intentar red y luego caché
-    event.respondWith(
-        fetch(request)
-            .catch(() => caches.match(request))
-    );
+    // Todo lo demás (la API: /perfil, /ranking, /naturadex...) no pasa por el
+    // service worker: sin conexión falla como siempre y la app muestra su error,
+    // en vez de recibir una respuesta vacía desde la caché
 });
 
 // Escuchar mensajes del cliente
@@ -1,8 +1,22 @@
+import os
 import pytest
-from app import app, db, User
+
+# El motor se crea al importar app, así que la base en memoria se fija antes
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+# La base en memoria es distinta en cada hilo: los puntos se escriben al llegar,
+# sin el hilo de escritura diferida (que se prueba aparte)
+os.environ['PUNTOS_FLUSH_MS'] = '0'
+
+from app import app, db, User, _usuarios_cache, ranking
+from utils import enriquecimiento
 from unittest.mock import patch
 import json
+from datetime import datetime
+import gzip
 import io
+import sys
+import threading
+import time
 
 @pytest.fixture
 def client():
@@ -10,9 +24,37 @@ def client():
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
     with app.test_client() as client:
         with app.app_context():
+            db.drop_all()
             db.create_all()
+        _usuarios_cache.clear()
+        for cache in enriquecimiento.CACHES:
+            cache.limpiar()
+        # Tablas vacías y recién reconstruidas: la reconstrucción de fondo no corre sola
+        ranking.reemplazar({})
+        ranking._ultima_reconstruccion = time.time()
         yield client
 
+def registrar(client, correo='explorador@example.com', puntos=0):
+    """Registra (e inicia sesión) un usuario de prueba."""
+    return client.post('/registro',
+                       data=json.dumps({'nombre': 'Ana', 'apellido': 'Soto',
+                                        'correo': correo, 'puntos': puntos}),
+                       content_type='application/json')
+
+def guardar(client, nombre='Chinita', tipo='insecto', puntos=10):
+    """Guarda un descubrimiento para el usuario con sesión activa."""
+    return client.post('/guardar_descubrimiento',
+                       data=json.dumps({'nombre': nombre, 'cientifico': f'{nombre} sp.',
+                                        'tipo': tipo, 'puntos': puntos}),
+                       content_type='application/json')
+
+def imagen(formato='JPEG', tamano=(32, 24)):
+    """Imagen real pequeña, en bytes."""
+    from PIL import Image
+    salida = io.BytesIO()
+    Image.new('RGB', tamano, (46, 139, 87)).save(salida, format=formato)
+    return salida.getvalue()
+
 def test_health_check(client):
     """Test the health check endpoint."""
     response = client.get('/salud')
@@ -37,7 +79,7 @@ def test_analizar_endpoint(mock_image_search, mock_analizar, client):
     mock_image_search.return_value = "http://example.com/chinita.jpg"
 
     data = {
-        'imagen': (io.BytesIO(b"fake image data"), 'test.jpg'),
+        'imagen': (io.BytesIO(imagen()), 'test.jpg'),
         'tipo': 'insecto'
     }
     response = client.post('/analizar', data=data, content_type='multipart/form-data')
@@ -48,6 +90,29 @@ def test_analizar_endpoint(mock_image_search, mock_analizar, client):
     assert res_data['estado_conservacion'] == "Preocupación Menor"
     assert res_data['imagen_url'] == "http://example.com/chinita.jpg"
 
+def test_cabecera_de_imagen_sin_decodificar():
+    """Format and size come from the first bytes; non-images are rejected."""
+    from utils.subida import leer_cabecera, ErrorSubida
+    for formato, nombre in (('JPEG', 'jpeg'), ('PNG', 'png'), ('GIF', 'gif'), ('WEBP', 'webp')):
+        assert leer_cabecera(imagen(formato, (640, 480))) == (nombre, 640, 480)
+    assert leer_cabecera(imagen('JPEG')[:8]) is None  # Faltan bytes
+    with pytest.raises(ErrorSubida):
+        leer_cabecera(b'<html><body>no soy una imagen</body></html>')
+
+@patch('app.analizar_imagen')
+def test_analizar_rechaza_subidas_invalidas(mock_analizar, client):
+    """Fake images and decompression bombs are rejected before Gemini is called."""
+    falsa = client.post('/analizar', content_type='multipart/form-data',
+                        data={'imagen': (io.BytesIO(b'fake image data' * 100), 'test.jpg')})
+    assert falsa.status_code == 400 and 'no parece una imagen' in falsa.get_json()['error']
+
+    # Cabecera PNG que declara 50000x50000 píxeles, seguida de 4 MB de relleno
+    bomba = b'\x89PNG\r\n\x1a\n' + b'\x00\x00\x00\rIHDR' + (50000).to_bytes(4, 'big') * 2 + b'\x00' * (4 * 1024 * 1024)
+    respuesta = client.post('/analizar', content_type='multipart/form-data',
+                            data={'imagen': (io.BytesIO(bomba), 'bomba.png')})
+    assert respuesta.status_code == 413 and 'megapíxeles' in respuesta.get_json()['error']
+    mock_analizar.assert_not_called()
+
 @patch('app.buscar_por_texto')
 @patch('app.obtener_imagen_especie')
 def test_buscar_endpoint(mock_image_search, mock_buscar, client):
@@ -73,3 +138,1060 @@ def test_buscar_endpoint(mock_image_search, mock_buscar, client):
     assert res_data['nombre'] == "Copihue"
     assert res_data['estado_conservacion'] == "Vulnerable"
     assert res_data['imagen_url'] == "http://example.com/copihue.jpg"
+
+def test_naturadex_paginacion_por_cursor(client):
+    """The Naturadex lists discoveries newest first with keyset pagination."""
+    registrar(client)
+    for i in range(5):
+        guardar(client, nombre=f'Especie {i}', tipo='planta' if i % 2 else 'insecto')
+
+    response = client.get('/naturadex?limite=2')
+    data = json.loads(response.data)
+    assert response.status_code == 200
+    assert [d['nombre'] for d in data['descubrimientos']] == ['Especie 4', 'Especie 3']
+    assert data['total'] == 5
+
+    vistos = [d['id'] for d in data['descubrimientos']]
+    while data['siguiente_cursor']:
+        data = json.loads(client.get(f"/naturadex?limite=2&cursor={data['siguiente_cursor']}").data)
+        vistos += [d['id'] for d in data['descubrimientos']]
+    assert len(vistos) == len(set(vistos)) == 5
+
+    plantas = json.loads(client.get('/naturadex?tipo=planta').data)
+    assert {d['tipo'] for d in plantas['descubrimientos']} == {'planta'}
+    assert len(plantas['descubrimientos']) == 2
+
+    assert client.get('/naturadex?cursor=basura').status_code == 400
+
+def test_contador_descubrimientos_en_perfil(client):
+    """The discovery counter is maintained incrementally on save."""
+    registrar(client)
+    response = guardar(client)
+    assert json.loads(response.data)['descubrimientos_count'] == 1
+    guardar(client)
+    perfil = json.loads(client.get('/perfil').data)
+    assert perfil['descubrimientos_count'] == 2
+
+def test_sincronizar_lote_idempotente(client):
+    """Replaying an offline batch never duplicates discoveries."""
+    registrar(client)
+    lote = {
+        'puntos': 70,
+        'descubrimientos': [
+            {'clave': 'a1', 'nombre': 'Copihue', 'cientifico': 'Lapageria rosea', 'tipo': 'planta', 'puntos': 40},
+            {'clave': 'a2', 'nombre': 'Chincol', 'cientifico': 'Zonotrichia capensis', 'tipo': 'ave', 'puntos': 30,
+             'fecha': '2026-01-15T10:30:00'},
+        ]
+    }
+    response = client.post('/sincronizar_lote', data=json.dumps(lote), content_type='application/json')
+    data = json.loads(response.data)
+    assert response.status_code == 200
+    assert data['insertados'] == 2
+    assert data['puntos'] == 70
+
+    response = client.post('/sincronizar_lote', data=json.dumps(lote), content_type='application/json')
+    data = json.loads(response.data)
+    assert data['insertados'] == 0
+    assert data['duplicados'] == 2
+    assert data['descubrimientos_count'] == 2
+
+    sin_clave = {'descubrimientos': [{'nombre': 'X', 'cientifico': 'X', 'tipo': 'ave'}]}
+    response = client.post('/sincronizar_lote', data=json.dumps(sin_clave), content_type='application/json')
+    assert response.status_code == 400
+
+    # Datos mal formados se rechazan con 400 y sin guardar nada
+    valido = {'clave': 'b1', 'nombre': 'Queltehue', 'cientifico': 'Vanellus chilensis', 'tipo': 'ave'}
+    for malo in ([lote], {'descubrimientos': ['a1']}, {'descubrimientos': [{**valido, 'puntos': 'muchos'}]},
+                 {'descubrimientos': [valido], 'puntos': 'muchos'}, {'descubrimientos': [valido], 'puntos': [1]}):
+        response = client.post('/sincronizar_lote', json=malo)
+        assert response.status_code == 400 and 'error' in response.get_json()
+    for clave in ({'a': 1}, ['a1'], 'x' * 65, '   '):
+        malo = {'descubrimientos': [{**valido, 'clave': clave}]}
+        assert client.post('/sincronizar_lote', json=malo).status_code == 400
+    assert client.get('/perfil').get_json()['descubrimientos_count'] == 2
+
+def test_guardar_descubrimiento_idempotente(client):
+    """Resending a single save with the same key answers 'duplicado' instead of failing; bad keys get 400."""
+    registrar(client)
+    descubrimiento = {'nombre': 'Chinita', 'cientifico': 'Eriopis connexa', 'tipo': 'insecto',
+                      'puntos': 10, 'clave': 'c1', 'region': 'Valparaíso'}
+    assert client.post('/guardar_descubrimiento', json=descubrimiento).status_code == 201
+    response = client.post('/guardar_descubrimiento', json=descubrimiento)
+    assert response.status_code == 200 and response.get_json()['duplicado']
+    assert client.get('/perfil').get_json()['descubrimientos_count'] == 1
+
+    for clave in ({'a': 1}, ['c1'], 'x' * 65):
+        assert client.post('/guardar_descubrimiento', json={**descubrimiento, 'clave': clave}).status_code == 400
+    assert client.get('/perfil').get_json()['descubrimientos_count'] == 1
+
+def test_ranking_incremental():
+    """The in-memory ranking answers positions with shared ranks on ties."""
+    from utils.ranking import RankingMemoria
+    r = RankingMemoria()
+    r.fijar('global', 1, 50)
+    r.fijar('global', 2, 80)
+    r.fijar('global', 3, 50)
+    r.incrementar('global', 1, 40)
+    assert r.top('global', 2) == [(1, 90), (2, 80)]
+    assert r.posicion('global', 3) == (3, 50)
+    r.fijar('global', 3, 80)
+    assert r.posicion('global', 3) == (2, 80)
+    assert r.posicion('global', 99) is None
+
+def test_ranking_endpoint(client):
+    """The leaderboard reflects synced points and the user's own rank."""
+    registrar(client, correo='uno@example.com', puntos=30)
+    client.get('/logout')
+    registrar(client, correo='dos@example.com', puntos=10)
+    client.post('/sincronizar_puntos', data=json.dumps({'puntos': 120}), content_type='application/json')
+    guardar(client, puntos=25)
+
+    data = json.loads(client.get('/ranking').data)
+    assert [f['puntos'] for f in data['ranking']] == [120, 30]
+    assert data['mi_posicion'] == {'posicion': 1, 'puntos': 120}
+
+    semana = json.loads(client.get('/ranking?ventana=semana').data)
+    assert semana['mi_posicion'] == {'posicion': 1, 'puntos': 25}
+    assert client.get('/ranking?ventana=anio').status_code == 400
+
+def test_ranking_reconstruye_en_segundo_plano(client, monkeypatch):
+    """A due rebuild runs in a background thread; /ranking answers from the current tables meanwhile."""
+    import app as app_module
+    registrar(client, puntos=30)
+    liberar = threading.Event()
+    reconstrucciones = []
+    def reconstruir_lento():
+        reconstrucciones.append(threading.current_thread().name)
+        liberar.wait(5)
+
+    monkeypatch.setattr(app_module, 'reconstruir_ranking', reconstruir_lento)
+    monkeypatch.setattr(app_module.ranking, '_ultima_reconstruccion', 0)
+    try:
+        response = client.get('/ranking')
+        assert response.status_code == 200
+        assert [f['puntos'] for f in response.get_json()['ranking']] == [30]
+        # Reclamada de nuevo mientras sigue la anterior: no se lanza otra
+        app_module.ranking._ultima_reconstruccion = 0
+        assert client.get('/ranking').status_code == 200
+    finally:
+        liberar.set()
+    limite = time.time() + 5
+    while app_module._reconstruyendo_ranking.locked() and time.time() < limite:
+        time.sleep(0.01)
+    assert reconstrucciones == ['reconstruir-ranking']
+
+def test_opciones_motor():
+    """SQLite gets a driver timeout and WAL pragmas; Postgres gets pool settings."""
+    import sqlite3
+    from utils.database import normalizar_url, opciones_motor, aplicar_pragmas_sqlite
+    assert normalizar_url('postgres://u@h/db') == 'postgresql://u@h/db'
+    assert 'pool_size' in opciones_motor('postgresql://u@h/db')
+    assert 'pool_size' not in opciones_motor('sqlite:///naturia.db')
+
+    conn = sqlite3.connect(':memory:')
+    aplicar_pragmas_sqlite(conn, wal=True)
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    conn.close()
+
+def test_usuario_en_cache_evita_consultas(client):
+    """Repeated authenticated requests reuse the cached user and writes invalidate it."""
+    from sqlalchemy import event
+    registrar(client)
+    consultas = []
+    def contar(*args):
+        consultas.append(args[2])
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', contar)
+    try:
+        client.get('/perfil')
+        consultas.clear()
+        client.get('/perfil')
+        assert consultas == []
+
+        client.post('/sincronizar_puntos', data=json.dumps({'puntos': 55}), content_type='application/json')
+        perfil = json.loads(client.get('/perfil').data)
+        assert perfil['puntos'] == 55
+    finally:
+        event.remove(engine, 'before_cursor_execute', contar)
+
+def test_catalogo_especies_etag(client):
+    """The catalog is served pre-compressed and revalidates with ETags."""
+    response = client.get('/especies?tipo=planta')
+    data = json.loads(response.data)
+    assert response.status_code == 200
+    assert data['total'] > 0 and all(e['tipo'] == 'planta' for e in data['especies'])
+
+    etag = response.headers['ETag']
+    assert client.get('/especies?tipo=planta', headers={'If-None-Match': etag}).status_code == 304
+
+    comprimida = client.get('/especies', headers={'Accept-Encoding': 'gzip'})
+    assert comprimida.headers['Content-Encoding'] == 'gzip'
+    assert 'especies' in json.loads(gzip.decompress(comprimida.data))
+
+def test_especies_por_region(client):
+    """The region inverted index accepts names and slugs."""
+    por_slug = json.loads(client.get('/regiones/la-araucania/especies').data)
+    por_nombre = json.loads(client.get('/regiones/La Araucanía/especies').data)
+    assert por_slug == por_nombre
+    assert all('La Araucanía' in e['regiones'] for e in por_slug['especies'])
+    assert client.get('/regiones/atlantida/especies').status_code == 404
+
+    # El tipo se normaliza y uno desconocido no refleja la URL en la respuesta
+    plantas = json.loads(client.get('/regiones/la-araucania/especies?tipo=planta').data)
+    assert json.loads(client.get('/regiones/la-araucania/especies?tipo= Planta ').data) == plantas
+    inyectado = '<script>alert(1)</script>'
+    for url in (f'/regiones/LA-ARAUCANIA-{inyectado}/especies', f'/regiones/la-araucania/especies?tipo={inyectado}'):
+        respuesta = client.get(url)
+        assert inyectado not in respuesta.get_data(as_text=True)
+    desconocido = json.loads(client.get(f'/regiones/la-araucania"<>/especies?tipo={inyectado}').data)
+    assert desconocido == {'region': 'La Araucanía', 'slug': 'la-araucania', 'especies': [], 'total': 0}
+
+def test_catalogo_recarga_en_caliente(tmp_path):
+    """The catalog reloads the data file when it changes on disk."""
+    from utils.catalogo import CatalogoEspecies
+    ruta = tmp_path / 'especies.json'
+    ruta.write_text(json.dumps({'especies': [], 'regiones_chile': ['Maule']}), encoding='utf-8')
+    catalogo = CatalogoEspecies(str(ruta), intervalo_revision=0)
+    assert json.loads(catalogo.especies().cuerpo)['total'] == 0
+
+    especie = {'id': 'x-1', 'tipo': 'planta', 'regiones': ['Maule']}
+    ruta.write_text(json.dumps({'especies': [especie], 'regiones_chile': ['Maule']}), encoding='utf-8')
+    os.utime(ruta, ns=(0, os.stat(ruta).st_mtime_ns + 10**9))
+    assert json.loads(catalogo.especies_region('maule').cuerpo)['total'] == 1
+
+def test_mapa_agregados_incrementales(client):
+    """Map aggregates are updated on insert and match a full rebuild."""
+    import app as app_module
+    registrar(client)
+    client.post('/guardar_descubrimiento', data=json.dumps({
+        'nombre': 'Copihue', 'cientifico': 'Lapageria rosea', 'tipo': 'planta',
+        'region': 'la-araucania', 'latitud': -38.73961, 'longitud': -72.59842}),
+        content_type='application/json')
+    lote = {'descubrimientos': [
+        {'clave': f'k{i}', 'nombre': 'Chinita', 'cientifico': 'Eriopis connexa', 'tipo': 'insecto',
+         'region': 'La Araucanía' if i else 'Maule'} for i in range(3)
+    ] + [{'clave': 'sin-region', 'nombre': 'Chinita', 'cientifico': 'Eriopis connexa', 'tipo': 'insecto'}]}
+    client.post('/sincronizar_lote', data=json.dumps(lote), content_type='application/json')
+
+    data = json.loads(client.get('/mapa/agregados').data)
+    assert data['regiones']['La Araucanía'] == {'total': 3, 'por_tipo': {'planta': 1, 'insecto': 2}}
+    assert data['regiones']['Maule']['total'] == 1
+    assert data['maximo'] == 3
+
+    naturadex = json.loads(client.get('/naturadex?tipo=planta').data)['descubrimientos']
+    assert (naturadex[0]['latitud'], naturadex[0]['longitud']) == (-38.74, -72.6)
+
+    with app.app_context():
+        app_module.reconstruir_agregados()
+    assert json.loads(client.get('/mapa/agregados').data) == data
+    assert client.get('/mapa/agregados?desde=ayer').status_code == 400
+
+def test_geohash_cubre_bbox():
+    """Every point inside a bounding box falls under one of its covering prefixes."""
+    import random
+    from utils.geo import codificar_geohash, decodificar_geohash, celdas_para_bbox
+    assert codificar_geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    lat, lon = decodificar_geohash(codificar_geohash(-33.45, -70.66))
+    assert abs(lat + 33.45) < 1e-3 and abs(lon + 70.66) < 1e-3
+
+    celdas = celdas_para_bbox(-34.0, -71.5, -33.0, -70.0)
+    assert len(celdas) <= 24
+    rnd = random.Random(1)
+    for _ in range(200):
+        gh = codificar_geohash(rnd.uniform(-34.0, -33.0), rnd.uniform(-71.5, -70.0))
+        assert any(gh.startswith(c) for c in celdas)
+
+def test_descubrimientos_cerca(client):
+    """Bounding-box and radius queries return nearby points or clusters."""
+    registrar(client)
+    lugares = [(-33.45, -70.66), (-33.46, -70.65), (-33.44, -70.60), (-41.47, -72.94)]
+    lote = {'descubrimientos': [
+        {'clave': f'g{i}', 'nombre': 'Chincol', 'cientifico': 'Zonotrichia capensis', 'tipo': 'ave',
+         'latitud': la, 'longitud': lo} for i, (la, lo) in enumerate(lugares)
+    ]}
+    client.post('/sincronizar_lote', data=json.dumps(lote), content_type='application/json')
+
+    data = json.loads(client.get('/descubrimientos/cerca?sur=-34&oeste=-71&norte=-33&este=-70').data)
+    assert data['total'] == 3
+
+    data = json.loads(client.get('/descubrimientos/cerca?lat=-33.45&lng=-70.66&radio_km=3').data)
+    assert data['total'] == 2
+
+    data = json.loads(client.get('/descubrimientos/cerca?sur=-56&oeste=-76&norte=-17&este=-66&zoom=4').data)
+    assert sum(c['cantidad'] for c in data['clusters']) == 4
+    assert len(data['clusters']) == 2
+
+    assert client.get('/descubrimientos/cerca?sur=-33&oeste=-71&norte=-34&este=-70').status_code == 400
+    for rectangulo in ('sur=nan&oeste=-71&norte=-33&este=-70', 'sur=-inf&oeste=-71&norte=-33&este=-70',
+                       'sur=-34&oeste=-71&norte=inf&este=-70', 'sur=-95&oeste=-71&norte=-33&este=-70',
+                       'sur=-34&oeste=-190&norte=-33&este=-70', 'lat=nan&lng=-70&radio_km=3',
+                       'lat=-33&lng=-70&radio_km=inf'):
+        assert client.get(f'/descubrimientos/cerca?{rectangulo}').status_code == 400
+
+def test_assets_con_huella(client, tmp_path):
+    """Built assets get hashed URLs, precompressed variants and immutable caching."""
+    from app import assets
+    from utils.assets import construir_assets
+    carpeta_original = assets.carpeta
+    construir_assets(destino=str(tmp_path))
+    assets.carpeta = str(tmp_path)
+    assets.cargar()
+    try:
+        url_js = assets.url('js/app.js')
+        assert url_js.startswith('/assets/js/app.') and url_js in client.get('/').get_data(as_text=True)
+
+        respuesta = client.get(url_js, headers={'Accept-Encoding': 'gzip'})
+        assert respuesta.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in respuesta.headers['Cache-Control']
+        assert len(gzip.decompress(respuesta.data)) < os.path.getsize(os.path.join(app.static_folder, 'js', 'app.js'))
+        assert client.get('/assets/js/app.js').status_code == 404
+
+        sw = client.get('/sw.js').get_data(as_text=True)
+        assert f"naturia-chile-{assets.version}" in sw and url_js in sw
+    finally:
+        assets.carpeta = carpeta_original
+        assets.cargar()
+    assert client.get('/').get_data(as_text=True).count('/static/js/app.js') == 1
+
+def test_server_timing_y_log_de_trazas(client, tmp_path, monkeypatch):
+    """Forced traces report upstream and DB spans in Server-Timing and the JSONL log."""
+    import utils.trazas as trazas
+    from unittest.mock import MagicMock
+    monkeypatch.setattr(trazas, 'TRAZAS_MUESTREO', 0)
+    monkeypatch.setattr(trazas, 'TRAZAS_ARCHIVO', str(tmp_path / 'trazas.jsonl'))
+    assert 'Server-Timing' not in client.get('/salud').headers
+    # Sin secreto configurado ni modo debug, la cabecera no fuerza nada
+    assert 'Server-Timing' not in client.get('/salud', headers={'X-Naturia-Traza': '1'}).headers
+    monkeypatch.setattr(trazas, 'TRAZAS_SECRETO', 'secreto-de-prueba')
+    assert 'Server-Timing' not in client.get('/salud', headers={'X-Naturia-Traza': '1'}).headers
+    assert 'Server-Timing' not in client.get('/salud', headers={'X-Naturia-Traza': 'otro'}).headers
+    assert not (tmp_path / 'trazas.jsonl').exists()
+
+    xeno_canto = MagicMock(status_code=200)
+    xeno_canto.json.return_value = {'numRecordings': '1', 'recordings': [
+        {'id': '1', 'en': 'Rufous-collared Sparrow', 'file': '//xeno-canto.org/1/download', 'q': 'A'}]}
+    with patch('utils.sound_search.requests.get', return_value=xeno_canto):
+        respuesta = client.post('/sonido', json={'nombre': 'chincol', 'tipo': 'ave'},
+                                headers={'X-Naturia-Traza': 'secreto-de-prueba'})
+    assert respuesta.get_json()['encontrado']
+    assert 'http;dur=' in respuesta.headers['Server-Timing'] and 'desc="xeno-canto"' in respuesta.headers['Server-Timing']
+
+    registrar(client)
+    naturadex = client.get('/naturadex', headers={'X-Naturia-Traza': 'secreto-de-prueba'})
+    assert 'db;dur=' in naturadex.headers['Server-Timing']
+
+    lineas = [json.loads(l) for l in (tmp_path / 'trazas.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [l['ruta'] for l in lineas] == ['/sonido', '/naturadex']
+    assert any(t['nombre'] == 'db' for t in lineas[1]['tramos'])
+
+def test_upstream_simulado_graba_y_reproduce(tmp_path, monkeypatch):
+    """The stand-in server replays recordings, injects errors and records through a proxy."""
+    import utils.sound_search as sound_search
+    import utils.image_search as image_search
+    from utils.upstream_simulado import servidor_simulado, url_simulada, SERVICIOS
+
+    def redirigir(base):
+        monkeypatch.setattr(sound_search, 'XENO_CANTO_API', url_simulada(base, 'https://xeno-canto.org/api/3/recordings'))
+        monkeypatch.setattr(sound_search, 'WIKIMEDIA_API', url_simulada(base, 'https://commons.wikimedia.org/w/api.php'))
+        monkeypatch.setattr(image_search, 'WIKIPEDIA_EN', url_simulada(base, SERVICIOS['wikipedia-en']))
+        monkeypatch.setattr(image_search, 'WIKIPEDIA_ES', url_simulada(base, SERVICIOS['wikipedia-es']))
+
+    with servidor_simulado() as base:
+        redirigir(base)
+        enriquecimiento.sonidos.limpiar()
+        sonido = sound_search.buscar_sonido('chincol', tipo='ave')
+        assert sonido['calidad'] == 'A' and sonido['fuente'] == 'Xeno-Canto'
+        assert 'Zonotrichia_capensis' in image_search.buscar_imagen_wikipedia('Zonotrichia capensis')
+
+    with servidor_simulado(tasa_errores=1.0) as base:
+        redirigir(base)
+        enriquecimiento.sonidos.limpiar()
+        assert sound_search.buscar_sonido('chincol', tipo='ave') is None
+
+    # Grabar: un segundo servidor usa al primero como "servicio real"
+    with servidor_simulado() as origen:
+        origenes = {servicio: f'{origen}/{servicio}' for servicio in SERVICIOS}
+        with servidor_simulado(carpeta=str(tmp_path), grabar=True, origenes=origenes) as base:
+            redirigir(base)
+            enriquecimiento.sonidos.limpiar()
+            assert sound_search.buscar_sonido('chincol', tipo='ave')['calidad'] == 'A'
+    grabado = json.loads((tmp_path / 'xeno-canto.json').read_text(encoding='utf-8'))
+    assert list(grabado) == ['/api/3/recordings?query=Zonotrichia+capensis+cnt%3Achile']
+
+def test_asgi_buscar_y_flask_montado():
+    """The ASGI app serves async /buscar and passes other routes to Flask."""
+    pytest.importorskip('starlette')
+    pytest.importorskip('httpx')
+    from unittest.mock import AsyncMock
+    from starlette.testclient import TestClient
+    import asgi
+
+    resultado = {'nombre': 'Copihue', 'cientifico': 'Lapageria rosea', 'tipo': 'planta'}
+    with patch('asgi.buscar_por_texto_async', AsyncMock(return_value=resultado)), \
+         patch('asgi.obtener_imagen_especie_async', AsyncMock(return_value='http://example.com/c.jpg')):
+        with TestClient(asgi.app) as cliente:
+            response = cliente.post('/buscar', json={'consulta': 'copihue', 'tipo': 'planta'})
+            assert response.status_code == 200
+            assert response.json()['imagen_url'] == 'http://example.com/c.jpg'
+            assert cliente.post('/buscar', json={'consulta': ' '}).status_code == 400
+            assert cliente.get('/salud').json()['status'] == 'ok'
+
+def test_asgi_analizar_limite_sin_content_length(monkeypatch):
+    """A chunked upload to async /analizar is cut off at the size limit; a malformed Content-Length is a 400."""
+    pytest.importorskip('starlette')
+    pytest.importorskip('httpx')
+    import asyncio
+    from starlette.requests import Request
+    from starlette.testclient import TestClient
+    import asgi
+
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 64 * 1024)
+    frontera = 'limite'
+    def cuerpo():
+        yield (f'--{frontera}\r\nContent-Disposition: form-data; name="imagen"; filename="a.png"\r\n'
+               'Content-Type: image/png\r\n\r\n').encode()
+        for _ in range(32):
+            yield b'\0' * 4096
+        yield f'\r\n--{frontera}--\r\n'.encode()
+
+    with patch('asgi.analizar_imagen_async') as analizar:
+        with TestClient(asgi.app) as cliente:
+            response = cliente.post('/analizar', content=cuerpo(),
+                                    headers={'Content-Type': f'multipart/form-data; boundary={frontera}'})
+    assert 'content-length' not in {k.lower() for k in response.request.headers}
+    assert response.status_code == 413
+    assert 'demasiado grande' in response.json()['error']
+
+    # Una cabecera Content-Length que no es un número
+    respuesta = asyncio.run(asgi.analizar(Request({
+        'type': 'http', 'method': 'POST', 'path': '/analizar', 'query_string': b'',
+        'headers': [(b'content-length', b'mucho'), (b'content-type', b'multipart/form-data; boundary=x')]})))
+    assert respuesta.status_code == 400
+    analizar.assert_not_called()
+
+def test_busqueda_async_no_bloquea_el_event_loop(tmp_path, monkeypatch):
+    """Async search runs configure_gemini and the SQLite cache lookups in worker threads, not on the loop."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    from utils import gemini_client
+    from utils.cache import AlmacenSQLite
+
+    monkeypatch.setattr(enriquecimiento.busquedas, '_propio', AlmacenSQLite(str(tmp_path / 'cache.sqlite3')))
+    hilos = {}
+    def anotar(nombre, funcion):
+        def envoltura(*args, **kwargs):
+            hilos.setdefault(nombre, set()).add(threading.current_thread().name)
+            return funcion(*args, **kwargs)
+        return envoltura
+    monkeypatch.setattr(gemini_client, 'configure_gemini', anotar('configurar', lambda: True))
+    for metodo in ('consultar', 'guardar'):
+        monkeypatch.setattr(enriquecimiento.busquedas, metodo, anotar(metodo, getattr(enriquecimiento.busquedas, metodo)))
+    respuesta = AsyncMock(return_value=(True, json.dumps({'nombre': 'Chucao', 'cientifico': 'Scelorchilus rubecula'})))
+    monkeypatch.setattr(gemini_client, 'intentar_busqueda_con_modelo_async', respuesta)
+
+    async def buscar_dos_veces():
+        await gemini_client.buscar_por_texto_async('chucao', 'ave')
+        return await gemini_client.buscar_por_texto_async('chucao', 'ave'), threading.current_thread().name
+
+    resultado, hilo_del_loop = asyncio.run(buscar_dos_veces())
+    assert resultado['cientifico'] == 'Scelorchilus rubecula' and respuesta.call_count == 1
+    assert set(hilos) == {'configurar', 'consultar', 'guardar'}
+    assert all(hilo_del_loop not in nombres for nombres in hilos.values())
+
+def test_imagen_wikipedia_async_misma_cascada():
+    """The async Wikipedia lookup follows the same search cascade as the sync one."""
+    httpx = pytest.importorskip('httpx')
+    import asyncio
+    from utils import image_search
+
+    pedidas = []
+    def responder(request):
+        params = dict(request.url.params)
+        pedidas.append((request.url.host, params.get('titles') or params.get('srsearch')))
+        if params.get('list') == 'search':
+            return httpx.Response(200, json={'query': {'search': [{'title': 'Cóndor andino'}]}})
+        if params.get('titles') == 'Cóndor andino' and request.url.host == 'es.wikipedia.org':
+            return httpx.Response(200, json={'query': {'pages': {'1': {'thumbnail': {'source': 'http://img/condor.jpg'}}}}})
+        return httpx.Response(200, json={'query': {'pages': {'-1': {}}}})
+
+    async def ejecutar():
+        cliente = httpx.AsyncClient(transport=httpx.MockTransport(responder))
+        with patch('utils.image_search.cliente_http', return_value=cliente):
+            return await image_search.buscar_imagen_wikipedia_async('Vultur gryphus')
+
+    assert asyncio.run(ejecutar()) == 'http://img/condor.jpg'
+    assert pedidas[0] == ('en.wikipedia.org', 'Vultur gryphus')
+    assert pedidas[-1] == ('es.wikipedia.org', 'Cóndor andino')
+
+def test_coalescencia_de_busquedas_identicas(client, tmp_path):
+    """Concurrent identical searches share one upstream call; /metricas counts the coalesced ones."""
+    import threading
+    import time
+    from utils import gemini_client
+    from utils.coalescencia import VueloUnico, vuelo_unico, clave_llamada
+
+    vuelo_unico.reiniciar_metricas()
+    liberar = threading.Event()
+    llamadas = []
+    def gemini_lento(modelo, tipo, consulta):
+        llamadas.append(consulta)
+        liberar.wait(5)
+        return True, json.dumps({'nombre': 'Copihue', 'cientifico': 'Lapageria rosea'})
+
+    resultados = []
+    with patch('utils.gemini_client.configure_gemini'), \
+         patch('utils.gemini_client.intentar_busqueda_con_modelo', side_effect=gemini_lento):
+        hilos = [threading.Thread(target=lambda c=c: resultados.append(gemini_client.buscar_por_texto(c, 'planta')))
+                 for c in ['copihue', ' Copihue', 'COPIHUE '] * 4]
+        for hilo in hilos:
+            hilo.start()
+        clave = clave_llamada('buscar_por_texto', ('copihue', 'planta'), {})
+        limite = time.time() + 5
+        while (vuelo_unico._en_curso.get(clave) is None or vuelo_unico._en_curso[clave].esperando < 11) \
+                and time.time() < limite:
+            time.sleep(0.01)
+        liberar.set()
+        for hilo in hilos:
+            hilo.join()
+
+    assert len(llamadas) == 1
+    assert len(resultados) == 12 and all(r['nombre'] == 'Copihue' for r in resultados)
+    resultados[0]['imagen_url'] = 'x'  # Cada llamada recibe su propia copia
+    assert sum('imagen_url' in r for r in resultados) == 1
+    metricas = client.get('/metricas').get_json()['coalescencia']['por_funcion']['buscar_por_texto']
+    assert metricas == {'llamadas': 12, 'ejecutadas': 1, 'coalescidas': 11, 'coalescidas_entre_procesos': 0}
+
+    # Entre procesos: otro worker que llega dentro de la ventana lee el resultado del lock de archivo
+    worker_a, worker_b = VueloUnico(str(tmp_path)), VueloUnico(str(tmp_path))
+    assert worker_a.hacer('f', 'k', lambda: {'n': 1}) == {'n': 1}
+    assert worker_b.hacer('f', 'k', lambda: {'n': 2}) == {'n': 1}
+    assert worker_b.metricas()['coalescidas_entre_procesos'] == 1
+
+def test_enriquecimiento_stale_while_revalidate(client, monkeypatch):
+    """Stale entries are served at once and refreshed in the background; dead URLs are re-fetched."""
+    from unittest.mock import MagicMock
+    from utils import image_search
+
+    cache = enriquecimiento.imagenes
+    monkeypatch.setattr(cache, 'ttl_suave', 60)
+    monkeypatch.setattr(cache, 'ttl_duro', 120)
+    urls = iter(['http://img/1.jpg', 'http://img/2.jpg', 'http://img/3.jpg', 'http://img/4.jpg'])
+    with patch('utils.image_search.pasos_busqueda', return_value=[('titulo', 'Lapageria rosea', 'wiki')]), \
+         patch('utils.image_search.requests.get') as get:
+        get.side_effect = lambda *a, **k: MagicMock(status_code=200, json=lambda: {
+            'query': {'pages': {'1': {'thumbnail': {'source': next(urls)}}}}})
+
+        assert image_search.buscar_imagen_wikipedia('Lapageria rosea') == 'http://img/1.jpg'
+        assert image_search.buscar_imagen_wikipedia('lapageria rosea ') == 'http://img/1.jpg'
+        assert get.call_count == 1
+
+        # Pasado el vencimiento suave: responde lo guardado y refresca en el fondo
+        for clave, registro, _ in cache.entradas_con_url():
+            registro['guardado'] -= 90
+            cache.reescribir(clave, registro)
+        assert image_search.buscar_imagen_wikipedia('Lapageria rosea') == 'http://img/1.jpg'
+        cache.esperar_refrescos()
+        assert image_search.buscar_imagen_wikipedia('Lapageria rosea') == 'http://img/2.jpg'
+
+        # Pasado el duro: espera una búsqueda nueva
+        for clave, registro, _ in cache.entradas_con_url():
+            registro['guardado'] -= 200
+            cache.reescribir(clave, registro)
+        assert image_search.buscar_imagen_wikipedia('Lapageria rosea') == 'http://img/3.jpg'
+
+        # Verificación en lote: un 404 en el HEAD dispara el refresco
+        sesion = MagicMock()
+        sesion.head.return_value.status_code = 404
+        with patch('utils.enriquecimiento.requests.Session', return_value=sesion):
+            assert enriquecimiento.verificar_urls([cache]) == {'revisadas': 1, 'muertas': 1, 'sin_respuesta': 0}
+        cache.esperar_refrescos()
+        assert image_search.buscar_imagen_wikipedia('Lapageria rosea') == 'http://img/4.jpg'
+
+    estadisticas = client.get('/metricas').get_json()['enriquecimiento']['imagenes']
+    assert estadisticas['viejas'] == 1 and estadisticas['refrescos'] == 2 and estadisticas['urls_muertas'] == 1
+
+def test_almacenes_de_cache_compartidos(tmp_path):
+    """Every backend honours TTL, per-namespace caps and isolation; sqlite is shared across instances."""
+    import time
+    from utils.cache import AlmacenMemoria, AlmacenSQLite, AlmacenRedis
+
+    def probar(almacen, otro=None):
+        otro = otro or almacen
+        almacen.guardar('imagenes', 'a', {'valor': 'http://img/a.jpg'}, ttl=60, maximo=2)
+        almacen.guardar('sonidos', 'a', {'valor': {'url': 'http://snd/a.mp3'}}, ttl=60, maximo=2)
+        assert otro.obtener('imagenes', 'a') == {'valor': 'http://img/a.jpg'}
+        assert otro.obtener('sonidos', 'a')['valor']['url'] == 'http://snd/a.mp3'
+        almacen.guardar('imagenes', 'b', {'valor': 1}, ttl=60, maximo=2)
+        almacen.guardar('imagenes', 'c', {'valor': 2}, ttl=60, maximo=2)
+        almacen.guardar('imagenes', 'corta', {'valor': 3}, ttl=1, maximo=10)
+        time.sleep(1.1)
+        assert otro.obtener('imagenes', 'corta') is None
+        assert {clave for clave, _ in otro.registros('imagenes')} == {'b', 'c'}
+        otro.limpiar('imagenes')
+        assert almacen.obtener('imagenes', 'b') is None and almacen.obtener('sonidos', 'a') is not None
+        # Al llenarse se descarta el menos usado, no el escrito hace más tiempo
+        almacen.guardar('lru', 'x', {'valor': 1}, ttl=60, maximo=2)
+        almacen.guardar('lru', 'y', {'valor': 2}, ttl=60, maximo=2)
+        assert otro.obtener('lru', 'x') is not None
+        almacen.guardar('lru', 'z', {'valor': 3}, ttl=60, maximo=2)
+        assert {clave for clave, _ in otro.registros('lru')} == {'x', 'z'}
+        otro.limpiar('lru')
+
+    memoria = AlmacenMemoria()
+    probar(memoria)
+    assert memoria.tamano('imagenes') == 0
+
+    ruta = str(tmp_path / 'cache.sqlite3')
+    sqlite = AlmacenSQLite(ruta)
+    sqlite.REVISAR_TOPE_CADA = 1
+    otro_sqlite = AlmacenSQLite(ruta)
+    otro_sqlite.TOQUE_SEGUNDOS = 0
+    probar(sqlite, otro_sqlite)
+
+    # Redis solo si hay un servidor local
+    redis = pytest.importorskip('redis')
+    cliente = redis.Redis(decode_responses=True, socket_connect_timeout=0.2)
+    try:
+        cliente.ping()
+    except redis.exceptions.ConnectionError:
+        pytest.skip('sin servidor Redis local')
+    almacen = AlmacenRedis(cliente)
+    almacen.PREFIJO = 'naturia:test:'
+    probar(almacen)
+    almacen.limpiar('sonidos')
+
+def test_enriquecimiento_compartido_entre_workers(client, tmp_path, monkeypatch):
+    """With a shared sqlite store, a lookup resolved by one worker is a hit for another."""
+    from utils import image_search
+    from utils.cache import AlmacenSQLite
+
+    ruta = str(tmp_path / 'cache.sqlite3')
+    monkeypatch.setattr(enriquecimiento, '_almacen', AlmacenSQLite(ruta))
+    with patch('utils.image_search.pasos_busqueda', return_value=[('titulo', 'Lapageria rosea', 'wiki')]), \
+         patch('utils.image_search.requests.get') as get:
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {'query': {'pages': {'1': {'thumbnail': {'source': 'http://img/1.jpg'}}}}}
+        assert image_search.buscar_imagen_wikipedia('Lapageria rosea') == 'http://img/1.jpg'
+        # Otro worker: su propio almacén apuntando al mismo archivo
+        monkeypatch.setattr(enriquecimiento, '_almacen', AlmacenSQLite(ruta))
+        assert image_search.buscar_imagen_wikipedia('lapageria rosea') == 'http://img/1.jpg'
+        assert get.call_count == 1
+    assert enriquecimiento.imagenes.estadisticas()['entradas'] == 1
+
+def test_enrutador_ordena_modelos_por_latencia(client, monkeypatch):
+    """Models are tried fastest-expected first, failing ones drop below the floor, and exploration rotates."""
+    from unittest.mock import MagicMock
+    from utils import gemini_client
+    from utils.enrutador_modelos import EnrutadorModelos
+
+    enrutador = EnrutadorModelos(['a', 'b', 'c'], alfa=0.5, muestras_minimas=2, exploracion=0)
+    assert enrutador.orden('texto') == ['a', 'b', 'c']
+    for _ in range(3):
+        enrutador.registrar('a', 'texto', True, 2.0)
+        enrutador.registrar('b', 'texto', True, 0.5)
+    assert enrutador.orden('texto') == ['b', 'a', 'c']
+    assert enrutador.orden('imagen') == ['a', 'b', 'c']  # Cada clase de llamada tiene sus números
+    for _ in range(3):
+        enrutador.registrar('b', 'texto', False, 0.1)
+    assert enrutador.orden('texto') == ['a', 'c', 'b']
+    enrutador.exploracion = 1.0
+    assert enrutador.orden('texto')[0] == 'c'
+
+    # Integración: los intentos reales alimentan el enrutador del cliente
+    gemini_client.enrutador.reiniciar()
+    monkeypatch.setattr(gemini_client.enrutador, 'muestras_minimas', 1)
+    monkeypatch.setattr(gemini_client.enrutador, 'exploracion', 0)
+    def modelo(nombre, **kwargs):
+        falso = MagicMock()
+        if nombre == 'gemini-2.5-flash':
+            falso.generate_content.side_effect = Exception('404 not found')
+        else:
+            falso.generate_content.return_value.text = json.dumps({'nombre': 'Copihue', 'cientifico': 'Lapageria rosea'})
+        return falso
+    genai = MagicMock(GenerativeModel=modelo)
+    gemini_client.MODELOS_PREPARADOS.clear()
+    with patch('utils.gemini_client.configure_gemini'), patch('utils.gemini_client.cargar_genai', return_value=genai):
+        assert gemini_client.buscar_por_texto('copihue', 'planta')['modelo_usado'] == 'gemini-2.0-flash'
+    estado = client.get('/metricas').get_json()['modelos']['texto']
+    assert estado['orden'][0] == 'gemini-2.0-flash' and estado['orden'][-1] == 'gemini-2.5-flash'
+    assert estado['modelos']['gemini-2.5-flash']['bajo_piso']
+
+def test_modelos_preparados_con_instrucciones_fijas(tmp_path, monkeypatch):
+    """Models are built once per (model, tipo, kind) with the static prompt as system_instruction; only the query is sent."""
+    from unittest.mock import MagicMock
+    from utils import gemini_client
+    from utils.huellas import IndiceHuellas
+
+    monkeypatch.setattr(gemini_client, 'indice_huellas', IndiceHuellas(str(tmp_path / 'huellas.jsonl')))
+    monkeypatch.setattr(gemini_client.enrutador, 'exploracion', 0)
+    monkeypatch.setenv('GOOGLE_API_KEY', 'clave-de-prueba')
+    genai = MagicMock()
+    genai.GenerativeModel.return_value.generate_content.return_value.text = json.dumps(
+        {'nombre': 'Chucao', 'cientifico': 'Scelorchilus rubecula'})
+    gemini_client.MODELOS_PREPARADOS.clear()
+    with patch('utils.gemini_client.cargar_genai', return_value=genai):
+        for consulta in ('chucao', 'pájaro que canta en el bosque', 'chucao'):
+            assert gemini_client.buscar_por_texto(consulta, 'ave')['cientifico'] == 'Scelorchilus rubecula'
+        gemini_client.analizar_imagen(foto(), 'ave')
+
+    # Un modelo de texto y uno de imagen, cada uno construido una vez
+    construidos = genai.GenerativeModel.call_args_list
+    assert len(construidos) == 2
+    instrucciones = construidos[0].kwargs['system_instruction']
+    assert 'ornitólogo' in instrucciones and 'chucao' not in instrucciones
+    assert construidos[1].kwargs['system_instruction'] == gemini_client.obtener_prompt('ave')
+    enviados = [llamada.args[0] for llamada in genai.GenerativeModel.return_value.generate_content.call_args_list]
+    assert enviados[:2] == ['chucao', 'pájaro que canta en el bosque'] and len(enviados[2]) == 1
+
+    # Otra clave de API: los modelos se vuelven a construir
+    monkeypatch.setenv('GOOGLE_API_KEY', 'otra-clave')
+    with patch('utils.gemini_client.cargar_genai', return_value=genai):
+        gemini_client.buscar_por_texto('chucao', 'insecto')
+    assert list(gemini_client.MODELOS_PREPARADOS) == [(gemini_client.enrutador.orden('texto')[0], 'insecto', 'texto')]
+
+def test_cache_de_contexto_se_reutiliza_y_se_libera(monkeypatch):
+    """Context caches are reused across workers by display_name and the ones this process created are deleted on key change."""
+    from datetime import timezone
+    from unittest.mock import MagicMock
+    from utils import gemini_client
+
+    monkeypatch.setattr(gemini_client, 'GEMINI_CACHE_CONTEXTO', True)
+    monkeypatch.setattr(gemini_client, '_caches_creados', {})
+    monkeypatch.setenv('GOOGLE_API_KEY', 'clave-de-prueba')
+    existentes = []
+    def crear(model, display_name, system_instruction, ttl):
+        contenido = MagicMock(display_name=display_name, expire_time=datetime.now(timezone.utc) + ttl)
+        existentes.append(contenido)
+        return contenido
+    genai = MagicMock()
+    genai.caching.CachedContent.create.side_effect = crear
+    genai.caching.CachedContent.list.side_effect = lambda page_size: list(existentes)
+    gemini_client.MODELOS_PREPARADOS.clear()
+    with patch('utils.gemini_client.cargar_genai', return_value=genai):
+        gemini_client.configure_gemini()
+        gemini_client.obtener_modelo('gemini-2.0-flash', 'ave', 'texto')
+        # Otro worker (sin nada preparado) encuentra la misma caché por su display_name
+        gemini_client.MODELOS_PREPARADOS.clear()
+        gemini_client.obtener_modelo('gemini-2.0-flash', 'ave', 'texto')
+        assert genai.caching.CachedContent.create.call_count == 1
+        assert genai.GenerativeModel.from_cached_content.call_args_list[1].args[0] is existentes[0]
+        gemini_client.obtener_modelo('gemini-2.0-flash', 'planta', 'texto')
+        assert genai.caching.CachedContent.create.call_count == 2
+
+        monkeypatch.setenv('GOOGLE_API_KEY', 'otra-clave')
+        gemini_client.configure_gemini()
+    assert all(contenido.delete.call_count == 1 for contenido in existentes)
+    assert gemini_client._caches_creados == {} and gemini_client.MODELOS_PREPARADOS == {}
+
+def test_autocompletar_prefijo_y_aproximado(client):
+    """Suggestions come from the catalog, AVES_CHILE, discoveries and Gemini results, by prefix or fuzzy match."""
+    import time
+    import app as app_module
+
+    registrar(client)
+    guardar(client, nombre='Madre de culebra', tipo='insecto')
+    app_module.autocompletado.construir()
+
+    def sugerencias(q, **params):
+        respuesta = client.get('/autocompletar', query_string={'q': q, **params})
+        assert respuesta.status_code == 200
+        return respuesta.get_json()['sugerencias']
+
+    assert sugerencias('chinc', tipo='ave')[0]['nombre'] == 'Chincol'
+    assert any(s['nombre'] == 'Madre de culebra' for s in sugerencias('culeb'))  # Palabra interior
+    assert sugerencias('zonotrichia')[0]['cientifico'] == 'Zonotrichia capensis'  # Nombre científico
+    aproximada = sugerencias('copiue')[0]
+    assert aproximada['nombre'] == 'Copihue' and aproximada['coincidencia'] == 'aproximada'
+    assert all(s['tipo'] == 'planta' for s in sugerencias('c', tipo='planta'))
+    assert sugerencias('') == [] and len(sugerencias('a', limite=3)) == 3
+
+    # Lo que devuelve Gemini en /buscar se aprende
+    with patch('app.buscar_por_texto', return_value={'nombre': 'Chucao', 'cientifico': 'Scelorchilus rubecula'}), \
+         patch('app.obtener_imagen_especie', return_value=None):
+        client.post('/buscar', json={'consulta': 'chukao', 'tipo': 'ave'})
+    app_module.autocompletado.construir()
+    assert sugerencias('chuca')[0]['cientifico'] == 'Scelorchilus rubecula'
+
+    # Y lo que identifica en /analizar
+    with patch('app.analizar_imagen', return_value={'nombre': 'Matapiojos', 'cientifico': 'Phenes raptor'}), \
+         patch('app.obtener_imagen_especie', return_value=None):
+        client.post('/analizar', content_type='multipart/form-data',
+                    data={'imagen': (io.BytesIO(imagen()), 'matapiojos.jpg'), 'tipo': 'insecto'})
+    app_module.autocompletado.construir()
+    assert sugerencias('matapi', tipo='insecto')[0]['cientifico'] == 'Phenes raptor'
+
+    inicio = time.perf_counter()
+    for consulta in ['ch', 'chin', 'picaflor', 'araucaria', 'zorzal', 'kondor', 'xyz'] * 30:
+        app_module.autocompletado.sugerir(consulta)
+    assert (time.perf_counter() - inicio) / 210 < 0.005
+
+def test_exportar_naturadex_en_streaming(client, monkeypatch):
+    """Discoveries stream as CSV or NDJSON (optionally gzipped) with filters; other users need the teacher token."""
+    import csv
+    import app as app_module
+    from app import Discovery
+
+    registrar(client)
+    guardar(client, nombre='Chinita', tipo='insecto')
+    guardar(client, nombre='Copihue', tipo='planta')
+    with app.app_context():
+        db.session.add_all([Discovery(user_id=1, nombre_especie=f'Especie {i}', nombre_cientifico=f'Species {i}',
+                                      tipo='ave', puntos=i, fecha=datetime(2024, 1, 1 + i % 28)) for i in range(1200)])
+        db.session.commit()
+
+    respuesta = client.get('/naturadex/export')
+    assert respuesta.is_streamed and respuesta.mimetype == 'text/csv'
+    filas = list(csv.reader(io.StringIO(respuesta.get_data(as_text=True).lstrip('\ufeff'))))
+    assert filas[0][:4] == ['id', 'usuario_id', 'explorador', 'nombre'] and len(filas) == 1203
+    assert filas[1][2] == 'Ana Soto'
+
+    respuesta = client.get('/naturadex/export?formato=ndjson&tipo=ave&desde=2024-01-02&hasta=2024-01-03',
+                           headers={'Accept-Encoding': 'gzip'})
+    assert respuesta.headers['Content-Encoding'] == 'gzip'
+    lineas = [json.loads(l) for l in gzip.decompress(respuesta.data).decode('utf-8').splitlines()]
+    assert len(lineas) == 86 and {l['fecha'][:10] for l in lineas} == {'2024-01-02', '2024-01-03'}
+    assert client.get('/naturadex/export?formato=xml').status_code == 400
+    assert client.get('/naturadex/export?desde=ayer').status_code == 400
+
+    # Otro usuario solo exporta lo suyo; con el token de docente se elige a quién
+    client.get('/logout')
+    registrar(client, correo='otra@example.com')
+    guardar(client, nombre='Pudú', tipo='animal')
+    assert len(client.get('/naturadex/export?formato=ndjson&usuario=1').data.splitlines()) == 1
+    client.get('/logout')
+    monkeypatch.setattr(app_module, 'NATURADEX_EXPORT_TOKEN', 'secreto')
+    assert client.get('/naturadex/export', headers={'Authorization': 'Bearer otro'}).status_code == 302
+    respuesta = client.get('/naturadex/export?formato=ndjson&usuario=1,2&tipo=animal',
+                           headers={'Authorization': 'Bearer secreto'})
+    assert [json.loads(l)['nombre'] for l in respuesta.data.splitlines()] == ['Pudú']
+
+    # Lo que escriben los usuarios no llega a Excel como fórmula
+    from utils.exportar import filas_csv, filas_ndjson
+    fila = ('=HYPERLINK("http://x")', '+56 9', '-2+3', '@SUMA(A1)', 'Chinita', -33.45, 7)
+    columnas = ('a', 'b', 'c', 'd', 'e', 'f', 'g')
+    texto = b''.join(filas_csv([fila], columnas)).decode('utf-8').lstrip('\ufeff')
+    assert list(csv.reader(io.StringIO(texto)))[1] == [
+        '\'=HYPERLINK("http://x")', "'+56 9", "'-2+3", "'@SUMA(A1)", 'Chinita', '-33.45', '7']
+    assert json.loads(b''.join(filas_ndjson([fila], columnas)))['a'] == '=HYPERLINK("http://x")'
+
+def test_init_db_migra_base_anterior(client):
+    """A database created by the original models gains the new columns and indexes, and the counter is backfilled."""
+    from sqlalchemy import inspect, text
+    from app import inicializar_base_de_datos
+
+    with app.app_context():
+        db.drop_all()
+        with db.engine.begin() as conexion:
+            conexion.execute(text("""CREATE TABLE user (id INTEGER PRIMARY KEY, nombre VARCHAR(50) NOT NULL,
+                apellido VARCHAR(50) NOT NULL, correo VARCHAR(100) NOT NULL UNIQUE, telefono VARCHAR(20),
+                total_puntos INTEGER, created_at DATETIME)"""))
+            conexion.execute(text("""CREATE TABLE discovery (id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES user (id), nombre_especie VARCHAR(100) NOT NULL,
+                nombre_cientifico VARCHAR(100) NOT NULL, tipo VARCHAR(50) NOT NULL, imagen_url VARCHAR(255),
+                puntos INTEGER, fecha DATETIME)"""))
+            conexion.execute(text("INSERT INTO user VALUES (1, 'Ana', 'Soto', 'explorador@example.com', NULL, 20, NULL)"))
+            conexion.execute(text("""INSERT INTO discovery (user_id, nombre_especie, nombre_cientifico, tipo, puntos)
+                VALUES (1, 'Chinita', 'Eriopis connexa', 'insecto', 10), (1, 'Copihue', 'Lapageria rosea', 'planta', 10)"""))
+
+    agregadas = inicializar_base_de_datos()
+    assert {'user.total_descubrimientos', 'discovery.clave_idempotencia', 'discovery.region',
+            'discovery.latitud', 'discovery.longitud', 'discovery.geohash'} <= set(agregadas)
+    assert inicializar_base_de_datos() == []  # Idempotente
+    with app.app_context():
+        indices = {i['name'] for i in inspect(db.engine).get_indexes('discovery')}
+        assert {'ix_discovery_user_fecha', 'ix_discovery_geohash', 'uq_discovery_user_clave'} <= indices
+
+    respuesta = client.post('/login', json={'correo': 'explorador@example.com'})
+    assert respuesta.status_code == 200
+    assert client.get('/perfil').get_json()['descubrimientos_count'] == 2
+
+def foto(tamano=(640, 480), calidad=90, variante=0):
+    """Foto con textura (la huella de una imagen lisa no se indexa)."""
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (640, 480), (30, 90, 40))
+    dibujo = ImageDraw.Draw(img)
+    for i in range(12):
+        x = (i * 97 + variante * 211) % 600
+        dibujo.ellipse((x, (i * 53) % 440, x + 60 + i * 5, (i * 53) % 440 + 40), fill=(200 - i * 10, 40 + i * 15, 60))
+    salida = io.BytesIO()
+    img.resize(tamano).save(salida, format='JPEG', quality=calidad)
+    return salida.getvalue()
+
+def test_huella_sin_decodificar_la_foto_completa():
+    """The JPEG fingerprint comes from a 1/8-scale draft read: the original stays undecoded and intact."""
+    from PIL import Image
+    from utils.gemini_client import abrir_imagen
+    from utils.huellas import calcular_huella, distancia
+
+    datos = foto((1600, 1200))
+    imagen = abrir_imagen(io.BytesIO(datos))
+    huella = calcular_huella(imagen)
+    assert imagen.tile and imagen.size == (1600, 1200)
+    completa = Image.open(io.BytesIO(datos))
+    completa.load()
+    assert imagen.tobytes() == completa.tobytes()
+    assert distancia(huella, calcular_huella(completa)) <= 2
+
+def test_huella_reutiliza_fotos_casi_identicas(client, tmp_path, monkeypatch):
+    """A resized/recompressed copy reuses the stored identification; the index persists and audits hits."""
+    from utils import gemini_client
+    from utils.huellas import IndiceHuellas
+
+    indice = IndiceHuellas(str(tmp_path / 'huellas.jsonl'), auditoria=0)
+    monkeypatch.setattr(gemini_client, 'indice_huellas', indice)
+    respuesta = json.dumps({'nombre': 'Chinita', 'cientifico': 'Eriopis connexa', 'puntos': 10})
+    with patch('utils.gemini_client.configure_gemini'), \
+         patch('utils.gemini_client.intentar_con_modelo', return_value=(True, respuesta)) as gemini:
+        assert gemini_client.analizar_imagen(foto(), 'insecto')['cientifico'] == 'Eriopis connexa'
+        similar = gemini_client.analizar_imagen(foto((480, 360), calidad=60), 'insecto')
+        assert similar['metodo'] == 'imagen_similar' and similar['cientifico'] == 'Eriopis connexa'
+        assert gemini.call_count == 1
+        # Otra foto, u otro tipo, sí consulta a Gemini
+        gemini_client.analizar_imagen(foto(variante=1), 'insecto')
+        gemini_client.analizar_imagen(foto(), 'planta')
+        assert gemini.call_count == 3
+
+    recargado = IndiceHuellas(str(tmp_path / 'huellas.jsonl'), auditoria=1.0)
+    from utils.gemini_client import abrir_imagen, calcular_huella
+    encontrado = recargado.buscar(calcular_huella(abrir_imagen(foto((320, 240)))), 'insecto')
+    assert encontrado['cientifico'] == 'Eriopis connexa'
+    recargado.quizas_auditar(encontrado, lambda: {'cientifico': 'Hippodamia variegata'}).result()
+    estadisticas = recargado.estadisticas()
+    assert estadisticas['en_indice'] == 3 and estadisticas['tasa_coincidencias_falsas'] == 1.0
+    assert estadisticas['discrepancias'][0]['gemini'] == 'Hippodamia variegata'
+    assert 'huellas' in client.get('/metricas').get_json()
+
+def test_huellas_compacta_al_pasar_el_maximo(tmp_path):
+    """Past HUELLAS_MAXIMO the oldest fingerprints are dropped and the file is rewritten, keeping other workers' lines."""
+    from utils.huellas import IndiceHuellas
+
+    archivo = str(tmp_path / 'huellas.jsonl')
+    huellas = [(0x9E3779B97F4A7C15 * (i + 1)) % 2 ** 64 for i in range(12)]
+    resultado = lambda i: {'nombre': f'Especie {i}', 'cientifico': f'Species {i}'}
+    otro_worker = IndiceHuellas(archivo, umbral=0, auditoria=0, maximo=10)
+    otro_worker.agregar(huellas[0], 'insecto', resultado(0))
+
+    indice = IndiceHuellas(archivo, umbral=0, auditoria=0, maximo=10)
+    # El otro worker ya dejó una línea en el archivo: con estas son 10
+    for i in range(1, 10):
+        indice.agregar(huellas[i], 'insecto', resultado(i))
+    assert indice.estadisticas()['compactaciones'] == 0 and indice.estadisticas()['en_indice'] == 10
+    otro_worker.agregar(huellas[10], 'insecto', resultado(10))
+    indice.agregar(huellas[11], 'insecto', resultado(11))
+
+    estadisticas = indice.estadisticas()
+    assert estadisticas['compactaciones'] == 1 and estadisticas['en_indice'] == 9
+    # Quedan las 9 más nuevas del archivo, incluida la del otro worker
+    assert indice.buscar(huellas[2], 'insecto') is None
+    assert indice.buscar(huellas[3], 'insecto')['cientifico'] == 'Species 3'
+    assert indice.buscar(huellas[10], 'insecto')['cientifico'] == 'Species 10'
+    with open(archivo, encoding='utf-8') as f:
+        assert len(f.readlines()) == 9
+    recargado = IndiceHuellas(archivo, umbral=0, auditoria=0, maximo=10)
+    assert recargado.buscar(huellas[11], 'insecto')['cientifico'] == 'Species 11'
+    assert recargado.estadisticas()['en_indice'] == 9
+
+def test_precalentar_llena_cache_y_retoma(client, tmp_path):
+    """Prewarming fills the shared snapshot that workers load, and a second run resumes instead of redoing."""
+    from utils import precalentar as modulo
+    from utils import gemini_client
+
+    respuesta = json.dumps({'nombre': 'Chincol', 'cientifico': 'Zonotrichia capensis', 'puntos': 10})
+    especies = [('chincol', 'Zonotrichia capensis', 'ave'), ('copihue', None, 'planta')]
+    avance, archivo = str(tmp_path / 'avance.json'), str(tmp_path / 'enriquecimiento.json')
+    with patch('utils.gemini_client.configure_gemini'), \
+         patch('utils.gemini_client.intentar_busqueda_con_modelo', return_value=(True, respuesta)) as gemini, \
+         patch('utils.image_search.buscar_imagen_wikipedia', return_value='http://img/chincol.jpg'), \
+         patch('utils.sound_search.buscar_sonido_ave', return_value=None):
+        resumen = modulo.precalentar(especies, avance, archivo, hilos=2, por_segundo=0, informar=lambda m: None)
+        assert resumen['especies'] == 2 and resumen['errores'] == 0
+        assert modulo.precalentar(especies, avance, archivo, informar=lambda m: None)['especies'] == 0
+        assert gemini.call_count == 2
+
+        # Otro worker: arranca vacío y carga el volcado
+        for cache in enriquecimiento.CACHES:
+            cache.limpiar()
+        assert enriquecimiento.cargar_archivo(archivo) == 2
+        assert gemini_client.buscar_por_texto('Chincol ', 'ave')['cientifico'] == 'Zonotrichia capensis'
+        assert gemini.call_count == 2
+
+def test_puntos_diferidos_en_lote(client, tmp_path, monkeypatch):
+    """Point syncs are batched into one write, stay visible to the user meanwhile, and survive a crash via the log."""
+    import app as app_module
+    from utils.puntos_diferidos import BufferPuntos
+
+    monkeypatch.setattr(app_module.puntos_diferidos, 'intervalo_ms', 60_000)
+    monkeypatch.setattr(app_module.puntos_diferidos, 'carpeta_log', str(tmp_path))
+    registrar(client, puntos=5)
+    for puntos in (10, 25, 40):
+        client.post('/sincronizar_puntos', json={'puntos': puntos})
+    with app.app_context():
+        assert db.session.get(User, 1).total_puntos == 5
+    # pendiente() es del worker que recibió los puntos; este test usa un solo proceso
+    assert client.get('/perfil').get_json()['puntos'] == 40
+    assert len(list(tmp_path.glob('puntos-*.log'))) == 1
+
+    # Cuerpos sin puntos válidos: 400, y el total pendiente no cambia
+    for cuerpo in ({}, {'puntos': None}, {'puntos': 'muchos'}, {'puntos': [40]}, [40]):
+        assert client.post('/sincronizar_puntos', json=cuerpo).status_code == 400
+    assert client.post('/sincronizar_puntos', data='puntos=40').status_code == 400
+    assert client.get('/perfil').get_json()['puntos'] == 40
+
+    assert app_module.puntos_diferidos.vaciar() == 1
+    with app.app_context():
+        assert db.session.get(User, 1).total_puntos == 40
+    assert all(p.stat().st_size == 0 for p in tmp_path.glob('puntos-*.log'))
+
+    # Un worker que se cae deja su log; el próximo proceso lo recupera
+    escritos = []
+    caido = BufferPuntos(escritos.append, intervalo_ms=60_000, carpeta_log=str(tmp_path / 'caido'))
+    caido.registrar(7, 100)
+    caido.registrar(8, 50)
+    caido.registrar(7, 120)
+    caido._log.close()
+    segmento = next((tmp_path / 'caido').glob('puntos-*.log'))
+    segmento.rename(segmento.with_name('puntos-999999999-1.log'))
+    nuevo = BufferPuntos(escritos.append, intervalo_ms=60_000, carpeta_log=str(tmp_path / 'caido'))
+    assert nuevo.recuperar() == 2 and nuevo.pendiente(7) == 120
+    nuevo.detener()
+    assert escritos == [{7: 120, 8: 50}]
+    assert list((tmp_path / 'caido').glob('*.log')) == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='requires fcntl')
+def test_puntos_diferidos_recuperacion_concurrente(tmp_path):
+    """Workers starting together recover each orphan segment once, and a live segment under a recycled PID is left alone."""
+    from utils.puntos_diferidos import BufferPuntos
+
+    carpeta = str(tmp_path)
+    caido = BufferPuntos(lambda lote: None, intervalo_ms=60_000, carpeta_log=carpeta)
+    caido.registrar(7, 120)
+    caido.registrar(8, 50)
+    caido._log.close()
+    segmento = next(tmp_path.glob('puntos-*.log'))
+    segmento.rename(segmento.with_name('puntos-999999999-1.log'))
+
+    # Sigue abierto por su dueño aunque el PID del nombre ya no exista
+    vivo = BufferPuntos(lambda lote: None, intervalo_ms=60_000, carpeta_log=carpeta)
+    vivo.registrar(9, 30)
+    segmento = next(p for p in tmp_path.glob('puntos-*.log') if p.name != 'puntos-999999999-1.log')
+    segmento.rename(segmento.with_name('puntos-999999998-1.log'))
+
+    workers = [BufferPuntos(lambda lote: None, intervalo_ms=60_000, carpeta_log=carpeta) for _ in range(8)]
+    barrera = threading.Barrier(len(workers))
+    recuperados = []
+
+    def arrancar(worker):
+        barrera.wait()
+        recuperados.append(worker.recuperar())
+
+    hilos = [threading.Thread(target=arrancar, args=(w,)) for w in workers]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert sum(recuperados) == 2
+    assert [w.pendiente(9) for w in workers] == [None] * len(workers)
+    assert (tmp_path / 'puntos-999999998-1.log').exists()
+    assert not (tmp_path / 'puntos-999999999-1.log').exists()
@@ -0,0 +1,218 @@
+"""
+NaturIA Chile - Assets estáticos con huella de contenido
+Minifica JS/CSS, optimiza los PNG, copia cada archivo a static/dist con el
+hash de su contenido en el nombre (app.3f2a1b9c0d.js) y guarda variantes
+.gz/.br ya comprimidas. Un manifiesto traduce la ruta original a la final;
+lo usan la plantilla (asset_url) y el service worker generado.
+
+Como el nombre cambia cuando cambia el contenido, los archivos se sirven con
+caché inmutable de un año. Sin compilar (desarrollo) todo sigue saliendo de
+/static como siempre.
+
+Compilar:
+    flask --app app build-assets
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+CARPETA_STATIC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+CARPETA_DIST = os.path.join(CARPETA_STATIC, 'dist')
+NOMBRE_MANIFIESTO = 'assets.json'
+PREFIJO_URL = '/assets/'
+
+# El service worker necesita una URL estable: se reescribe pero no lleva hash
+SERVICE_WORKER = 'sw.js'
+
+COMPRIMIBLES = {'.js', '.css', '.json', '.svg'}
+# Íconos de colores planos: se reducen a paleta de 256 colores (casi sin pérdida visible)
+CARPETAS_PALETA = ('icons/',)
+# Orden de proceso: lo que se referencia (imágenes) antes de lo que referencia
+ORDEN_EXTENSIONES = {'.png': 0, '.svg': 0, '.jpg': 0, '.webp': 0, '.css': 1, '.js': 1, '.json': 2}
+
+
+def minificar_css(texto: str) -> str:
+    try:
+        import rcssmin
+        return rcssmin.cssmin(texto)
+    except ImportError:
+        pass
+    texto = re.sub(r'/\*.*?\*/', '', texto, flags=re.S)
+    texto = re.sub(r'\s+', ' ', texto)
+    # Solo alrededor de llaves, punto y coma y comas: no cambia selectores ni calc()
+    texto = re.sub(r'\s*([{};,])\s*', r'\1', texto)
+    return texto.replace(';}', '}').strip()
+
+
+def minificar_js(texto: str) -> str:
+    try:
+        import rjsmin
+        return rjsmin.jsmin(texto)
+    except ImportError:
+        pass
+    # Sin rjsmin: solo sangría, líneas vacías y comentarios de línea completa
+    lineas = []
+    for linea in texto.splitlines():
+        linea = linea.strip()
+        if linea and not linea.startswith('//'):
+            lineas.append(linea)
+    return '\n'.join(lineas) + '\n'
+
+
+def optimizar_png(ruta: str, paleta: bool = False) -> bytes:
+    """
+    Recomprime un PNG (y lo reduce al tamaño que indica su nombre, p. ej.
+    icon-512.png → 512 px). Con paleta=True lo cuantiza a 256 colores.
+    Retorna el original si no se gana nada.
+    """
+    from PIL import Image
+
+    with open(ruta, 'rb') as f:
+        original = f.read()
+    try:
+        imagen = Image.open(io.BytesIO(original))
+        imagen.load()
+    except OSError:
+        return original
+
+    lado = re.search(r'-(\d+)\.png$', ruta)
+    if lado and max(imagen.size) > int(lado.group(1)):
+        imagen = imagen.resize((int(lado.group(1)),) * 2, Image.LANCZOS)
+    if imagen.mode not in ('RGB', 'RGBA', 'P', 'L', 'LA'):
+        imagen = imagen.convert('RGBA')
+    if paleta and imagen.mode in ('RGB', 'RGBA'):
+        imagen = imagen.quantize(256, method=Image.Quantize.FASTOCTREE)
+
+    salida = io.BytesIO()
+    imagen.save(salida, format='PNG', optimize=True)
+    optimizado = salida.getvalue()
+    return optimizado if len(optimizado) < len(original) else original
+
+
+def comprimir_variantes(ruta: str, contenido: bytes) -> dict:
+    """Escribe ruta.gz y ruta.br (si hay brotli) cuando resultan más pequeñas."""
+    tamanos = {}
+    variantes = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    try:
+        import brotli
+        variantes.append(('.br', lambda d: brotli.compress(d, quality=11)))
+    except ImportError:
+        pass
+    for extension, comprimir in variantes:
+        datos = comprimir(contenido)
+        if len(datos) < len(contenido):
+            with open(ruta + extension, 'wb') as f:
+                f.write(datos)
+            tamanos[extension] = len(datos)
+    return tamanos
+
+
+def reescribir_referencias(texto: str, archivos: dict) -> str:
+    """Cambia '/static/<ruta>' por la URL con huella de cada archivo ya procesado."""
+    for original, final in archivos.items():
+        texto = texto.replace(f'/static/{original}', PREFIJO_URL + final)
+    return texto
+
+
+def nombre_con_huella(ruta: str, contenido: bytes) -> str:
+    base, extension = os.path.splitext(ruta)
+    return f'{base}.{hashlib.sha256(contenido).hexdigest()[:10]}{extension}'
+
+
+def construir_assets(origen: str = CARPETA_STATIC, destino: str = CARPETA_DIST) -> dict:
+    """
+    Compila los assets de `origen` en `destino` y escribe el manifiesto.
+    Retorna el manifiesto con el detalle de tamaños por archivo.
+    """
+    if os.path.isdir(destino):
+        shutil.rmtree(destino)
+    os.makedirs(destino)
+
+    rutas = []
+    for carpeta, subcarpetas, nombres in os.walk(origen):
+        if os.path.abspath(carpeta).startswith(os.path.abspath(destino)):
+            continue
+        for nombre in nombres:
+            relativa = os.path.relpath(os.path.join(carpeta, nombre), origen).replace(os.sep, '/')
+            extension = os.path.splitext(nombre)[1].lower()
+            if extension in ORDEN_EXTENSIONES and relativa != SERVICE_WORKER:
+                rutas.append(relativa)
+    rutas.sort(key=lambda r: (ORDEN_EXTENSIONES[os.path.splitext(r)[1].lower()], r))
+
+    archivos, tamanos = {}, {}
+    for relativa in rutas:
+        ruta = os.path.join(origen, relativa)
+        extension = os.path.splitext(relativa)[1].lower()
+        if extension == '.png':
+            contenido = optimizar_png(ruta, paleta=relativa.startswith(CARPETAS_PALETA))
+        elif extension in COMPRIMIBLES:
+            with open(ruta, encoding='utf-8') as f:
+                texto = reescribir_referencias(f.read(), archivos)
+            if extension == '.css':
+                texto = minificar_css(texto)
+            elif extension == '.js':
+                texto = minificar_js(texto)
+            elif extension == '.json':
+                texto = json.dumps(json.loads(texto), ensure_ascii=False, separators=(',', ':'))
+            contenido = texto.encode('utf-8')
+        else:
+            with open(ruta, 'rb') as f:
+                contenido = f.read()
+
+        final = nombre_con_huella(relativa, contenido)
+        ruta_final = os.path.join(destino, final)
+        os.makedirs(os.path.dirname(ruta_final), exist_ok=True)
+        with open(ruta_final, 'wb') as f:
+            f.write(contenido)
+        archivos[relativa] = final
+        tamanos[relativa] = {'original': os.path.getsize(ruta), 'final': len(contenido)}
+        if extension in COMPRIMIBLES:
+            tamanos[relativa].update(comprimir_variantes(ruta_final, contenido))
+
+    # La versión cambia si cambia cualquier archivo: nombra la caché del service worker
+    version = hashlib.sha256(json.dumps(archivos, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+    ruta_sw = os.path.join(origen, SERVICE_WORKER)
+    if os.path.exists(ruta_sw):
+        with open(ruta_sw, encoding='utf-8') as f:
+            sw = reescribir_referencias(f.read(), archivos)
+        sw = re.sub(r"const CACHE_NAME = '[^']*';", f"const CACHE_NAME = 'naturia-chile-{version}';", sw, count=1)
+        with open(os.path.join(destino, SERVICE_WORKER), 'w', encoding='utf-8') as f:
+            f.write(sw)
+
+    manifiesto = {'version': version, 'archivos': archivos, 'tamanos': tamanos}
+    with open(os.path.join(destino, NOMBRE_MANIFIESTO), 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f, indent=2, sort_keys=True)
+    return manifiesto
+
+
+class ManifiestoAssets:
+    """Traduce rutas de static/ a sus URLs con huella, si hay assets compilados."""
+
+    def __init__(self, carpeta: str = CARPETA_DIST):
+        self.carpeta = carpeta
+        self.cargar()
+
+    def cargar(self):
+        try:
+            with open(os.path.join(self.carpeta, NOMBRE_MANIFIESTO), encoding='utf-8') as f:
+                manifiesto = json.load(f)
+        except (OSError, ValueError):
+            manifiesto = {}
+        self.version = manifiesto.get('version')
+        self.archivos = manifiesto.get('archivos', {})
+        self.publicados = set(self.archivos.values())
+
+    def url(self, ruta: str):
+        """URL con huella de un archivo de static/, o None si no está compilado."""
+        final = self.archivos.get(ruta)
+        return PREFIJO_URL + final if final else None
+
+    def ruta_service_worker(self):
+        """Service worker generado por la compilación, o None."""
+        ruta = os.path.join(self.carpeta, SERVICE_WORKER)
+        return ruta if self.version and os.path.exists(ruta) else None
@@ -0,0 +1,188 @@
+"""
+NaturIA Chile - Autocompletado de nombres de especies
+Sugiere especies conocidas mientras se escribe (o tras el dictado por voz),
+para que el usuario elija un nombre que ya está en la caché de búsquedas en
+vez de mandar a Gemini una consulta a medias o mal escrita.
+
+- Prefijo: una lista ordenada de claves normalizadas (sin tildes, en
+  minúsculas) por cada palabra del nombre común y del científico; bisect
+  encuentra el rango del prefijo, como un trie pero en un arreglo compacto.
+  'rosea' encuentra 'Lapageria rosea' y 'chin' encuentra 'Chinita'.
+- Aproximada: si el prefijo no alcanza, trigramas con índice invertido y
+  coeficiente de Dice ('copiue' -> 'Copihue', 'chincoll' -> 'Chincol').
+
+Las fuentes (catálogo, AVES_CHILE, especies de Discovery y de la caché de
+búsquedas) las entrega la app; el índice se reconstruye en segundo plano cada
+AUTOCOMPLETAR_RECARGA_SEGUNDOS y mientras tanto aprende lo que devuelve Gemini.
+"""
+
+import bisect
+import os
+import re
+import threading
+import time
+import unicodedata
+
+AUTOCOMPLETAR_RECARGA_SEGUNDOS = float(os.getenv('AUTOCOMPLETAR_RECARGA_SEGUNDOS', 300))
+AUTOCOMPLETAR_SIMILITUD_MINIMA = float(os.getenv('AUTOCOMPLETAR_SIMILITUD_MINIMA', 0.35))
+
+
+def normalizar_nombre(texto: str) -> str:
+    """'  Picaflor de Juan Fernández ' -> 'picaflor de juan fernandez'."""
+    sin_tildes = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', ' ', sin_tildes.lower()).strip()
+
+
+def trigramas(texto: str) -> set:
+    relleno = f'  {texto} '
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+
+class Especie:
+    __slots__ = ('nombre', 'cientifico', 'tipo', 'popularidad', 'normalizado')
+
+    def __init__(self, nombre, cientifico, tipo, popularidad):
+        self.nombre = nombre
+        self.cientifico = cientifico
+        self.tipo = tipo
+        self.popularidad = popularidad
+        self.normalizado = normalizar_nombre(nombre)
+
+    def a_dict(self, coincidencia: str) -> dict:
+        return {'nombre': self.nombre, 'cientifico': self.cientifico, 'tipo': self.tipo,
+                'coincidencia': coincidencia}
+
+
+class Indice:
+    """Índice inmutable: se construye completo y se reemplaza de una vez."""
+
+    def __init__(self, especies: list):
+        self.especies = especies
+        claves = []
+        # Cada nombre (común o científico) con su especie y cuántos trigramas tiene
+        self.textos = []
+        self.por_trigrama = {}
+        for posicion, especie in enumerate(especies):
+            for texto in {especie.normalizado, normalizar_nombre(especie.cientifico or '')} - {''}:
+                palabras = texto.split()
+                # Cada sufijo de palabras: 'de juan fernandez', 'juan fernandez', 'fernandez'
+                for i in range(len(palabras)):
+                    claves.append((' '.join(palabras[i:]), i, posicion))
+                suyos = trigramas(texto)
+                for trigrama in suyos:
+                    self.por_trigrama.setdefault(trigrama, []).append(len(self.textos))
+                self.textos.append((posicion, len(suyos)))
+        claves.sort()
+        self.claves = [clave for clave, _, _ in claves]
+        self.entradas = [(palabra, posicion) for _, palabra, posicion in claves]
+
+    def por_prefijo(self, prefijo: str):
+        """(especie, palabra donde coincidió) de las claves que empiezan con `prefijo`."""
+        inicio = bisect.bisect_left(self.claves, prefijo)
+        fin = bisect.bisect_right(self.claves, prefijo + '\uffff')
+        for palabra, posicion in self.entradas[inicio:fin]:
+            yield self.especies[posicion], palabra
+
+    def aproximadas(self, consulta: str, minimo: float):
+        """(especie, similitud) por coeficiente de Dice de trigramas."""
+        buscados = trigramas(consulta)
+        comunes = {}
+        for trigrama in buscados:
+            for texto in self.por_trigrama.get(trigrama, ()):
+                comunes[texto] = comunes.get(texto, 0) + 1
+        mejores = {}
+        for texto, n in comunes.items():
+            posicion, total = self.textos[texto]
+            similitud = 2 * n / (len(buscados) + total)
+            if similitud >= minimo and similitud > mejores.get(posicion, 0):
+                mejores[posicion] = similitud
+        for posicion, similitud in mejores.items():
+            yield self.especies[posicion], similitud
+
+
+class Autocompletado:
+    """Sugerencias por prefijo y aproximadas sobre los nombres de especies conocidas."""
+
+    def __init__(self, fuentes=None, recarga: float = AUTOCOMPLETAR_RECARGA_SEGUNDOS,
+                 similitud_minima: float = AUTOCOMPLETAR_SIMILITUD_MINIMA):
+        # fuentes() -> iterable de (nombre, cientifico, tipo, popularidad)
+        self.fuentes = fuentes
+        self.recarga = recarga
+        self.similitud_minima = similitud_minima
+        self._indice = None
+        self._construido = 0.0
+        self._reconstruyendo = False
+        self._aprendidas = {}
+        self._lock = threading.Lock()
+
+    def construir(self):
+        """Reconstruye el índice desde las fuentes (más lo aprendido)."""
+        especies = {}
+        for nombre, cientifico, tipo, popularidad in list(self.fuentes() if self.fuentes else []) + \
+                list(self._aprendidas.values()):
+            if not nombre:
+                continue
+            clave = (normalizar_nombre(nombre), tipo)
+            actual = especies.get(clave)
+            if actual is None:
+                especies[clave] = Especie(nombre.strip(), (cientifico or '').strip() or None, tipo, popularidad)
+            else:
+                actual.popularidad += popularidad
+                actual.cientifico = actual.cientifico or (cientifico or '').strip() or None
+        self._indice = Indice(list(especies.values()))
+        self._construido = time.monotonic()
+
+    def _reconstruir_en_fondo(self):
+        try:
+            self.construir()
+        except Exception as e:
+            print(f"⚠️  Error reconstruyendo el autocompletado: {e}")
+        finally:
+            self._reconstruyendo = False
+
+    def _asegurar_indice(self):
+        if self._indice is None:
+            with self._lock:
+                if self._indice is None:
+                    self.construir()
+        elif self.recarga > 0 and time.monotonic() - self._construido > self.recarga and not self._reconstruyendo:
+            with self._lock:
+                if self._reconstruyendo:
+                    return self._indice
+                self._reconstruyendo = True
+            # Mientras tanto se sigue respondiendo con el índice anterior
+            threading.Thread(target=self._reconstruir_en_fondo, name='autocompletar', daemon=True).start()
+        return self._indice
+
+    def aprender(self, nombre: str, cientifico: str, tipo: str):
+        """Agrega una especie devuelta por Gemini; entra al índice en la próxima reconstrucción."""
+        if nombre:
+            clave = (normalizar_nombre(nombre), tipo)
+            if clave not in self._aprendidas:
+                self._aprendidas[clave] = (nombre, cientifico, tipo, 1)
+                # Se adelanta la reconstrucción para que aparezca pronto
+                self._construido = min(self._construido, time.monotonic() - self.recarga + 5)
+
+    def sugerir(self, consulta: str, tipo: str = None, limite: int = 8) -> list:
+        consulta = normalizar_nombre(consulta)
+        if not consulta:
+            return []
+        indice = self._asegurar_indice()
+
+        # Prefijo: primero las que empiezan por el nombre, luego las más populares y cortas
+        mejores = {}
+        for especie, palabra in indice.por_prefijo(consulta):
+            if tipo and especie.tipo != tipo:
+                continue
+            orden = (palabra > 0, -especie.popularidad, len(especie.nombre), especie.normalizado)
+            if id(especie) not in mejores or orden < mejores[id(especie)][0]:
+                mejores[id(especie)] = (orden, especie)
+        sugerencias = [especie.a_dict('prefijo') for _, especie in sorted(mejores.values(), key=lambda x: x[0])]
+
+        if len(sugerencias) < limite and len(consulta) >= 3:
+            vistas = set(mejores)
+            aproximadas = [(-similitud, -especie.popularidad, especie.normalizado, especie)
+                           for especie, similitud in indice.aproximadas(consulta, self.similitud_minima)
+                           if id(especie) not in vistas and (not tipo or especie.tipo == tipo)]
+            sugerencias += [e.a_dict('aproximada') for *_, e in sorted(aproximadas, key=lambda x: x[:3])]
+        return sugerencias[:limite]
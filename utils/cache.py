@@ -0,0 +1,240 @@
+"""
+NaturIA Chile - Almacenes de caché intercambiables
+Las cachés de utils/enriquecimiento.py (búsquedas de Gemini, imágenes y
+sonidos) guardan sus registros en uno de estos almacenes, elegido con
+CACHE_BACKEND:
+
+- memoria: LRU por proceso (por defecto). Cada worker de gunicorn tiene su copia.
+- sqlite:  un archivo compartido por todos los workers de la máquina
+           (CACHE_SQLITE_RUTA), en modo WAL.
+- redis:   cualquier servidor que hable el protocolo de Redis (CACHE_REDIS_URL,
+           o REDIS_URL), compartido entre máquinas. Requiere el paquete redis.
+
+Todos tienen la misma interfaz: espacios de nombres ('imagenes', 'sonidos'...),
+TTL por registro, tope de registros por espacio (se descartan los menos
+usados) y registros serializados como JSON.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memoria')
+CACHE_SQLITE_RUTA = os.getenv('CACHE_SQLITE_RUTA')
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL')
+
+
+class AlmacenMemoria:
+    """LRU en memoria del proceso, un OrderedDict por espacio."""
+
+    nombre = 'memoria'
+    # Sin E/S: se puede consultar desde el event loop sin pasar por un hilo
+    bloqueante = False
+
+    def __init__(self):
+        self._espacios = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, espacio: str, clave: str):
+        with self._lock:
+            datos = self._espacios.get(espacio)
+            fila = datos.get(clave) if datos else None
+            if fila is None:
+                return None
+            if fila[1] <= time.time():
+                del datos[clave]
+                return None
+            datos.move_to_end(clave)
+        return json.loads(fila[0])
+
+    def guardar(self, espacio: str, clave: str, registro: dict, ttl: float, maximo: int):
+        fila = (json.dumps(registro, ensure_ascii=False), time.time() + ttl)
+        with self._lock:
+            datos = self._espacios.setdefault(espacio, OrderedDict())
+            datos[clave] = fila
+            datos.move_to_end(clave)
+            while len(datos) > maximo:
+                datos.popitem(last=False)
+
+    def borrar(self, espacio: str, clave: str):
+        with self._lock:
+            self._espacios.get(espacio, {}).pop(clave, None)
+
+    def registros(self, espacio: str) -> list:
+        ahora = time.time()
+        with self._lock:
+            filas = list(self._espacios.get(espacio, {}).items())
+        return [(clave, json.loads(texto)) for clave, (texto, expira) in filas if expira > ahora]
+
+    def tamano(self, espacio: str) -> int:
+        with self._lock:
+            return len(self._espacios.get(espacio, {}))
+
+    def limpiar(self, espacio: str):
+        with self._lock:
+            self._espacios.pop(espacio, None)
+
+
+class AlmacenSQLite:
+    """
+    Tabla en un archivo SQLite compartido entre procesos. Una conexión por
+    hilo; la última lectura de cada registro se anota como mucho una vez
+    por minuto (para descartar los menos usados sin escribir en cada lectura).
+    """
+
+    nombre = 'sqlite'
+    bloqueante = True
+    # Cada cuántas escrituras se aplica el tope y se borran los vencidos
+    REVISAR_TOPE_CADA = 50
+    TOQUE_SEGUNDOS = 60
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._escrituras = 0
+        os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+        self._conexion().executescript('''
+            CREATE TABLE IF NOT EXISTS cache (
+                espacio TEXT NOT NULL,
+                clave TEXT NOT NULL,
+                registro TEXT NOT NULL,
+                expira REAL NOT NULL,
+                usado REAL NOT NULL,
+                PRIMARY KEY (espacio, clave)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_cache_usado ON cache (espacio, usado);
+        ''')
+
+    def _conexion(self):
+        # Una conexión heredada de otro proceso (fork) no se reutiliza
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            conexion.execute('PRAGMA journal_mode=WAL')
+            conexion.execute('PRAGMA synchronous=NORMAL')
+            self._local.conexion, self._local.pid = conexion, os.getpid()
+        return self._local.conexion
+
+    def obtener(self, espacio: str, clave: str):
+        conexion = self._conexion()
+        fila = conexion.execute('SELECT registro, expira, usado FROM cache WHERE espacio = ? AND clave = ?',
+                                (espacio, clave)).fetchone()
+        if fila is None:
+            return None
+        ahora = time.time()
+        if fila[1] <= ahora:
+            return None
+        if ahora - fila[2] > self.TOQUE_SEGUNDOS:
+            conexion.execute('UPDATE cache SET usado = ? WHERE espacio = ? AND clave = ?', (ahora, espacio, clave))
+        return json.loads(fila[0])
+
+    def guardar(self, espacio: str, clave: str, registro: dict, ttl: float, maximo: int):
+        ahora = time.time()
+        conexion = self._conexion()
+        conexion.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                         (espacio, clave, json.dumps(registro, ensure_ascii=False), ahora + ttl, ahora))
+        self._escrituras += 1
+        if self._escrituras % self.REVISAR_TOPE_CADA == 0:
+            with conexion:
+                conexion.execute('DELETE FROM cache WHERE expira <= ?', (ahora,))
+                conexion.execute('''DELETE FROM cache WHERE espacio = ? AND clave IN (
+                                        SELECT clave FROM cache WHERE espacio = ? ORDER BY usado
+                                        LIMIT max(0, (SELECT count(*) FROM cache WHERE espacio = ?) - ?))''',
+                                 (espacio, espacio, espacio, maximo))
+
+    def borrar(self, espacio: str, clave: str):
+        self._conexion().execute('DELETE FROM cache WHERE espacio = ? AND clave = ?', (espacio, clave))
+
+    def registros(self, espacio: str) -> list:
+        filas = self._conexion().execute('SELECT clave, registro FROM cache WHERE espacio = ? AND expira > ?',
+                                         (espacio, time.time()))
+        return [(clave, json.loads(texto)) for clave, texto in filas]
+
+    def tamano(self, espacio: str) -> int:
+        return self._conexion().execute('SELECT count(*) FROM cache WHERE espacio = ?', (espacio,)).fetchone()[0]
+
+    def limpiar(self, espacio: str):
+        self._conexion().execute('DELETE FROM cache WHERE espacio = ?', (espacio,))
+
+
+class AlmacenRedis:
+    """
+    Un string con EX por registro y un sorted set por espacio con el último
+    uso (lectura o escritura) de cada clave, para descartar los menos usados
+    sin recorrer todo el servidor. La lectura y su anotación van en un solo
+    viaje al servidor.
+    """
+
+    nombre = 'redis'
+    bloqueante = True
+    PREFIJO = 'naturia:cache:'
+
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def _clave(self, espacio, clave):
+        return f'{self.PREFIJO}{espacio}:{clave}'
+
+    def _indice(self, espacio):
+        return f'{self.PREFIJO}{espacio}'
+
+    def obtener(self, espacio: str, clave: str):
+        pipe = self.cliente.pipeline()
+        pipe.get(self._clave(espacio, clave))
+        # xx: solo se anota una clave que sigue en el índice (no revive las descartadas)
+        pipe.zadd(self._indice(espacio), {clave: time.time()}, xx=True)
+        texto = pipe.execute()[0]
+        return json.loads(texto) if texto is not None else None
+
+    def guardar(self, espacio: str, clave: str, registro: dict, ttl: float, maximo: int):
+        pipe = self.cliente.pipeline()
+        pipe.set(self._clave(espacio, clave), json.dumps(registro, ensure_ascii=False), ex=max(1, int(ttl)))
+        pipe.zadd(self._indice(espacio), {clave: time.time()})
+        pipe.zcard(self._indice(espacio))
+        sobrantes = pipe.execute()[-1] - maximo
+        if sobrantes > 0:
+            viejas = [clave for clave, _ in self.cliente.zpopmin(self._indice(espacio), sobrantes)]
+            self.cliente.delete(*[self._clave(espacio, c) for c in viejas])
+
+    def borrar(self, espacio: str, clave: str):
+        pipe = self.cliente.pipeline()
+        pipe.delete(self._clave(espacio, clave))
+        pipe.zrem(self._indice(espacio), clave)
+        pipe.execute()
+
+    def registros(self, espacio: str) -> list:
+        claves = self.cliente.zrange(self._indice(espacio), 0, -1)
+        if not claves:
+            return []
+        textos = self.cliente.mget([self._clave(espacio, c) for c in claves])
+        vencidas = [c for c, texto in zip(claves, textos) if texto is None]
+        if vencidas:
+            self.cliente.zrem(self._indice(espacio), *vencidas)
+        return [(c, json.loads(texto)) for c, texto in zip(claves, textos) if texto is not None]
+
+    def tamano(self, espacio: str) -> int:
+        return self.cliente.zcard(self._indice(espacio))
+
+    def limpiar(self, espacio: str):
+        claves = self.cliente.zrange(self._indice(espacio), 0, -1)
+        self.cliente.delete(self._indice(espacio), *[self._clave(espacio, c) for c in claves])
+
+
+def crear_almacen(backend: str = CACHE_BACKEND, ruta_sqlite: str = CACHE_SQLITE_RUTA, redis_url: str = None):
+    """Crea el almacén pedido; si Redis no está disponible, usa la memoria del proceso."""
+    if backend == 'sqlite':
+        return AlmacenSQLite(ruta_sqlite or 'cache.sqlite3')
+    if backend == 'redis':
+        try:
+            import redis
+            cliente = redis.Redis.from_url(redis_url or CACHE_REDIS_URL or os.getenv('REDIS_URL'),
+                                           decode_responses=True)
+            cliente.ping()
+            return AlmacenRedis(cliente)
+        except Exception as e:
+            print(f"⚠️  Caché sin Redis ({e}), usando memoria del proceso")
+    elif backend != 'memoria':
+        print(f"⚠️  CACHE_BACKEND desconocido: {backend}, usando memoria del proceso")
+    return AlmacenMemoria()
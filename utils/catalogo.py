@@ -0,0 +1,141 @@
+"""
+NaturIA Chile - Catálogo de especies
+Carga data/especies_chile.json una vez, construye índices (por id, por tipo y
+un índice invertido región → especies) y guarda las respuestas JSON ya
+serializadas y comprimidas con gzip, listas para enviarse con su ETag.
+El archivo se recarga solo cuando cambia en disco.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+RUTA_DATOS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'data', 'especies_chile.json')
+
+# Cada cuánto (segundos) se revisa si el archivo cambió en disco
+CATALOGO_REVISION_SEGUNDOS = float(os.getenv('CATALOGO_REVISION_SEGUNDOS', 2))
+
+
+def normalizar_region(nombre: str) -> str:
+    """'La Araucanía' -> 'la-araucania', "O'Higgins" -> 'ohiggins'."""
+    sin_tildes = unicodedata.normalize('NFKD', nombre).encode('ascii', 'ignore').decode('ascii')
+    sin_tildes = sin_tildes.lower().replace("'", '')
+    return re.sub(r'[^a-z0-9]+', '-', sin_tildes).strip('-')
+
+
+class RespuestaPrecalculada:
+    """Cuerpo JSON serializado una sola vez, con su variante gzip y ETag."""
+
+    def __init__(self, datos):
+        self.cuerpo = json.dumps(datos, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.cuerpo_gzip = gzip.compress(self.cuerpo, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(self.cuerpo).hexdigest()[:32]
+
+
+class CatalogoEspecies:
+    """Índices en memoria sobre el archivo de especies, con recarga en caliente."""
+
+    def __init__(self, ruta: str = RUTA_DATOS, intervalo_revision: float = CATALOGO_REVISION_SEGUNDOS):
+        self.ruta = ruta
+        self.intervalo_revision = intervalo_revision
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._ultima_revision = 0.0
+        self._cargar()
+
+    def _cargar(self):
+        mtime = os.stat(self.ruta).st_mtime_ns
+        with open(self.ruta, encoding='utf-8') as f:
+            datos = json.load(f)
+
+        especies = datos.get('especies', [])
+        regiones = datos.get('regiones_chile', [])
+        nombres_region = {normalizar_region(r): r for r in regiones}
+
+        por_id = {e['id']: e for e in especies}
+        por_tipo = {}
+        por_region = {slug: [] for slug in nombres_region}
+        for especie in especies:
+            por_tipo.setdefault(especie['tipo'], []).append(especie)
+            for region in especie.get('regiones', []):
+                slug = normalizar_region(region)
+                nombres_region.setdefault(slug, region)
+                por_region.setdefault(slug, []).append(especie)
+
+        # Todas las respuestas posibles se serializan aquí, no en cada petición
+        respuestas = {
+            ('especies', None): RespuestaPrecalculada({
+                'especies': especies, 'total': len(especies), 'regiones': regiones
+            })
+        }
+        for tipo, lista in por_tipo.items():
+            respuestas[('especies', tipo)] = RespuestaPrecalculada({'especies': lista, 'total': len(lista)})
+        for slug, lista in por_region.items():
+            cabecera = {'region': nombres_region[slug], 'slug': slug}
+            respuestas[('region', slug, None)] = RespuestaPrecalculada(
+                {**cabecera, 'especies': lista, 'total': len(lista)})
+            # Para un tipo que no existe en el catálogo
+            respuestas[('region_vacia', slug)] = RespuestaPrecalculada({**cabecera, 'especies': [], 'total': 0})
+            for tipo in por_tipo:
+                filtradas = [e for e in lista if e['tipo'] == tipo]
+                respuestas[('region', slug, tipo)] = RespuestaPrecalculada(
+                    {**cabecera, 'especies': filtradas, 'total': len(filtradas)})
+        for especie_id, especie in por_id.items():
+            respuestas[('especie', especie_id)] = RespuestaPrecalculada(especie)
+
+        # Un solo reemplazo de referencia: los lectores nunca ven índices a medias
+        self.por_id = por_id
+        self.por_tipo = por_tipo
+        self.por_region = por_region
+        self.nombres_region = nombres_region
+        self._respuestas = respuestas
+        self._vacia = RespuestaPrecalculada({'especies': [], 'total': 0})
+        self._mtime = mtime
+
+    def _revisar(self):
+        """Recarga el archivo si cambió (como máximo una revisión por intervalo)."""
+        ahora = time.monotonic()
+        if ahora - self._ultima_revision < self.intervalo_revision:
+            return
+        with self._lock:
+            if ahora - self._ultima_revision < self.intervalo_revision:
+                return
+            self._ultima_revision = ahora
+            try:
+                if os.stat(self.ruta).st_mtime_ns != self._mtime:
+                    self._cargar()
+            except (OSError, ValueError) as e:
+                # Archivo a medio escribir o inválido: se mantiene la versión anterior
+                print(f"Error recargando catálogo de especies: {e}")
+
+    def nombre_region(self, region: str) -> str:
+        """Nombre oficial de una región a partir de su nombre o slug, o None."""
+        return self.nombres_region.get(normalizar_region(region))
+
+    def especies(self, tipo: str = None) -> RespuestaPrecalculada:
+        self._revisar()
+        return self._respuestas.get(('especies', tipo), self._vacia)
+
+    def especies_region(self, region: str, tipo: str = None) -> RespuestaPrecalculada:
+        """
+        Respuesta para una región (nombre o slug), o None si no existe. Un tipo
+        desconocido da la lista vacía con el nombre oficial de la región: nada
+        de lo que llega en la URL se copia a la respuesta.
+        """
+        self._revisar()
+        respuestas = self._respuestas
+        slug = normalizar_region(region)
+        if ('region', slug, None) not in respuestas:
+            return None
+        tipo = tipo.strip().lower() or None if tipo else None
+        return respuestas.get(('region', slug, tipo)) or respuestas[('region_vacia', slug)]
+
+    def especie(self, especie_id: str) -> RespuestaPrecalculada:
+        self._revisar()
+        return self._respuestas.get(('especie', especie_id))
@@ -0,0 +1,194 @@
+"""
+NaturIA Chile - Coalescencia de llamadas idénticas (single-flight)
+Cuando 30 niños buscan "copihue" a la vez, solo la primera llamada va a
+Gemini/Wikipedia/Xeno-Canto; las demás con la misma clave esperan esa
+llamada en curso y reciben una copia de su resultado.
+
+- Entre hilos de un worker: siempre.
+- Entre workers (procesos): opcional con COALESCENCIA_DIR. El primero toma
+  un lock de archivo (fcntl) por clave y deja el resultado en JSON; los que
+  esperaban ese lock lo leen si tiene menos de COALESCENCIA_VENTANA_SEGUNDOS.
+- Las versiones async (modo ASGI) coalescen dentro del event loop.
+"""
+
+import asyncio
+import copy
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin coordinación entre procesos
+    fcntl = None
+
+COALESCENCIA_DIR = os.getenv('COALESCENCIA_DIR')
+COALESCENCIA_VENTANA_SEGUNDOS = float(os.getenv('COALESCENCIA_VENTANA_SEGUNDOS', 5))
+
+
+def normalizar_argumento(valor):
+    if isinstance(valor, str):
+        return re.sub(r'\s+', ' ', valor.strip().lower())
+    return valor
+
+
+def clave_llamada(nombre: str, args: tuple, kwargs: dict) -> str:
+    """'buscar_por_texto:["copihue","planta"]' (mayúsculas y espacios no cuentan)."""
+    partes = [normalizar_argumento(a) for a in args]
+    if kwargs:
+        partes.append({k: normalizar_argumento(v) for k, v in sorted(kwargs.items())})
+    return f'{nombre}:{json.dumps(partes, ensure_ascii=False, default=str)}'
+
+
+class _Llamada:
+    def __init__(self):
+        self.listo = threading.Event()
+        self.resultado = None
+        self.error = None
+        self.esperando = 0
+
+
+class VueloUnico:
+    """Registro de llamadas en curso por clave, con métricas de coalescencia."""
+
+    def __init__(self, directorio: str = COALESCENCIA_DIR, ventana: float = COALESCENCIA_VENTANA_SEGUNDOS):
+        self.directorio = directorio if fcntl else None
+        self.ventana = ventana
+        self._lock = threading.Lock()
+        self._en_curso = {}
+        self._en_curso_async = {}
+        self._metricas = {}
+
+    def _contar(self, nombre, campo):
+        with self._lock:
+            contadores = self._metricas.setdefault(
+                nombre, {'llamadas': 0, 'ejecutadas': 0, 'coalescidas': 0, 'coalescidas_entre_procesos': 0})
+            contadores[campo] += 1
+
+    def metricas(self) -> dict:
+        with self._lock:
+            por_funcion = {n: dict(c) for n, c in self._metricas.items()}
+        totales = {campo: sum(c[campo] for c in por_funcion.values())
+                   for campo in ('llamadas', 'ejecutadas', 'coalescidas', 'coalescidas_entre_procesos')}
+        return {**totales, 'por_funcion': por_funcion}
+
+    def reiniciar_metricas(self):
+        with self._lock:
+            self._metricas = {}
+
+    def hacer(self, nombre: str, clave: str, funcion):
+        """Ejecuta funcion() una sola vez por clave entre los hilos que llegan mientras está en curso."""
+        self._contar(nombre, 'llamadas')
+        with self._lock:
+            llamada = self._en_curso.get(clave)
+            lider = llamada is None
+            if lider:
+                llamada = self._en_curso[clave] = _Llamada()
+            else:
+                llamada.esperando += 1
+
+        if not lider:
+            llamada.listo.wait()
+            self._contar(nombre, 'coalescidas')
+            if llamada.error is not None:
+                raise llamada.error
+            return copy.deepcopy(llamada.resultado)
+
+        resultado = None
+        try:
+            resultado = self._ejecutar(nombre, clave, funcion)
+            return resultado
+        except Exception as e:
+            llamada.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._en_curso[clave]
+                # Quien llamó primero puede modificar su resultado (p. ej. agregar
+                # imagen_url); los que esperaban copian de una instantánea aparte
+                if llamada.esperando:
+                    llamada.resultado = copy.deepcopy(resultado)
+            llamada.listo.set()
+
+    def _ejecutar(self, nombre, clave, funcion):
+        if not self.directorio:
+            self._contar(nombre, 'ejecutadas')
+            return funcion()
+
+        os.makedirs(self.directorio, exist_ok=True)
+        base = os.path.join(self.directorio, hashlib.sha256(clave.encode('utf-8')).hexdigest()[:32])
+        with open(base + '.lock', 'a') as archivo_lock:
+            # Bloquea mientras otro worker resuelve la misma clave
+            fcntl.flock(archivo_lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    if time.time() - os.path.getmtime(base + '.json') < self.ventana:
+                        with open(base + '.json', encoding='utf-8') as f:
+                            resultado = json.load(f)
+                        self._contar(nombre, 'coalescidas_entre_procesos')
+                        return resultado
+                except (OSError, ValueError):
+                    pass
+                self._contar(nombre, 'ejecutadas')
+                resultado = funcion()
+                try:
+                    temporal = f'{base}.{os.getpid()}.tmp'
+                    with open(temporal, 'w', encoding='utf-8') as f:
+                        json.dump(resultado, f, ensure_ascii=False)
+                    os.replace(temporal, base + '.json')
+                except (OSError, TypeError) as e:
+                    print(f"⚠️  No se pudo compartir el resultado de {nombre}: {e}")
+                return resultado
+            finally:
+                fcntl.flock(archivo_lock, fcntl.LOCK_UN)
+
+    async def hacer_async(self, nombre: str, clave: str, corrutina):
+        """Versión para el event loop: los que llegan esperan el mismo Future."""
+        self._contar(nombre, 'llamadas')
+        loop = asyncio.get_running_loop()
+        clave_loop = (id(loop), clave)
+        en_curso = self._en_curso_async.get(clave_loop)
+        if en_curso is not None:
+            en_curso[1] += 1
+            resultado = await asyncio.shield(en_curso[0])
+            self._contar(nombre, 'coalescidas')
+            return copy.deepcopy(resultado)
+
+        futuro = loop.create_future()
+        en_curso = self._en_curso_async[clave_loop] = [futuro, 0]
+        try:
+            self._contar(nombre, 'ejecutadas')
+            resultado = await corrutina()
+            futuro.set_result(copy.deepcopy(resultado) if en_curso[1] else resultado)
+            return resultado
+        except BaseException as e:
+            futuro.set_exception(e)
+            # Si nadie esperaba, que el Future no avise "exception was never retrieved"
+            futuro.exception()
+            raise
+        finally:
+            del self._en_curso_async[clave_loop]
+
+
+vuelo_unico = VueloUnico()
+
+
+def coalescido(funcion):
+    """Decorador: las llamadas concurrentes con los mismos argumentos comparten una ejecución."""
+    nombre = funcion.__name__
+
+    if asyncio.iscoroutinefunction(funcion):
+        @functools.wraps(funcion)
+        async def envoltura_async(*args, **kwargs):
+            return await vuelo_unico.hacer_async(nombre, clave_llamada(nombre, args, kwargs),
+                                                 lambda: funcion(*args, **kwargs))
+        return envoltura_async
+
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        return vuelo_unico.hacer(nombre, clave_llamada(nombre, args, kwargs), lambda: funcion(*args, **kwargs))
+    return envoltura
@@ -0,0 +1,127 @@
+"""
+NaturIA Chile - Configuración del motor de base de datos
+Ajustes de SQLite (WAL, synchronous, busy timeout, mmap) y del pool de
+conexiones de Postgres, configurables por variables de entorno, y la
+migración que completa bases creadas con versiones anteriores del modelo.
+"""
+
+import os
+import sqlite3
+from sqlalchemy import UniqueConstraint, event
+from sqlalchemy.engine import Engine
+
+
+def _env_bool(nombre: str, defecto: bool) -> bool:
+    return os.getenv(nombre, str(defecto)).lower() in ('1', 'true', 'yes', 'si', 'sí')
+
+
+# SQLite
+SQLITE_WAL = _env_bool('SQLITE_WAL', True)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_MMAP_BYTES = int(os.getenv('SQLITE_MMAP_BYTES', 64 * 1024 * 1024))
+
+# Postgres (u otro motor con pool)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = _env_bool('DB_POOL_PRE_PING', True)
+
+
+def normalizar_url(url: str) -> str:
+    """Heroku/Render entregan 'postgres://', que SQLAlchemy ya no acepta."""
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+def opciones_motor(url: str) -> dict:
+    """Opciones para create_engine (SQLALCHEMY_ENGINE_OPTIONS) según el motor."""
+    if url.startswith('sqlite'):
+        # El timeout del driver cubre la espera antes de que se apliquen los PRAGMA
+        return {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+def aplicar_pragmas_sqlite(dbapi_connection, wal: bool = None):
+    """
+    Ajusta una conexión SQLite recién abierta.
+    WAL permite lectores concurrentes con un escritor y synchronous=NORMAL
+    evita un fsync por commit (sigue siendo seguro ante caídas del proceso).
+    """
+    wal = SQLITE_WAL if wal is None else wal
+    cursor = dbapi_connection.cursor()
+    try:
+        if wal:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute(f"PRAGMA mmap_size={int(SQLITE_MMAP_BYTES)}")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, 'connect')
+def _al_conectar(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        aplicar_pragmas_sqlite(dbapi_connection)
+
+
+def configurar_base_de_datos(app, url_defecto: str = 'sqlite:///naturia.db'):
+    """Fija la URL y las opciones del motor en la configuración de Flask."""
+    url = normalizar_url(os.getenv('DATABASE_URL', url_defecto))
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opciones_motor(url)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+
+def _ddl_columna(columna, dialecto) -> str:
+    """'nombre TIPO [DEFAULT x] [NOT NULL]' para ALTER TABLE ... ADD COLUMN."""
+    preparador = dialecto.identifier_preparer
+    ddl = f'{preparador.quote(columna.name)} {columna.type.compile(dialect=dialecto)}'
+    if columna.server_default is not None:
+        valor = columna.server_default.arg
+        ddl += f" DEFAULT {valor.text if hasattr(valor, 'text') else repr(str(valor))}"
+        if not columna.nullable:
+            # Sin valor por defecto no se puede agregar una columna NOT NULL a una tabla con filas
+            ddl += ' NOT NULL'
+    return ddl
+
+
+def migrar_esquema(conexion, metadata) -> list:
+    """
+    Completa tablas existentes con lo que create_all() no agrega: columnas
+    nuevas (ALTER TABLE ADD COLUMN), índices y restricciones UNIQUE (como
+    índice único con el mismo nombre, que SQLite sí permite agregar).
+    Es idempotente. Retorna las columnas agregadas como 'tabla.columna'.
+    """
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(conexion)
+    preparador = conexion.dialect.identifier_preparer
+    agregadas = []
+    for tabla in metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            continue
+        existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+        for columna in tabla.columns:
+            if columna.name not in existentes:
+                conexion.execute(text(f'ALTER TABLE {preparador.format_table(tabla)} '
+                                      f'ADD COLUMN {_ddl_columna(columna, conexion.dialect)}'))
+                agregadas.append(f'{tabla.name}.{columna.name}')
+
+        nombres = {i['name'] for i in inspector.get_indexes(tabla.name)}
+        nombres |= {u['name'] for u in inspector.get_unique_constraints(tabla.name)}
+        for indice in tabla.indexes:
+            if indice.name not in nombres:
+                indice.create(conexion)
+        for restriccion in tabla.constraints:
+            if isinstance(restriccion, UniqueConstraint) and restriccion.name and restriccion.name not in nombres:
+                columnas = ', '.join(preparador.quote(c.name) for c in restriccion.columns)
+                conexion.execute(text(f'CREATE UNIQUE INDEX {preparador.quote(restriccion.name)} '
+                                      f'ON {preparador.format_table(tabla)} ({columnas})'))
+    return agregadas
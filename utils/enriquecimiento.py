@@ -0,0 +1,345 @@
+"""
+NaturIA Chile - Caché de enriquecimiento con refresco en segundo plano
+Las miniaturas de Wikipedia y las grabaciones de Xeno-Canto/Wikimedia se
+guardan con dos vencimientos (stale-while-revalidate):
+
+- Antes de ENRIQUECIMIENTO_TTL_SUAVE se responden tal cual.
+- Entre el suave y ENRIQUECIMIENTO_TTL_DURO se responden igual de rápido y
+  se agenda un refresco en segundo plano.
+- Pasado el duro (o si la URL guardada ya no existe) la petición espera la
+  búsqueda completa, como si no hubiera caché.
+
+Cada ENRIQUECIMIENTO_VERIFICAR_CADA segundos un hilo revisa en lote las URLs
+guardadas con peticiones HEAD; las que responden 404/410 se refrescan.
+Un resultado None o con 'error' (no encontrado o falla del servicio) no se guarda.
+
+Las búsquedas por texto de Gemini usan la misma caché (`busquedas`). Los
+registros viven en un almacén intercambiable (utils/cache.py, CACHE_BACKEND):
+en memoria del proceso, o compartidos entre workers en SQLite o Redis. Como
+se guardan serializados, cada consulta entrega su propia copia (las rutas les
+agregan campos, p. ej. imagen_url). Todo se puede volcar a un archivo
+(ENRIQUECIMIENTO_ARCHIVO) que cada worker carga al arrancar; así lo que deja
+`flask precalentar` llega a todos los workers aunque el almacén sea en memoria.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from utils.cache import AlmacenMemoria
+from utils.coalescencia import clave_llamada
+
+ENRIQUECIMIENTO_TTL_SUAVE = float(os.getenv('ENRIQUECIMIENTO_TTL_SUAVE', 60 * 60 * 24 * 7))
+ENRIQUECIMIENTO_TTL_DURO = float(os.getenv('ENRIQUECIMIENTO_TTL_DURO', 60 * 60 * 24 * 30))
+ENRIQUECIMIENTO_MAXIMO = int(os.getenv('ENRIQUECIMIENTO_MAXIMO', 5000))
+ENRIQUECIMIENTO_VERIFICAR_CADA = float(os.getenv('ENRIQUECIMIENTO_VERIFICAR_CADA', 60 * 60 * 6))
+ENRIQUECIMIENTO_ARCHIVO = os.getenv('ENRIQUECIMIENTO_ARCHIVO')
+
+# Tras un refresco que no trajo nada se conserva el valor y se espera esto antes de reintentar
+REINTENTO_SEGUNDOS = 300
+ESTADOS_MUERTOS = {404, 410}
+USER_AGENT = 'NaturIA-Chile/1.0 (Educational App for Children)'
+
+_refrescador = ThreadPoolExecutor(max_workers=2, thread_name_prefix='enriquecimiento')
+
+# Todas las cachés creadas, para verificarlas y reportarlas juntas
+CACHES = []
+# Función de búsqueda por nombre: los registros guardan nombre y argumentos para rehacer el refresco
+FUNCIONES = {}
+
+# Dónde viven los registros (ver utils/cache.py); la app lo cambia con usar_almacen()
+_almacen = AlmacenMemoria()
+
+
+def usar_almacen(almacen):
+    """Cambia el almacén de todas las cachés (memoria, sqlite o redis)."""
+    global _almacen
+    _almacen = almacen
+
+
+def url_de(valor):
+    """URL verificable de un valor guardado (str o dict con 'url'), o None."""
+    url = valor.get('url') if isinstance(valor, dict) else valor
+    if isinstance(url, str) and url.startswith(('http://', 'https://')):
+        return url
+    return None
+
+
+class CacheEnriquecimiento:
+    """
+    Espacio de nombres del almacén con vencimiento suave y duro por registro.
+    Un registro es {'valor', 'guardado', 'funcion', 'args', 'kwargs'} más
+    'muerta' y 'proximo_refresco' cuando corresponde; vive en el almacén
+    hasta el vencimiento duro. Los contadores son de este proceso.
+    """
+
+    def __init__(self, nombre: str, ttl_suave: float = ENRIQUECIMIENTO_TTL_SUAVE,
+                 ttl_duro: float = ENRIQUECIMIENTO_TTL_DURO, maximo: int = ENRIQUECIMIENTO_MAXIMO,
+                 almacen=None):
+        self.nombre = nombre
+        self.ttl_suave = ttl_suave
+        self.ttl_duro = ttl_duro
+        self.maximo = maximo
+        self._propio = almacen
+        self._lock = threading.Lock()
+        self._refrescando = {}
+        self._contadores = dict.fromkeys(
+            ('frescas', 'viejas', 'bloqueadas', 'refrescos', 'refrescos_sin_resultado', 'urls_muertas'), 0)
+        CACHES.append(self)
+
+    @property
+    def almacen(self):
+        return self._propio or _almacen
+
+    def _contar(self, campo, n=1):
+        with self._lock:
+            self._contadores[campo] += n
+
+    def reescribir(self, clave: str, registro: dict):
+        """Guarda un registro con lo que le queda hasta el vencimiento duro."""
+        restante = self.ttl_duro - (time.time() - registro['guardado'])
+        if restante <= 0:
+            self.almacen.borrar(self.nombre, clave)
+        else:
+            self.almacen.guardar(self.nombre, clave, registro, restante, self.maximo)
+
+    def consultar(self, clave: str):
+        """
+        Retorna (encontrado, valor). Un registro pasado del vencimiento suave
+        se entrega igual y agenda su refresco.
+        """
+        registro = self.almacen.obtener(self.nombre, clave)
+        edad = time.time() - registro['guardado'] if registro else None
+        if registro is None or registro.get('muerta') or edad >= self.ttl_duro:
+            self._contar('bloqueadas')
+            return False, None
+        if edad < self.ttl_suave:
+            self._contar('frescas')
+            return True, registro['valor']
+        self._contar('viejas')
+        self.agendar_refresco(clave, registro)
+        return True, registro['valor']
+
+    def guardar(self, clave: str, valor, funcion: str, args=(), kwargs=None):
+        if valor is None or (isinstance(valor, dict) and 'error' in valor):
+            return
+        self.reescribir(clave, {'valor': valor, 'guardado': time.time(), 'funcion': funcion,
+                                'args': list(args), 'kwargs': kwargs or {}})
+        iniciar_verificacion_periodica()
+
+    def agendar_refresco(self, clave: str, registro: dict):
+        """Refresca el registro en el pool de fondo (una vez por clave a la vez en este proceso)."""
+        with self._lock:
+            if clave in self._refrescando or time.time() < registro.get('proximo_refresco', 0):
+                return
+            self._refrescando[clave] = _refrescador.submit(self._refrescar, clave, registro)
+
+    def _refrescar(self, clave, registro):
+        try:
+            funcion = FUNCIONES[registro['funcion']]
+            valor = funcion(*registro['args'], **registro['kwargs'])
+        except Exception as e:
+            print(f"⚠️  Error refrescando {self.nombre} {clave}: {e}")
+            valor = None
+        if isinstance(valor, dict) and 'error' in valor:
+            valor = None
+        try:
+            if valor is not None:
+                self._contar('refrescos')
+                self.reescribir(clave, {**registro, 'valor': valor, 'guardado': time.time(),
+                                        'muerta': False, 'proximo_refresco': 0})
+            elif registro.get('muerta'):
+                # La URL ya no existe y no hay reemplazo: mejor no responder nada que un enlace roto
+                self._contar('refrescos_sin_resultado')
+                actual = self.almacen.obtener(self.nombre, clave)
+                if actual is not None and actual['guardado'] == registro['guardado']:
+                    self.almacen.borrar(self.nombre, clave)
+            else:
+                self._contar('refrescos_sin_resultado')
+                self.reescribir(clave, {**registro, 'proximo_refresco': time.time() + REINTENTO_SEGUNDOS})
+        finally:
+            with self._lock:
+                self._refrescando.pop(clave, None)
+
+    def esperar_refrescos(self):
+        """Espera los refrescos en curso (para tests y para apagar el servidor)."""
+        with self._lock:
+            pendientes = list(self._refrescando.values())
+        for futuro in pendientes:
+            futuro.result()
+
+    def entradas_con_url(self):
+        return [(clave, registro, url_de(registro['valor']))
+                for clave, registro in self.almacen.registros(self.nombre) if url_de(registro['valor'])]
+
+    def marcar_muerta(self, clave: str, registro: dict):
+        registro['muerta'] = True
+        self.reescribir(clave, registro)
+        self._contar('urls_muertas')
+        self.agendar_refresco(clave, registro)
+
+    def limpiar(self):
+        self.esperar_refrescos()
+        self.almacen.limpiar(self.nombre)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            contadores = dict(self._contadores)
+        return {'entradas': self.almacen.tamano(self.nombre), **contadores}
+
+    def exportar(self) -> list:
+        return [{'clave': clave, **registro} for clave, registro in self.almacen.registros(self.nombre)
+                if not registro.get('muerta')]
+
+    def importar(self, registros: list) -> int:
+        """Agrega registros exportados (sin pisar otros más nuevos). Retorna cuántos."""
+        agregados = 0
+        for r in registros:
+            registro = {k: r[k] for k in ('valor', 'guardado', 'funcion', 'args', 'kwargs')}
+            actual = self.almacen.obtener(self.nombre, r['clave'])
+            if r['funcion'] not in FUNCIONES or (actual is not None and actual['guardado'] >= r['guardado']):
+                continue
+            if time.time() - registro['guardado'] < self.ttl_duro:
+                self.reescribir(r['clave'], registro)
+                agregados += 1
+        return agregados
+
+
+imagenes = CacheEnriquecimiento('imagenes')
+sonidos = CacheEnriquecimiento('sonidos')
+busquedas = CacheEnriquecimiento('busquedas')
+
+
+def con_refresco(cache: CacheEnriquecimiento, sincrona=None):
+    """
+    Decorador que pasa una búsqueda por `cache`. Para la versión async se
+    indica su equivalente síncrona: comparten la clave, y el refresco de
+    fondo siempre corre la síncrona en el pool de hilos.
+    """
+    def decorar(funcion):
+        cargar = getattr(sincrona, '__wrapped__', sincrona) or funcion
+        nombre = cargar.__name__
+        FUNCIONES[nombre] = cargar
+
+        if asyncio.iscoroutinefunction(funcion):
+            @functools.wraps(funcion)
+            async def envoltura_async(*args, **kwargs):
+                clave = clave_llamada(nombre, args, kwargs)
+                # SQLite y Redis son E/S bloqueante: fuera del event loop
+                bloqueante = getattr(cache.almacen, 'bloqueante', True)
+                if bloqueante:
+                    encontrado, valor = await asyncio.to_thread(cache.consultar, clave)
+                else:
+                    encontrado, valor = cache.consultar(clave)
+                if encontrado:
+                    return valor
+                valor = await funcion(*args, **kwargs)
+                if bloqueante:
+                    await asyncio.to_thread(cache.guardar, clave, valor, nombre, args, kwargs)
+                else:
+                    cache.guardar(clave, valor, nombre, args, kwargs)
+                return valor
+            return envoltura_async
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            clave = clave_llamada(nombre, args, kwargs)
+            encontrado, valor = cache.consultar(clave)
+            if encontrado:
+                return valor
+            valor = funcion(*args, **kwargs)
+            cache.guardar(clave, valor, nombre, args, kwargs)
+            return valor
+        return envoltura
+    return decorar
+
+
+def verificar_urls(caches=None, hilos: int = 8, timeout: float = 5) -> dict:
+    """
+    Revisa con HEAD (en paralelo, con una sesión keep-alive por hilo) las
+    URLs guardadas. Las que ya no existen se marcan y se refrescan en el
+    fondo. Un error de red no cuenta como URL muerta.
+    """
+    pendientes = [(cache, clave, registro, url)
+                  for cache in (caches or CACHES) for clave, registro, url in cache.entradas_con_url()]
+    local = threading.local()
+
+    def revisar(url):
+        if not hasattr(local, 'sesion'):
+            local.sesion = requests.Session()
+            local.sesion.headers['User-Agent'] = USER_AGENT
+        try:
+            return local.sesion.head(url, allow_redirects=True, timeout=timeout).status_code
+        except requests.exceptions.RequestException:
+            return None
+
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        estados = list(pool.map(revisar, [url for *_, url in pendientes]))
+
+    muertas = 0
+    for (cache, clave, registro, _), estado in zip(pendientes, estados):
+        if estado in ESTADOS_MUERTOS:
+            cache.marcar_muerta(clave, registro)
+            muertas += 1
+    return {'revisadas': len(pendientes), 'muertas': muertas,
+            'sin_respuesta': sum(estado is None for estado in estados)}
+
+
+_verificador = None
+_lock_verificador = threading.Lock()
+
+
+def iniciar_verificacion_periodica(intervalo: float = None):
+    """Arranca (una vez por proceso) el hilo que verifica las URLs guardadas."""
+    global _verificador
+    intervalo = ENRIQUECIMIENTO_VERIFICAR_CADA if intervalo is None else intervalo
+    if intervalo <= 0 or _verificador is not None:
+        return
+    with _lock_verificador:
+        if _verificador is not None:
+            return
+
+        def bucle():
+            while True:
+                time.sleep(intervalo)
+                try:
+                    verificar_urls()
+                except Exception as e:
+                    print(f"⚠️  Error verificando URLs de enriquecimiento: {e}")
+
+        _verificador = threading.Thread(target=bucle, name='verificar-enriquecimiento', daemon=True)
+        _verificador.start()
+
+
+def estadisticas() -> dict:
+    return {cache.nombre: cache.estadisticas() for cache in CACHES}
+
+
+def guardar_archivo(ruta: str = None):
+    """Vuelca todas las cachés a un JSON (escritura atómica)."""
+    ruta = ruta or ENRIQUECIMIENTO_ARCHIVO
+    os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+    temporal = f'{ruta}.{os.getpid()}.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump({cache.nombre: cache.exportar() for cache in CACHES}, f, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+def cargar_archivo(ruta: str = None) -> int:
+    """Carga un volcado de guardar_archivo, si existe. Retorna cuántas entradas agregó."""
+    ruta = ruta or ENRIQUECIMIENTO_ARCHIVO
+    try:
+        with open(ruta, encoding='utf-8') as f:
+            datos = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except ValueError as e:
+        print(f"⚠️  Archivo de enriquecimiento inválido ({ruta}): {e}")
+        return 0
+    return sum(cache.importar(datos.get(cache.nombre, [])) for cache in CACHES)
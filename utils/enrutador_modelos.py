@@ -0,0 +1,121 @@
+"""
+NaturIA Chile - Orden adaptativo de los modelos de Gemini
+MODELOS_DISPONIBLES es solo el orden inicial. Por cada (modelo, clase de
+llamada: 'imagen' o 'texto') se lleva un promedio móvil exponencial (EWMA)
+de la latencia de cada intento y de su tasa de éxito, y cada petición prueba
+los modelos en el orden que minimiza la latencia esperada:
+
+- Probar los modelos en orden creciente de latencia / éxito minimiza el
+  tiempo esperado hasta la primera respuesta buena.
+- Piso de calidad: un modelo con éxito bajo MODELOS_EXITO_MINIMO (cuota
+  agotada, modelo retirado) pasa al final, pero sigue como último recurso.
+- Un modelo con menos de MODELOS_MUESTRAS_MINIMAS intentos conserva su
+  lugar en el orden inicial hasta tener datos.
+- Exploración: una fracción MODELOS_EXPLORACION de las peticiones prueba
+  primero el modelo con datos más viejos, para que sus números no se queden
+  congelados (un modelo lento a las 3 de la tarde puede ser el más rápido a
+  las 3 de la mañana).
+
+Los números son de cada worker; /metricas muestra el orden actual de ese worker.
+"""
+
+import os
+import random
+import threading
+import time
+
+MODELOS_ALFA = float(os.getenv('MODELOS_ALFA', 0.2))
+MODELOS_EXITO_MINIMO = float(os.getenv('MODELOS_EXITO_MINIMO', 0.5))
+MODELOS_MUESTRAS_MINIMAS = int(os.getenv('MODELOS_MUESTRAS_MINIMAS', 3))
+MODELOS_EXPLORACION = float(os.getenv('MODELOS_EXPLORACION', 0.05))
+
+CLASES = ('imagen', 'texto')
+
+
+class Estadistica:
+    __slots__ = ('latencia', 'exito', 'intentos', 'ultimo')
+
+    def __init__(self):
+        self.latencia = None
+        self.exito = None
+        self.intentos = 0
+        self.ultimo = 0.0
+
+
+class EnrutadorModelos:
+    """EWMA de latencia y éxito por (modelo, clase), y el orden de intentos que resulta."""
+
+    def __init__(self, modelos: list, alfa: float = MODELOS_ALFA, exito_minimo: float = MODELOS_EXITO_MINIMO,
+                 muestras_minimas: int = MODELOS_MUESTRAS_MINIMAS, exploracion: float = MODELOS_EXPLORACION):
+        self.modelos = list(modelos)
+        self.alfa = alfa
+        self.exito_minimo = exito_minimo
+        self.muestras_minimas = muestras_minimas
+        self.exploracion = exploracion
+        self._estadisticas = {}
+        self._lock = threading.Lock()
+        self.exploradas = 0
+
+    def _estadistica(self, modelo, clase):
+        return self._estadisticas.setdefault((modelo, clase), Estadistica())
+
+    def registrar(self, modelo: str, clase: str, exito: bool, segundos: float):
+        """Anota un intento: su latencia (acierte o falle, es tiempo que espera el usuario) y si respondió."""
+        with self._lock:
+            e = self._estadistica(modelo, clase)
+            if e.latencia is None:
+                e.latencia, e.exito = segundos, float(exito)
+            else:
+                e.latencia += self.alfa * (segundos - e.latencia)
+                e.exito += self.alfa * (float(exito) - e.exito)
+            e.intentos += 1
+            e.ultimo = time.time()
+
+    def _costo(self, e: Estadistica) -> float:
+        return e.latencia / max(e.exito, 1e-3)
+
+    def _orden_calculado(self, clase):
+        """
+        Recorre el orden inicial; cada hueco que ocupaba un modelo con datos
+        suficientes y sobre el piso se llena con el más barato de ellos.
+        """
+        medidos, bajo_piso = [], []
+        for modelo in self.modelos:
+            e = self._estadisticas.get((modelo, clase))
+            if e is not None and e.intentos >= self.muestras_minimas:
+                (medidos if e.exito >= self.exito_minimo else bajo_piso).append(modelo)
+        por_costo = iter(sorted(medidos, key=lambda m: self._costo(self._estadisticas[(m, clase)])))
+        orden = [next(por_costo) if modelo in medidos else modelo
+                 for modelo in self.modelos if modelo not in bajo_piso]
+        return orden + bajo_piso
+
+    def orden(self, clase: str) -> list:
+        """Modelos en el orden en que esta petición debe probarlos."""
+        with self._lock:
+            orden = self._orden_calculado(clase)
+            if len(orden) > 1 and random.random() < self.exploracion:
+                # El de datos más viejos (o sin datos) va primero
+                explorado = min(orden[1:], key=lambda m: getattr(self._estadisticas.get((m, clase)), 'ultimo', 0))
+                orden.remove(explorado)
+                orden.insert(0, explorado)
+                self.exploradas += 1
+        return orden
+
+    def estado(self) -> dict:
+        """Orden actual por clase y los números de cada modelo (sin exploración)."""
+        with self._lock:
+            resumen = {'exploradas': self.exploradas}
+            for clase in CLASES:
+                modelos = {}
+                for modelo in self.modelos:
+                    e = self._estadisticas.get((modelo, clase))
+                    if e is not None:
+                        modelos[modelo] = {'latencia_ms': round(e.latencia * 1000, 1), 'exito': round(e.exito, 3),
+                                           'intentos': e.intentos, 'bajo_piso': e.exito < self.exito_minimo}
+                resumen[clase] = {'orden': self._orden_calculado(clase), 'modelos': modelos}
+            return resumen
+
+    def reiniciar(self):
+        with self._lock:
+            self._estadisticas.clear()
+            self.exploradas = 0
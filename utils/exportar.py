@@ -0,0 +1,82 @@
+"""
+NaturIA Chile - Exportación de descubrimientos en streaming
+Convierte un iterador de filas (tuplas, en el orden de COLUMNAS) en trozos
+de CSV o NDJSON, y opcionalmente los comprime con gzip a medida que salen.
+Nada se acumula: cada trozo lleva a lo más FILAS_POR_TROZO filas, así que la
+memoria no depende de cuántas filas tenga la exportación.
+
+En el CSV, un texto que empieza con =, +, -, @ (o tabulación / retorno de
+carro) se antepone con ' para que Excel no lo ejecute como fórmula: los
+nombres de especies y exploradores los escriben los usuarios.
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+
+COLUMNAS = ('id', 'usuario_id', 'explorador', 'nombre', 'cientifico', 'tipo', 'puntos',
+            'fecha', 'region', 'latitud', 'longitud', 'imagen_url')
+FILAS_POR_TROZO = 500
+FORMATOS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+INICIOS_DE_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _valor(valor):
+    return valor.isoformat() if isinstance(valor, (date, datetime)) else valor
+
+
+def _celda_csv(valor):
+    valor = _valor(valor)
+    if isinstance(valor, str) and valor.startswith(INICIOS_DE_FORMULA):
+        return "'" + valor
+    return valor
+
+
+def _en_trozos(filas, convertir):
+    trozo = []
+    for fila in filas:
+        trozo.append(convertir(fila))
+        if len(trozo) >= FILAS_POR_TROZO:
+            yield ''.join(trozo).encode('utf-8')
+            trozo = []
+    if trozo:
+        yield ''.join(trozo).encode('utf-8')
+
+
+def filas_csv(filas, columnas=COLUMNAS):
+    """CSV con cabecera; con BOM para que Excel reconozca el UTF-8 (tildes, ñ)."""
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+
+    def convertir(fila):
+        salida.seek(0)
+        salida.truncate()
+        escritor.writerow([_celda_csv(v) for v in fila])
+        return salida.getvalue()
+
+    yield '\ufeff'.encode('utf-8') + convertir(columnas).encode('utf-8')
+    yield from _en_trozos(filas, convertir)
+
+
+def filas_ndjson(filas, columnas=COLUMNAS):
+    """Un objeto JSON por línea."""
+    return _en_trozos(filas, lambda fila: json.dumps(
+        dict(zip(columnas, map(_valor, fila))), ensure_ascii=False) + '\n')
+
+
+def comprimir_gzip(trozos, nivel: int = 6):
+    """Comprime en gzip trozo a trozo (cada trozo comprimido sale apenas está listo)."""
+    compresor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+    for trozo in trozos:
+        comprimido = compresor.compress(trozo) + compresor.flush(zlib.Z_SYNC_FLUSH)
+        if comprimido:
+            yield comprimido
+    yield compresor.flush()
+
+
+def exportar(filas, formato: str = 'csv', gzip: bool = False):
+    """Trozos de bytes listos para una respuesta en streaming."""
+    trozos = filas_csv(filas) if formato == 'csv' else filas_ndjson(filas)
+    return comprimir_gzip(trozos) if gzip else trozos
@@ -3,15 +3,36 @@ Cliente para interactuar con la API de Google Gemini.
 Maneja la identificación de insectos y plantas de Chile.
 """
 
+import asyncio
+import hashlib
 import os
 import json
 import re
+import threading
 import time
-import google.generativeai as genai
-from PIL import Image
 import io
+from datetime import timedelta
 
-# Lista de modelos a probar (en orden de preferencia)
+from utils.coalescencia import coalescido
+from utils.enriquecimiento import con_refresco, busquedas
+from utils.enrutador_modelos import EnrutadorModelos
+from utils.huellas import calcular_huella, indice_huellas
+from utils.trazas import tramo
+
+# google.generativeai tarda ~0.5 s en importarse: se carga en el primer uso
+# para que arrancar un worker o correr los tests no pague ese costo.
+genai = None
+
+
+def cargar_genai():
+    """Importa el SDK de Gemini la primera vez que se necesita."""
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+    return genai
+
+# Lista de modelos a probar (orden inicial; después manda la latencia medida)
 MODELOS_DISPONIBLES = [
     'gemini-2.5-flash',
     'gemini-2.0-flash',
@@ -20,13 +41,51 @@ MODELOS_DISPONIBLES = [
     'gemini-pro-latest',
 ]
 
+# Orden de intentos por latencia y tasa de éxito (ver utils/enrutador_modelos.py)
+enrutador = EnrutadorModelos(MODELOS_DISPONIBLES)
+
+# Caché de contexto de Gemini para las instrucciones fijas (solo se usa si el modelo la acepta)
+GEMINI_CACHE_CONTEXTO = os.getenv('GEMINI_CACHE_CONTEXTO', 'false').lower() == 'true'
+GEMINI_CACHE_CONTEXTO_TTL = int(os.getenv('GEMINI_CACHE_CONTEXTO_TTL', 60 * 60))
+
+# Lado máximo (px) de la imagen que se envía a Gemini
+LADO_MAXIMO_IMAGEN = int(os.getenv('GEMINI_LADO_MAXIMO', 2048))
+
+
+def abrir_imagen(image_data):
+    """
+    Abre la imagen (bytes o archivo) reducida a LADO_MAXIMO_IMAGEN.
+    En JPEG, draft() decodifica directamente a 1/2, 1/4 u 1/8 de escala,
+    así que una foto grande nunca se descomprime completa en memoria.
+    """
+    from PIL import Image
+    image = Image.open(image_data if hasattr(image_data, 'read') else io.BytesIO(image_data))
+    if max(image.size) > LADO_MAXIMO_IMAGEN:
+        image.draft('RGB', (LADO_MAXIMO_IMAGEN, LADO_MAXIMO_IMAGEN))
+        image.thumbnail((LADO_MAXIMO_IMAGEN, LADO_MAXIMO_IMAGEN))
+    return image
+
+# GenerativeModel ya construidos por (modelo, tipo, clase de llamada), con su vencimiento
+MODELOS_PREPARADOS = {}
+_lock_modelos = threading.Lock()
+_clave_configurada = None
+# CachedContent creados por este proceso, por display_name (se borran al cambiar la clave)
+_caches_creados = {}
+
 # Configurar la API de Gemini
 def configure_gemini():
     """Configura la API de Gemini con la clave del entorno."""
     api_key = os.getenv('GOOGLE_API_KEY')
     if not api_key:
         raise ValueError("No se encontró GOOGLE_API_KEY en las variables de entorno")
-    genai.configure(api_key=api_key)
+    global _clave_configurada
+    if api_key != _clave_configurada:
+        # Los modelos preparados quedan atados al cliente de la clave anterior
+        MODELOS_PREPARADOS.clear()
+        if _clave_configurada is not None:
+            liberar_caches_contexto()
+        _clave_configurada = api_key
+    cargar_genai().configure(api_key=api_key)
     return True
 
 def obtener_prompt(tipo: str) -> str:
@@ -100,35 +159,204 @@ def obtener_prompt(tipo: str) -> str:
         
         IMPORTANTE: Responde SOLO con el JSON, sin texto adicional ni markdown."""
 
-def intentar_con_modelo(model_name: str, prompt: str, image) -> tuple:
+def clasificar_error(error_str: str, model_name: str) -> str:
+    """Traduce el error de un intento a una etiqueta (cuota, clave, modelo inexistente)."""
+    # Verificar si es error de cuota
+    if "429" in error_str or "quota" in error_str.lower():
+        return f"quota_exceeded:{model_name}"
+    # Verificar si la API key es inválida o expiró
+    if "400" in error_str or "API_KEY_INVALID" in error_str or "expired" in error_str.lower():
+        return f"key_error:{model_name}"
+    # Verificar si el modelo no existe
+    if "404" in error_str or "not found" in error_str.lower():
+        return f"model_not_found:{model_name}"
+    # Otro error
+    return error_str
+
+def parsear_respuesta(response_text: str) -> dict:
+    """Quita los posibles marcadores de código markdown y parsea el JSON."""
+    if response_text.startswith('```'):
+        response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
+        response_text = re.sub(r'\n?```$', '', response_text)
+    return json.loads(response_text)
+
+def registrar_fallo(modelo: str, resultado: str, errores: list, modelos_con_cuota_excedida: list, avisar: bool = False):
+    """Acumula el motivo del fallo de un modelo para el mensaje final."""
+    if "quota_exceeded" in resultado:
+        modelos_con_cuota_excedida.append(modelo)
+    elif "model_not_found" in resultado:
+        return  # Silenciosamente probar el siguiente modelo
+    else:
+        if avisar:
+            print(f"❌ Error con {modelo}: {resultado}")
+        errores.append(f"{modelo}: {resultado}")
+
+def resultado_fallido(tipo: str, errores: list, modelos_con_cuota_excedida: list,
+                      prefijo_error: str, sin_modelos: str) -> dict:
+    """Construye la respuesta de error cuando todos los modelos fallaron."""
+    if modelos_con_cuota_excedida:
+        return {
+            "error": "⏰ ¡Has usado todas las consultas gratuitas de hoy! El límite de la API Free de Google Gemini se ha alcanzado. Intenta de nuevo en unos minutos o mañana.",
+            "tipo": tipo,
+            "codigo_error": "QUOTA_EXCEEDED"
+        }
+    
+    # Revisar si hubo errores de API Key
+    if errores and any("key_error" in err or "400" in err for err in errores):
+        return {
+            "error": "🔑 Tu API Key de Google Gemini parece haber expirado o es inválida. Por favor, genera una nueva en https://aistudio.google.com/app/apikey",
+            "tipo": tipo,
+            "codigo_error": "API_KEY_ERROR"
+        }
+    
+    # Si hubo otros errores
+    if errores:
+        return {
+            "error": f"{prefijo_error}: {errores[0]}",
+            "tipo": tipo
+        }
+    
+    return {
+        "error": sin_modelos,
+        "tipo": tipo
+    }
+
+def instrucciones_para(tipo: str, clase: str) -> str:
+    """Instrucciones fijas de una clase de llamada ('imagen' o 'texto')."""
+    return obtener_prompt(tipo) if clase == 'imagen' else obtener_instrucciones_busqueda(tipo)
+
+def nombre_cache_contexto(model_name: str, instrucciones: str) -> str:
+    """display_name del CachedContent: el mismo en todos los workers para las mismas instrucciones."""
+    return 'naturia-' + hashlib.sha256(f'{model_name}\n{instrucciones}'.encode('utf-8')).hexdigest()[:16]
+
+def buscar_cache_contexto(sdk, nombre: str):
+    """(CachedContent, segundos que le quedan) del vigente con ese display_name, o None."""
+    mejor = None
+    for contenido in sdk.caching.CachedContent.list(page_size=100):
+        if contenido.display_name != nombre:
+            continue
+        restante = contenido.expire_time.timestamp() - time.time()
+        # Con menos de dos minutos no vale la pena: vencería antes de volver a prepararse
+        if restante > 120 and (mejor is None or restante > mejor[1]):
+            mejor = (contenido, restante)
+    return mejor
+
+def liberar_caches_contexto():
+    """Borra los CachedContent creados por este proceso (con la clave que los creó aún configurada)."""
+    for contenido in list(_caches_creados.values()):
+        try:
+            contenido.delete()
+        except Exception as e:
+            print(f"⚠️  No se pudo borrar la caché de contexto {contenido.name}: {e}")
+    _caches_creados.clear()
+
+def crear_modelo(model_name: str, instrucciones: str) -> tuple:
+    """
+    Construye el modelo con las instrucciones como system_instruction.
+    Retorna (modelo, vencimiento); con GEMINI_CACHE_CONTEXTO intenta dejarlas
+    en la caché de contexto de Gemini, que vence tras su TTL. Si otro worker
+    (o un arranque anterior) ya dejó las mismas instrucciones en caché, se
+    reutiliza esa en vez de crear otra.
+    """
+    sdk = cargar_genai()
+    if GEMINI_CACHE_CONTEXTO:
+        try:
+            nombre = nombre_cache_contexto(model_name, instrucciones)
+            encontrado = buscar_cache_contexto(sdk, nombre)
+            if encontrado is None:
+                contenido = sdk.caching.CachedContent.create(
+                    model=f'models/{model_name}', display_name=nombre, system_instruction=instrucciones,
+                    ttl=timedelta(seconds=GEMINI_CACHE_CONTEXTO_TTL))
+                _caches_creados[nombre] = contenido
+                restante = GEMINI_CACHE_CONTEXTO_TTL
+            else:
+                contenido, restante = encontrado
+            return (sdk.GenerativeModel.from_cached_content(contenido),
+                    time.monotonic() + restante - 60)
+        except Exception as e:
+            # P. ej. instrucciones bajo el mínimo de tokens que el modelo acepta en caché
+            print(f"⚠️  Sin caché de contexto para {model_name}: {e}")
+    return sdk.GenerativeModel(model_name, system_instruction=instrucciones), float('inf')
+
+def obtener_modelo(model_name: str, tipo: str, clase: str):
+    """Modelo preparado para (modelo, tipo, clase); se construye la primera vez."""
+    # Los tipos sin prompt propio usan el de plantas (como obtener_prompt)
+    tipo = tipo if tipo in ('insecto', 'ave', 'animal') else 'planta'
+    clave = (model_name, tipo, clase)
+    preparado = MODELOS_PREPARADOS.get(clave)
+    if preparado is None or preparado[1] <= time.monotonic():
+        with _lock_modelos:
+            preparado = MODELOS_PREPARADOS.get(clave)
+            if preparado is None or preparado[1] <= time.monotonic():
+                preparado = MODELOS_PREPARADOS[clave] = crear_modelo(model_name, instrucciones_para(tipo, clase))
+    return preparado[0]
+
+def intentar_con_modelo(model_name: str, tipo: str, image) -> tuple:
     """
     Intenta generar contenido con un modelo específico.
     Retorna (éxito, resultado_o_error)
     """
-    try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content([prompt, image])
-        return (True, response.text.strip())
-    except Exception as e:
-        error_str = str(e)
-        # Verificar si es error de cuota
-        if "429" in error_str or "quota" in error_str.lower():
-            return (False, f"quota_exceeded:{model_name}")
-        # Verificar si la API key es inválida o expiró
-        if "400" in error_str or "API_KEY_INVALID" in error_str or "expired" in error_str.lower():
-            return (False, f"key_error:{model_name}")
-        # Verificar si el modelo no existe
-        if "404" in error_str or "not found" in error_str.lower():
-            return (False, f"model_not_found:{model_name}")
-        # Otro error
-        return (False, error_str)
-
-def analizar_imagen(image_data: bytes, tipo: str = "insecto") -> dict:
+    inicio = time.perf_counter()
+    with tramo('gemini', modelo=model_name) as etiquetas:
+        try:
+            model = obtener_modelo(model_name, tipo, 'imagen')
+            response = model.generate_content([image])
+            enrutador.registrar(model_name, 'imagen', True, time.perf_counter() - inicio)
+            return (True, response.text.strip())
+        except Exception as e:
+            etiquetas['error'] = True
+            enrutador.registrar(model_name, 'imagen', False, time.perf_counter() - inicio)
+            return (False, clasificar_error(str(e), model_name))
+
+async def intentar_con_modelo_async(model_name: str, tipo: str, image) -> tuple:
+    """Versión asíncrona de intentar_con_modelo (no bloquea el event loop)."""
+    inicio = time.perf_counter()
+    with tramo('gemini', modelo=model_name) as etiquetas:
+        try:
+            # Crear el CachedContent es una llamada bloqueante
+            model = await asyncio.to_thread(obtener_modelo, model_name, tipo, 'imagen')
+            response = await model.generate_content_async([image])
+            enrutador.registrar(model_name, 'imagen', True, time.perf_counter() - inicio)
+            return (True, response.text.strip())
+        except Exception as e:
+            etiquetas['error'] = True
+            enrutador.registrar(model_name, 'imagen', False, time.perf_counter() - inicio)
+            return (False, clasificar_error(str(e), model_name))
+
+SIN_MODELOS_IMAGEN = "No hay modelos disponibles para analizar la imagen. Por favor, verifica tu API Key."
+
+def identificar_imagen(image, tipo: str) -> dict:
+    """Identifica la imagen (ya abierta) con Gemini, probando varios modelos si es necesario."""
+    # Intentar con cada modelo disponible
+    errores = []
+    modelos_con_cuota_excedida = []
+    
+    for modelo in enrutador.orden('imagen'):
+        exito, resultado = intentar_con_modelo(modelo, tipo, image)
+        
+        if exito:
+            # Limpiar y parsear la respuesta
+            result = parsear_respuesta(resultado)
+            
+            # Agregar tipo al resultado
+            result['tipo'] = tipo
+            result['modelo_usado'] = modelo
+            
+            return result
+        registrar_fallo(modelo, resultado, errores, modelos_con_cuota_excedida, avisar=True)
+    
+    # Si todos los modelos fallaron, analizar por qué
+    return resultado_fallido(tipo, errores, modelos_con_cuota_excedida,
+                             "No se pudo analizar la imagen", SIN_MODELOS_IMAGEN)
+
+
+def analizar_imagen(image_data, tipo: str = "insecto") -> dict:
     """
     Analiza una imagen usando Gemini, probando varios modelos si es necesario.
+    Una foto casi idéntica a otra ya identificada reutiliza ese resultado.
     
     Args:
-        image_data: Bytes de la imagen a analizar
+        image_data: Bytes o archivo con la imagen a analizar
         tipo: Tipo de análisis ("insecto" o "planta")
     
     Returns:
@@ -138,71 +366,63 @@ def analizar_imagen(image_data: bytes, tipo: str = "insecto") -> dict:
         configure_gemini()
         
         # Cargar la imagen
-        image = Image.open(io.BytesIO(image_data))
+        image = abrir_imagen(image_data)
         
-        # Obtener el prompt
-        prompt = obtener_prompt(tipo)
+        huella = calcular_huella(image)
+        similar = indice_huellas.buscar(huella, tipo)
+        if similar is not None:
+            indice_huellas.quizas_auditar(similar, lambda: identificar_imagen(image, tipo))
+            return similar
+        
+        result = identificar_imagen(image, tipo)
+        indice_huellas.agregar(huella, tipo, result)
+        return result
+        
+    except json.JSONDecodeError as e:
+        return {
+            "error": f"Error al procesar la respuesta de la IA: {str(e)}",
+            "tipo": tipo
+        }
+    except Exception as e:
+        return {
+            "error": f"Error al analizar la imagen: {str(e)}",
+            "tipo": tipo
+        }
+
+
+def _preparar_imagen(image_data, tipo: str):
+    """Decodifica la imagen, calcula su huella y busca una ya identificada (todo bloqueante)."""
+    configure_gemini()
+    image = abrir_imagen(image_data)
+    huella = calcular_huella(image)
+    return image, huella, indice_huellas.buscar(huella, tipo)
+
+
+async def analizar_imagen_async(image_data, tipo: str = "insecto") -> dict:
+    """Versión asíncrona de analizar_imagen, para el modo ASGI."""
+    try:
+        # El trabajo de CPU y disco va a un hilo para no detener el event loop
+        image, huella, similar = await asyncio.to_thread(_preparar_imagen, image_data, tipo)
+        if similar is not None:
+            indice_huellas.quizas_auditar(similar, lambda: identificar_imagen(image, tipo))
+            return similar
         
-        # Intentar con cada modelo disponible
         errores = []
         modelos_con_cuota_excedida = []
         
-        for modelo in MODELOS_DISPONIBLES:
-            exito, resultado = intentar_con_modelo(modelo, prompt, image)
+        for modelo in enrutador.orden('imagen'):
+            exito, resultado = await intentar_con_modelo_async(modelo, tipo, image)
             
             if exito:
-                # Limpiar y parsear la respuesta
-                response_text = resultado
-                
-                # Remover posibles marcadores de código markdown
-                if response_text.startswith('```'):
-                    response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
-                    response_text = re.sub(r'\n?```$', '', response_text)
-                
-                # Parsear JSON
-                result = json.loads(response_text)
-                
-                # Agregar tipo al resultado
+                result = parsear_respuesta(resultado)
                 result['tipo'] = tipo
                 result['modelo_usado'] = modelo
-                
+                await asyncio.to_thread(indice_huellas.agregar, huella, tipo, result)
                 return result
-            else:
-                if "quota_exceeded" in resultado:
-                    modelos_con_cuota_excedida.append(modelo)
-                elif "model_not_found" in resultado:
-                    continue  # Silenciosamente probar el siguiente modelo
-                else:
-                    print(f"❌ Error con {modelo}: {resultado}")
-                    errores.append(f"{modelo}: {resultado}")
-        
-        # Si todos los modelos fallaron, analizar por qué
-        if modelos_con_cuota_excedida:
-             return {
-                "error": "⏰ ¡Has usado todas las consultas gratuitas de hoy! El límite de la API Free de Google Gemini se ha alcanzado. Intenta de nuevo en unos minutos o mañana.",
-                "tipo": tipo,
-                "codigo_error": "QUOTA_EXCEEDED"
-            }
-        
-        # Revisar si hubo errores de API Key
-        if errores and any("key_error" in err or "400" in err for err in errores):
-             return {
-                "error": "🔑 Tu API Key de Google Gemini parece haber expirado o es inválida. Por favor, genera una nueva en https://aistudio.google.com/app/apikey",
-                "tipo": tipo,
-                "codigo_error": "API_KEY_ERROR"
-            }
-
-        # Si hubo otros errores
-        if errores:
-            return {
-                "error": f"No se pudo analizar la imagen: {errores[0]}",
-                "tipo": tipo
-            }
+            registrar_fallo(modelo, resultado, errores, modelos_con_cuota_excedida, avisar=True)
         
-        return {
-            "error": "No hay modelos disponibles para analizar la imagen. Por favor, verifica tu API Key.",
-            "tipo": tipo
-        }
+        return resultado_fallido(tipo, errores, modelos_con_cuota_excedida,
+                                 "No se pudo analizar la imagen", SIN_MODELOS_IMAGEN)
         
     except json.JSONDecodeError as e:
         return {
@@ -216,14 +436,14 @@ def analizar_imagen(image_data: bytes, tipo: str = "insecto") -> dict:
         }
 
 
-def obtener_prompt_busqueda(tipo: str, consulta: str) -> str:
-    """Obtiene el prompt para búsqueda por texto."""
+def obtener_instrucciones_busqueda(tipo: str) -> str:
+    """Instrucciones fijas de la búsqueda por texto; la consulta va aparte como contenido del usuario."""
     if tipo == "insecto":
-        return f"""Eres un experto entomólogo chileno especializado en insectos de Chile.
-        El usuario está buscando información sobre: "{consulta}"
+        return """Eres un experto entomólogo chileno especializado en insectos de Chile.
+        El usuario escribirá el nombre (o una descripción) de lo que está buscando.
         
         Identifica el insecto y devuelve ÚNICAMENTE un objeto JSON válido con esta estructura exacta:
-        {{
+        {
             "nombre": "Nombre común en Chile (si tiene varios, usa el más conocido)",
             "cientifico": "Nombre científico en latín",
             "descripcion": "Explicación divertida y educativa para niños de 8 años, máximo 3 oraciones",
@@ -233,18 +453,18 @@ def obtener_prompt_busqueda(tipo: str, consulta: str) -> str:
             "dato_curioso": "Un dato sorprendente sobre este insecto",
             "puntos": un número entero entre 10 y 100 basado en la rareza del insecto en Chile,
             "imagen_sugerida": "Una descripción breve para buscar una imagen del insecto"
-        }}
+        }
         
         Si no puedes identificar el insecto o no existe, devuelve:
-        {{"error": "No encontré información sobre '{consulta}'. ¿Puedes verificar el nombre?"}}
+        {"error": "No encontré información sobre '<lo que escribió el usuario>'. ¿Puedes verificar el nombre?"}
         
         IMPORTANTE: Responde SOLO con el JSON, sin texto adicional ni markdown."""
     elif tipo == "ave":
-        return f"""Eres un experto ornitólogo chileno especializado en aves de Chile.
-        El usuario está buscando información sobre: "{consulta}"
+        return """Eres un experto ornitólogo chileno especializado en aves de Chile.
+        El usuario escribirá el nombre (o una descripción) de lo que está buscando.
         
         Identifica el ave y devuelve ÚNICAMENTE un objeto JSON válido con esta estructura exacta:
-        {{
+        {
             "nombre": "Nombre común en Chile",
             "cientifico": "Nombre científico en latín",
             "descripcion": "Explicación divertida y educativa para niños de 8 años, máximo 3 oraciones",
@@ -254,18 +474,18 @@ def obtener_prompt_busqueda(tipo: str, consulta: str) -> str:
             "dato_curioso": "Un dato sorprendente sobre esta ave",
             "puntos": un número entero entre 10 y 100 basado en la rareza del ave en Chile,
             "imagen_sugerida": "Una descripción breve para buscar una imagen del ave"
-        }}
+        }
         
         Si no puedes identificar el ave o no existe en Chile, devuelve:
-        {{"error": "No encontré información sobre '{consulta}' en Chile. ¿Puedes verificar el nombre?"}}
+        {"error": "No encontré información sobre '<lo que escribió el usuario>' en Chile. ¿Puedes verificar el nombre?"}
         
         IMPORTANTE: Responde SOLO con el JSON, sin texto adicional ni markdown."""
     elif tipo == "animal":
-        return f"""Eres un experto zoólogo chileno especializado en fauna silvestre de Chile.
-        El usuario está buscando información sobre: "{consulta}"
+        return """Eres un experto zoólogo chileno especializado en fauna silvestre de Chile.
+        El usuario escribirá el nombre (o una descripción) de lo que está buscando.
         
         Identifica el animal y devuelve ÚNICAMENTE un objeto JSON válido con esta estructura exacta:
-        {{
+        {
             "nombre": "Nombre común en Chile",
             "cientifico": "Nombre científico en latín",
             "descripcion": "Explicación divertida y educativa para niños de 8 años, máximo 3 oraciones",
@@ -275,18 +495,18 @@ def obtener_prompt_busqueda(tipo: str, consulta: str) -> str:
             "dato_curioso": "Un dato sorprendente sobre este animal",
             "puntos": un número entero entre 10 y 100 basado en la rareza del animal en Chile,
             "imagen_sugerida": "Una descripción breve para buscar una imagen del animal"
-        }}
+        }
         
         Si no puedes identificar el animal o no existe en Chile, devuelve:
-        {{"error": "No encontré información sobre '{consulta}' en Chile. ¿Puedes verificar el nombre?"}}
+        {"error": "No encontré información sobre '<lo que escribió el usuario>' en Chile. ¿Puedes verificar el nombre?"}
         
         IMPORTANTE: Responde SOLO con el JSON, sin texto adicional ni markdown."""
     else:
-        return f"""Eres un experto botánico chileno especializado en flora nativa de Chile.
-        El usuario está buscando información sobre: "{consulta}"
+        return """Eres un experto botánico chileno especializado en flora nativa de Chile.
+        El usuario escribirá el nombre (o una descripción) de lo que está buscando.
         
         Identifica la planta y devuelve ÚNICAMENTE un objeto JSON válido con esta estructura exacta:
-        {{
+        {
             "nombre": "Nombre común en Chile",
             "cientifico": "Nombre científico en latín",
             "descripcion": "Explicación divertida y educativa para niños de 8 años, máximo 3 oraciones",
@@ -296,34 +516,52 @@ def obtener_prompt_busqueda(tipo: str, consulta: str) -> str:
             "dato_curioso": "Un dato sorprendente sobre esta planta",
             "puntos": un número entero entre 10 y 100 basado en la rareza de la planta en Chile,
             "imagen_sugerida": "Una descripción breve para buscar una imagen de la planta"
-        }}
+        }
         
         Si no puedes identificar la planta o no existe en Chile, devuelve:
-        {{"error": "No encontré información sobre '{consulta}' en Chile. ¿Puedes verificar el nombre?"}}
+        {"error": "No encontré información sobre '<lo que escribió el usuario>' en Chile. ¿Puedes verificar el nombre?"}
         
         IMPORTANTE: Responde SOLO con el JSON, sin texto adicional ni markdown."""
 
 
-def intentar_busqueda_con_modelo(model_name: str, prompt: str) -> tuple:
+def intentar_busqueda_con_modelo(model_name: str, tipo: str, consulta: str) -> tuple:
     """
     Intenta generar contenido de búsqueda con un modelo específico.
     Retorna (éxito, resultado_o_error)
     """
-    try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
-        return (True, response.text.strip())
-    except Exception as e:
-        error_str = str(e)
-        if "429" in error_str or "quota" in error_str.lower():
-            return (False, f"quota_exceeded:{model_name}")
-        if "400" in error_str or "API_KEY_INVALID" in error_str or "expired" in error_str.lower():
-            return (False, f"key_error:{model_name}")
-        if "404" in error_str or "not found" in error_str.lower():
-            return (False, f"model_not_found:{model_name}")
-        return (False, error_str)
+    inicio = time.perf_counter()
+    with tramo('gemini', modelo=model_name) as etiquetas:
+        try:
+            model = obtener_modelo(model_name, tipo, 'texto')
+            response = model.generate_content(consulta)
+            enrutador.registrar(model_name, 'texto', True, time.perf_counter() - inicio)
+            return (True, response.text.strip())
+        except Exception as e:
+            etiquetas['error'] = True
+            enrutador.registrar(model_name, 'texto', False, time.perf_counter() - inicio)
+            return (False, clasificar_error(str(e), model_name))
 
 
+async def intentar_busqueda_con_modelo_async(model_name: str, tipo: str, consulta: str) -> tuple:
+    """Versión asíncrona de intentar_busqueda_con_modelo."""
+    inicio = time.perf_counter()
+    with tramo('gemini', modelo=model_name) as etiquetas:
+        try:
+            model = await asyncio.to_thread(obtener_modelo, model_name, tipo, 'texto')
+            response = await model.generate_content_async(consulta)
+            enrutador.registrar(model_name, 'texto', True, time.perf_counter() - inicio)
+            return (True, response.text.strip())
+        except Exception as e:
+            etiquetas['error'] = True
+            enrutador.registrar(model_name, 'texto', False, time.perf_counter() - inicio)
+            return (False, clasificar_error(str(e), model_name))
+
+
+SIN_MODELOS_BUSQUEDA = "No hay modelos disponibles. Verifica tu API Key."
+
+
+@con_refresco(busquedas)
+@coalescido
 def buscar_por_texto(consulta: str, tipo: str = "insecto") -> dict:
     """
     Busca información sobre un insecto o planta por nombre.
@@ -338,27 +576,16 @@ def buscar_por_texto(consulta: str, tipo: str = "insecto") -> dict:
     try:
         configure_gemini()
         
-        # Obtener el prompt de búsqueda
-        prompt = obtener_prompt_busqueda(tipo, consulta)
-        
         # Intentar con cada modelo disponible
         errores = []
         modelos_con_cuota_excedida = []
         
-        for modelo in MODELOS_DISPONIBLES:
-            exito, resultado = intentar_busqueda_con_modelo(modelo, prompt)
+        for modelo in enrutador.orden('texto'):
+            exito, resultado = intentar_busqueda_con_modelo(modelo, tipo, consulta)
             
             if exito:
                 # Limpiar y parsear la respuesta
-                response_text = resultado
-                
-                # Remover posibles marcadores de código markdown
-                if response_text.startswith('```'):
-                    response_text = re.sub(r'^```(?:json)?\n?', '', response_text)
-                    response_text = re.sub(r'\n?```$', '', response_text)
-                
-                # Parsear JSON
-                result = json.loads(response_text)
+                result = parsear_respuesta(resultado)
                 
                 # Agregar metadata al resultado
                 result['tipo'] = tipo
@@ -366,40 +593,48 @@ def buscar_por_texto(consulta: str, tipo: str = "insecto") -> dict:
                 result['metodo'] = 'busqueda_texto'
                 
                 return result
-            else:
-                if "quota_exceeded" in resultado:
-                    modelos_con_cuota_excedida.append(modelo)
-                elif "model_not_found" in resultado:
-                    continue
-                else:
-                    errores.append(f"{modelo}: {resultado}")
+            registrar_fallo(modelo, resultado, errores, modelos_con_cuota_excedida)
         
         # Si todos los modelos fallaron, analizar por qué
-        if modelos_con_cuota_excedida:
-            return {
-                "error": "⏰ ¡Has usado todas las consultas gratuitas de hoy! El límite de la API Free de Google Gemini se ha alcanzado. Intenta de nuevo en unos minutos o mañana.",
-                "tipo": tipo,
-                "codigo_error": "QUOTA_EXCEEDED"
-            }
-        
-        # Revisar si hubo errores de API Key
-        if errores and any("key_error" in err or "400" in err for err in errores):
-             return {
-                "error": "🔑 Tu API Key de Google Gemini parece haber expirado o es inválida. Por favor, genera una nueva en https://aistudio.google.com/app/apikey",
-                "tipo": tipo,
-                "codigo_error": "API_KEY_ERROR"
-            }
-        
-        if errores:
-            return {
-                "error": f"No se pudo realizar la búsqueda: {errores[0]}",
-                "tipo": tipo
-            }
+        return resultado_fallido(tipo, errores, modelos_con_cuota_excedida,
+                                 "No se pudo realizar la búsqueda", SIN_MODELOS_BUSQUEDA)
         
+    except json.JSONDecodeError as e:
         return {
-            "error": "No hay modelos disponibles. Verifica tu API Key.",
+            "error": f"Error al procesar la respuesta: {str(e)}",
+            "tipo": tipo
+        }
+    except Exception as e:
+        return {
+            "error": f"Error en la búsqueda: {str(e)}",
             "tipo": tipo
         }
+
+
+@con_refresco(busquedas, sincrona=buscar_por_texto)
+@coalescido
+async def buscar_por_texto_async(consulta: str, tipo: str = "insecto") -> dict:
+    """Versión asíncrona de buscar_por_texto, para el modo ASGI."""
+    try:
+        # La primera vez importa el SDK; al cambiar la clave borra cachés de contexto por la red
+        await asyncio.to_thread(configure_gemini)
+        
+        errores = []
+        modelos_con_cuota_excedida = []
+        
+        for modelo in enrutador.orden('texto'):
+            exito, resultado = await intentar_busqueda_con_modelo_async(modelo, tipo, consulta)
+            
+            if exito:
+                result = parsear_respuesta(resultado)
+                result['tipo'] = tipo
+                result['modelo_usado'] = modelo
+                result['metodo'] = 'busqueda_texto'
+                return result
+            registrar_fallo(modelo, resultado, errores, modelos_con_cuota_excedida)
+        
+        return resultado_fallido(tipo, errores, modelos_con_cuota_excedida,
+                                 "No se pudo realizar la búsqueda", SIN_MODELOS_BUSQUEDA)
         
     except json.JSONDecodeError as e:
         return {
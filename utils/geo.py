@@ -0,0 +1,128 @@
+"""
+NaturIA Chile - Utilidades geográficas
+Geohash para indexar descubrimientos por ubicación con índices B-tree
+normales (SQLite y Postgres, sin PostGIS): un rectángulo se cubre con unos
+pocos prefijos de geohash y cada prefijo es un rango del índice.
+"""
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION_GEOHASH = 9
+RADIO_TIERRA_KM = 6371.0
+
+# Zoom del mapa (estilo web mercator) → largo de prefijo para agrupar
+PRECISION_POR_ZOOM = [(4, 2), (7, 3), (9, 4), (11, 5)]
+
+
+def codificar_geohash(latitud: float, longitud: float, precision: int = PRECISION_GEOHASH) -> str:
+    """Codifica una coordenada como geohash de la precisión dada."""
+    lat_min, lat_max = -90.0, 90.0
+    lon_min, lon_max = -180.0, 180.0
+    resultado = []
+    bits, valor, par = 0, 0, True
+    while len(resultado) < precision:
+        if par:
+            medio = (lon_min + lon_max) / 2
+            if longitud >= medio:
+                valor = (valor << 1) | 1
+                lon_min = medio
+            else:
+                valor <<= 1
+                lon_max = medio
+        else:
+            medio = (lat_min + lat_max) / 2
+            if latitud >= medio:
+                valor = (valor << 1) | 1
+                lat_min = medio
+            else:
+                valor <<= 1
+                lat_max = medio
+        par = not par
+        bits += 1
+        if bits == 5:
+            resultado.append(BASE32[valor])
+            bits, valor = 0, 0
+    return ''.join(resultado)
+
+
+def decodificar_geohash(geohash: str) -> tuple:
+    """Retorna el centro (latitud, longitud) de la celda de un geohash."""
+    lat_min, lat_max = -90.0, 90.0
+    lon_min, lon_max = -180.0, 180.0
+    par = True
+    for caracter in geohash:
+        valor = BASE32.index(caracter)
+        for desplazamiento in range(4, -1, -1):
+            bit = (valor >> desplazamiento) & 1
+            if par:
+                medio = (lon_min + lon_max) / 2
+                lon_min, lon_max = (medio, lon_max) if bit else (lon_min, medio)
+            else:
+                medio = (lat_min + lat_max) / 2
+                lat_min, lat_max = (medio, lat_max) if bit else (lat_min, medio)
+            par = not par
+    return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+
+
+def tamano_celda(precision: int) -> tuple:
+    """Alto y ancho (grados) de una celda de geohash con esa precisión."""
+    bits = precision * 5
+    bits_lon = (bits + 1) // 2
+    bits_lat = bits // 2
+    return 180.0 / (2 ** bits_lat), 360.0 / (2 ** bits_lon)
+
+
+def celdas_para_bbox(sur: float, oeste: float, norte: float, este: float, max_celdas: int = 24) -> list:
+    """
+    Prefijos de geohash que cubren el rectángulo, con la mayor precisión
+    que no supere max_celdas (menos rangos que recorrer en el índice).
+    """
+    mejor = None
+    for precision in range(1, PRECISION_GEOHASH + 1):
+        alto, ancho = tamano_celda(precision)
+        filas = math.floor(norte / alto) - math.floor(sur / alto) + 1
+        columnas = math.floor(este / ancho) - math.floor(oeste / ancho) + 1
+        if filas * columnas > max_celdas:
+            break
+        mejor = precision
+    if mejor is None:
+        return ['']  # Rectángulo enorme: un solo rango que cubre todo
+
+    alto, ancho = tamano_celda(mejor)
+    celdas = set()
+    # Recorrer por el centro de cada fila/columna de celdas que toca el rectángulo
+    lat = (math.floor(sur / alto) + 0.5) * alto
+    while lat - alto / 2 <= norte:
+        lon = (math.floor(oeste / ancho) + 0.5) * ancho
+        while lon - ancho / 2 <= este:
+            celdas.add(codificar_geohash(max(-90.0, min(90.0, lat)), max(-180.0, min(180.0, lon)), mejor))
+            lon += ancho
+        lat += alto
+    return sorted(celdas)
+
+
+def bbox_de_radio(latitud: float, longitud: float, radio_km: float) -> tuple:
+    """Rectángulo (sur, oeste, norte, este) que contiene el círculo dado."""
+    delta_lat = math.degrees(radio_km / RADIO_TIERRA_KM)
+    coseno = max(math.cos(math.radians(latitud)), 1e-6)
+    delta_lon = min(180.0, delta_lat / coseno)
+    return (max(-90.0, latitud - delta_lat), max(-180.0, longitud - delta_lon),
+            min(90.0, latitud + delta_lat), min(180.0, longitud + delta_lon))
+
+
+def distancia_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia haversine entre dos coordenadas."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(math.sqrt(a))
+
+
+def precision_para_zoom(zoom: int):
+    """Largo de prefijo para agrupar a ese zoom, o None si se muestran puntos sueltos."""
+    for zoom_maximo, precision in PRECISION_POR_ZOOM:
+        if zoom <= zoom_maximo:
+            return precision
+    return None
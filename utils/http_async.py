@@ -0,0 +1,37 @@
+"""
+Cliente HTTP asíncrono compartido para el modo ASGI.
+Un solo httpx.AsyncClient por event loop reutiliza conexiones (keep-alive)
+hacia Wikipedia, Wikimedia Commons y Xeno-Canto en vez de abrir una por petición.
+"""
+
+import asyncio
+import os
+
+HTTP_MAX_CONEXIONES = int(os.getenv('HTTP_MAX_CONEXIONES', 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', 20))
+
+_clientes = {}
+
+
+def cliente_http():
+    """Retorna el cliente del event loop actual, creándolo en el primer uso."""
+    # httpx es una dependencia opcional (requirements-async.txt)
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    cliente = _clientes.get(loop)
+    if cliente is None or cliente.is_closed:
+        cliente = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONEXIONES,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            follow_redirects=True,
+        )
+        _clientes[loop] = cliente
+    return cliente
+
+
+async def cerrar_cliente_http():
+    """Cierra el cliente del event loop actual (al apagar el servidor)."""
+    cliente = _clientes.pop(asyncio.get_running_loop(), None)
+    if cliente is not None:
+        await cliente.aclose()
@@ -0,0 +1,284 @@
+"""
+NaturIA Chile - Índice de huellas visuales (near-duplicates)
+La misma mariposa fotografiada dos veces, o la misma foto reenviada desde
+otro teléfono (redimensionada o recomprimida), cambia todos sus bytes pero
+casi no cambia su dHash: una huella de 64 bits que compara el brillo de
+píxeles vecinos en una miniatura de 9x8.
+
+Cada identificación exitosa se guarda con su huella en un árbol BK por
+tipo. Si llega una foto a distancia de Hamming <= HUELLAS_UMBRAL de una ya
+identificada, se responde con ese resultado sin llamar a Gemini.
+
+- Persistencia: un JSONL de solo agregar (HUELLAS_ARCHIVO) con la huella,
+  el tipo y el resultado completo de cada identificación; se carga entero en
+  el primer uso.
+- Tope: a lo más HUELLAS_MAXIMO huellas. Al pasarlo se compacta: se vuelve
+  a leer el archivo, se conservan las más nuevas (90% del tope, para no
+  compactar en cada foto), se rearman los árboles y el archivo se reescribe
+  de una vez (os.replace).
+- El índice en memoria es de cada worker. El archivo es compartido: lo que
+  agrega otro worker se ve al reiniciar o en la próxima compactación.
+- Auditoría: una fracción HUELLAS_AUDITORIA de los aciertos se vuelve a
+  identificar con Gemini en segundo plano; si la especie no coincide se
+  cuenta como coincidencia falsa y se guarda para revisión.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+HUELLAS_ARCHIVO = os.getenv('HUELLAS_ARCHIVO')
+HUELLAS_UMBRAL = int(os.getenv('HUELLAS_UMBRAL', 6))
+HUELLAS_AUDITORIA = float(os.getenv('HUELLAS_AUDITORIA', 0.02))
+HUELLAS_MAXIMO = int(os.getenv('HUELLAS_MAXIMO', 50_000))
+
+# Con menos contraste que esto (fotos casi lisas u oscuras) el dHash es
+# puro ruido y chocaría con cualquier otra imagen lisa: no se indexa
+DESVIACION_MINIMA = 4.0
+
+_auditor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='auditoria-huellas')
+
+
+# Lado aproximado de la muestra de la que sale la miniatura de 9x8
+LADO_MUESTRA = 64
+MODOS_REDUCIBLES = {'L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr', 'I', 'F'}
+
+
+def _muestra(image):
+    """
+    La imagen reducida a unas decenas de píxeles por lado, sin convertir la
+    foto completa. Un JPEG aún sin decodificar se vuelve a leer a 1/8 de
+    escala (draft) en un objeto aparte: la imagen original, que puede ir a
+    Gemini, no cambia.
+    """
+    from PIL import Image
+    if image.format == 'JPEG' and image.tile and getattr(image, 'fp', None) is not None:
+        posicion = image.fp.tell()
+        try:
+            image.fp.seek(0)
+            muestra = Image.open(image.fp)
+            muestra.draft('L', (LADO_MUESTRA, LADO_MUESTRA))
+            muestra.load()
+            return muestra
+        except Exception:
+            pass  # Se calcula desde la imagen completa
+        finally:
+            image.fp.seek(posicion)
+    factor = min(image.width, image.height) // LADO_MUESTRA
+    if factor > 1 and image.mode in MODOS_REDUCIBLES:
+        return image.reduce(factor)
+    return image
+
+
+def calcular_huella(image):
+    """dHash de 64 bits de una imagen PIL, o None si la imagen es casi lisa."""
+    from PIL import Image
+    gris = _muestra(image).convert('L').resize((9, 8), Image.Resampling.BOX)
+    pixeles = gris.tobytes()
+    media = sum(pixeles) / len(pixeles)
+    if (sum((p - media) ** 2 for p in pixeles) / len(pixeles)) ** 0.5 < DESVIACION_MINIMA:
+        return None
+    huella = 0
+    for fila in range(8):
+        for columna in range(8):
+            izquierda, derecha = pixeles[fila * 9 + columna], pixeles[fila * 9 + columna + 1]
+            huella = (huella << 1) | (izquierda > derecha)
+    return huella
+
+
+def distancia(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class ArbolBK:
+    """Árbol BK sobre distancia de Hamming: búsqueda por radio sin recorrer todo."""
+
+    def __init__(self):
+        self.raiz = None
+        self.tamano = 0
+
+    def agregar(self, huella: int, valor):
+        """Agrega la huella; si ya existe idéntica, no hace nada y retorna False."""
+        nodo = [huella, valor, {}]
+        if self.raiz is None:
+            self.raiz = nodo
+            self.tamano = 1
+            return True
+        actual = self.raiz
+        while True:
+            d = distancia(huella, actual[0])
+            if d == 0:
+                return False
+            hijo = actual[2].get(d)
+            if hijo is None:
+                actual[2][d] = nodo
+                self.tamano += 1
+                return True
+            actual = hijo
+
+    def mas_cercano(self, huella: int, radio: int):
+        """(distancia, valor) del más cercano dentro del radio, o None."""
+        mejor = None
+        pendientes = [self.raiz] if self.raiz else []
+        while pendientes:
+            nodo = pendientes.pop()
+            d = distancia(huella, nodo[0])
+            if d <= radio and (mejor is None or d < mejor[0]):
+                mejor = (d, nodo[1])
+                if d == 0:
+                    break
+            # Desigualdad triangular: solo los hijos con |d_hijo - d| <= radio pueden estar cerca
+            pendientes.extend(hijo for dh, hijo in nodo[2].items() if d - radio <= dh <= d + radio)
+        return mejor
+
+
+class IndiceHuellas:
+    """Resultados de identificaciones anteriores, buscables por huella y tipo."""
+
+    def __init__(self, archivo: str = HUELLAS_ARCHIVO, umbral: int = HUELLAS_UMBRAL,
+                 auditoria: float = HUELLAS_AUDITORIA, maximo: int = HUELLAS_MAXIMO):
+        self.archivo = archivo
+        self.umbral = umbral
+        self.auditoria = auditoria
+        self.maximo = maximo
+        self._arboles = {}
+        # (tipo, huella) -> resultado, de la más antigua a la más nueva
+        self._entradas = {}
+        self._lock = threading.Lock()
+        self._cargado = False
+        self._contadores = dict.fromkeys(
+            ('consultas', 'aciertos', 'indexadas', 'compactaciones', 'auditadas', 'coincidencias_falsas'), 0)
+        self.discrepancias = deque(maxlen=50)
+
+    def _leer_archivo(self) -> dict:
+        entradas = {}
+        if not self.archivo or not os.path.exists(self.archivo):
+            return entradas
+        with open(self.archivo, encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    registro = json.loads(linea)
+                    # La primera vez que aparece una huella es la que vale (como en el árbol)
+                    entradas.setdefault((registro['t'], int(registro['h'], 16)), registro['r'])
+                except (ValueError, KeyError):
+                    continue  # Una línea cortada por un apagón no invalida el resto
+        return entradas
+
+    def _indexar(self, entradas: dict, limite: int):
+        """Arma los árboles con las `limite` entradas más nuevas."""
+        if len(entradas) > limite:
+            entradas = dict(list(entradas.items())[len(entradas) - limite:])
+        arboles = {}
+        for (tipo, huella), resultado in entradas.items():
+            arboles.setdefault(tipo, ArbolBK()).agregar(huella, resultado)
+        self._entradas, self._arboles = entradas, arboles
+
+    def _reescribir(self):
+        temporal = f'{self.archivo}.{os.getpid()}.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            for (tipo, huella), resultado in self._entradas.items():
+                f.write(json.dumps({'h': f'{huella:016x}', 't': tipo, 'r': resultado}, ensure_ascii=False) + '\n')
+        os.replace(temporal, self.archivo)
+
+    def _compactar(self):
+        # Se relee el archivo para no perder lo que agregaron otros workers
+        entradas = self._leer_archivo() if self.archivo else self._entradas
+        self._indexar(entradas, int(self.maximo * 0.9))
+        if self.archivo:
+            self._reescribir()
+        self._contadores['compactaciones'] += 1
+
+    def _cargar(self):
+        if self._cargado:
+            return
+        self._cargado = True
+        if not self.archivo or not os.path.exists(self.archivo):
+            return
+        inicio = time.perf_counter()
+        entradas = self._leer_archivo()
+        if len(entradas) > self.maximo:
+            self._compactar()
+        else:
+            self._indexar(entradas, self.maximo)
+        print(f"🔎 Índice de huellas: {len(self._entradas)} imágenes en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+
+    def buscar(self, huella, tipo: str):
+        """Copia del resultado de una foto casi idéntica del mismo tipo, o None."""
+        if huella is None:
+            return None
+        with self._lock:
+            self._cargar()
+            self._contadores['consultas'] += 1
+            arbol = self._arboles.get(tipo)
+            encontrado = arbol.mas_cercano(huella, self.umbral) if arbol else None
+            if encontrado is None:
+                return None
+            self._contadores['aciertos'] += 1
+        d, resultado = encontrado
+        return {**resultado, 'metodo': 'imagen_similar', 'distancia_huella': d}
+
+    def agregar(self, huella, tipo: str, resultado: dict):
+        """Indexa una identificación con especie (no los errores ni respuestas sin nombre)."""
+        if huella is None or 'error' in resultado or not resultado.get('cientifico'):
+            return
+        with self._lock:
+            self._cargar()
+            if not self._arboles.setdefault(tipo, ArbolBK()).agregar(huella, resultado):
+                return
+            self._entradas[(tipo, huella)] = resultado
+            self._contadores['indexadas'] += 1
+            if self.archivo:
+                os.makedirs(os.path.dirname(os.path.abspath(self.archivo)), exist_ok=True)
+                with open(self.archivo, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'h': f'{huella:016x}', 't': tipo, 'r': resultado},
+                                       ensure_ascii=False) + '\n')
+            if len(self._entradas) > self.maximo:
+                self._compactar()
+
+    def quizas_auditar(self, reutilizado: dict, identificar):
+        """Con probabilidad `auditoria`, compara el resultado reutilizado con uno nuevo de Gemini."""
+        if self.auditoria <= 0 or random.random() >= self.auditoria:
+            return None
+        return _auditor.submit(self._auditar, reutilizado, identificar)
+
+    def _auditar(self, reutilizado, identificar):
+        try:
+            nuevo = identificar()
+        except Exception as e:
+            print(f"⚠️  Error en la auditoría de huellas: {e}")
+            return
+        if 'error' in nuevo:
+            return
+        falsa = nuevo.get('cientifico', '').strip().lower() != reutilizado.get('cientifico', '').strip().lower()
+        with self._lock:
+            self._contadores['auditadas'] += 1
+            if falsa:
+                self._contadores['coincidencias_falsas'] += 1
+                self.discrepancias.append({
+                    'tipo': reutilizado.get('tipo'),
+                    'distancia': reutilizado.get('distancia_huella'),
+                    'reutilizado': reutilizado.get('cientifico'),
+                    'gemini': nuevo.get('cientifico'),
+                    'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                })
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            contadores = dict(self._contadores)
+            indexadas = len(self._entradas)
+            discrepancias = list(self.discrepancias)
+        return {
+            **contadores,
+            'en_indice': indexadas,
+            'tasa_aciertos': round(contadores['aciertos'] / contadores['consultas'], 3) if contadores['consultas'] else 0,
+            'tasa_coincidencias_falsas': (round(contadores['coincidencias_falsas'] / contadores['auditadas'], 3)
+                                          if contadores['auditadas'] else None),
+            'discrepancias': discrepancias,
+        }
+
+
+indice_huellas = IndiceHuellas()
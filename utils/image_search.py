@@ -4,13 +4,87 @@ Utilidad para buscar imágenes de especies en Wikipedia.
 
 import requests
 import urllib.parse
+from utils.coalescencia import coalescido
+from utils.enriquecimiento import con_refresco, imagenes
+from utils.http_async import cliente_http
+from utils.trazas import tramo
+from utils.upstream_simulado import url_servicio
 
 # User-Agent requerido por Wikipedia API
 HEADERS = {
     "User-Agent": "NaturIA-Chile/1.0 (https://github.com/naturia-chile; naturia@example.com) requests/2.0"
 }
 
+# Bases de Wikipedia (configurables para apuntar a un servidor de pruebas,
+# ver utils/upstream_simulado.py)
+WIKIPEDIA_EN = url_servicio('WIKIPEDIA_EN', "https://en.wikipedia.org")
+WIKIPEDIA_ES = url_servicio('WIKIPEDIA_ES', "https://es.wikipedia.org")
 
+
+def parametros_imagen(titulo: str) -> dict:
+    """Parámetros de la API para obtener la imagen principal de un artículo."""
+    return {
+        "action": "query",
+        "titles": titulo,
+        "prop": "pageimages",
+        "format": "json",
+        "pithumbsize": 500
+    }
+
+
+def parametros_busqueda(termino: str) -> dict:
+    """Parámetros de la API para buscar el artículo más relevante."""
+    return {
+        "action": "query",
+        "list": "search",
+        "srsearch": termino,
+        "format": "json",
+        "srlimit": 1
+    }
+
+
+def extraer_miniatura(img_data: dict) -> str:
+    """URL de la miniatura en una respuesta de pageimages, o None."""
+    pages = img_data.get("query", {}).get("pages", {})
+    for page_id, page_info in pages.items():
+        if page_id != "-1" and "thumbnail" in page_info:
+            return page_info["thumbnail"]["source"]
+    return None
+
+
+def extraer_titulo(data: dict) -> str:
+    """Título del primer resultado de una búsqueda, o None."""
+    if data.get("query", {}).get("search"):
+        return data["query"]["search"][0]["title"]
+    return None
+
+
+def pasos_busqueda(nombre_cientifico: str, nombre_comun: str = None):
+    """
+    Orden en que se consultan las fuentes: ('titulo' | 'busqueda', término, wiki).
+    Compartido por la versión síncrona y la asíncrona.
+    """
+    # ESTRATEGIA 1: Buscar directamente con nombre científico en Wikipedia inglés
+    # (mejor fuente para especies biológicas), luego en español
+    if nombre_cientifico:
+        for wiki_base in [WIKIPEDIA_EN, WIKIPEDIA_ES]:
+            yield ('titulo', nombre_cientifico, wiki_base)
+            yield ('busqueda', nombre_cientifico, wiki_base)
+    
+    # ESTRATEGIA 2: Si el nombre científico falló, intentar con nombre común
+    # pero agregando contexto para evitar ambigüedades
+    if nombre_comun:
+        terminos_busqueda = [
+            f"{nombre_comun} insecto",
+            f"{nombre_comun} animal",
+            nombre_comun
+        ]
+        for termino in terminos_busqueda:
+            for wiki_base in [WIKIPEDIA_EN, WIKIPEDIA_ES]:
+                yield ('busqueda', termino, wiki_base)
+
+
+@con_refresco(imagenes)
 def buscar_imagen_wikipedia(nombre_cientifico: str, nombre_comun: str = None) -> str:
     """
     Busca una imagen en Wikipedia para la especie dada.
@@ -27,30 +101,19 @@ def buscar_imagen_wikipedia(nombre_cientifico: str, nombre_comun: str = None) ->
     def buscar_imagen_con_titulo(titulo: str, wiki_base: str) -> str:
         """Busca la imagen de un artículo específico en Wikipedia."""
         try:
-            image_params = {
-                "action": "query",
-                "titles": titulo,
-                "prop": "pageimages",
-                "format": "json",
-                "pithumbsize": 500
-            }
-            img_response = requests.get(
-                f"{wiki_base}/w/api.php", 
-                params=image_params, 
-                headers=HEADERS,
-                timeout=5
-            )
+            with tramo('http', servicio='wikipedia'):
+                img_response = requests.get(
+                    f"{wiki_base}/w/api.php", 
+                    params=parametros_imagen(titulo), 
+                    headers=HEADERS,
+                    timeout=5
+                )
             
             if img_response.status_code != 200:
                 print(f"Error HTTP {img_response.status_code} para '{titulo}'")
                 return None
                 
-            img_data = img_response.json()
-            
-            pages = img_data.get("query", {}).get("pages", {})
-            for page_id, page_info in pages.items():
-                if page_id != "-1" and "thumbnail" in page_info:
-                    return page_info["thumbnail"]["source"]
+            return extraer_miniatura(img_response.json())
         except requests.exceptions.RequestException as e:
             print(f"Error de conexión buscando imagen para '{titulo}': {e}")
         except ValueError as e:
@@ -62,29 +125,20 @@ def buscar_imagen_wikipedia(nombre_cientifico: str, nombre_comun: str = None) ->
     def buscar_articulo_y_obtener_imagen(termino: str, wiki_base: str) -> str:
         """Busca un artículo y obtiene su imagen principal."""
         try:
-            search_params = {
-                "action": "query",
-                "list": "search",
-                "srsearch": termino,
-                "format": "json",
-                "srlimit": 1
-            }
-            
-            response = requests.get(
-                f"{wiki_base}/w/api.php", 
-                params=search_params, 
-                headers=HEADERS,
-                timeout=5
-            )
+            with tramo('http', servicio='wikipedia'):
+                response = requests.get(
+                    f"{wiki_base}/w/api.php", 
+                    params=parametros_busqueda(termino), 
+                    headers=HEADERS,
+                    timeout=5
+                )
             
             if response.status_code != 200:
                 print(f"Error HTTP {response.status_code} buscando '{termino}'")
                 return None
                 
-            data = response.json()
-            
-            if data.get("query", {}).get("search"):
-                titulo = data["query"]["search"][0]["title"]
+            titulo = extraer_titulo(response.json())
+            if titulo:
                 return buscar_imagen_con_titulo(titulo, wiki_base)
         except requests.exceptions.RequestException as e:
             print(f"Error de conexión buscando artículo para '{termino}': {e}")
@@ -94,44 +148,47 @@ def buscar_imagen_wikipedia(nombre_cientifico: str, nombre_comun: str = None) ->
             print(f"Error inesperado buscando artículo para '{termino}': {e}")
         return None
     
-    # ESTRATEGIA 1: Buscar directamente con nombre científico en Wikipedia inglés
-    # (mejor fuente para especies biológicas)
-    if nombre_cientifico:
-        # Intentar acceso directo al artículo con el nombre científico
-        imagen = buscar_imagen_con_titulo(nombre_cientifico, "https://en.wikipedia.org")
+    for paso, termino, wiki_base in pasos_busqueda(nombre_cientifico, nombre_comun):
+        if paso == 'titulo':
+            imagen = buscar_imagen_con_titulo(termino, wiki_base)
+        else:
+            imagen = buscar_articulo_y_obtener_imagen(termino, wiki_base)
         if imagen:
             return imagen
-        
-        # Buscar artículo en inglés
-        imagen = buscar_articulo_y_obtener_imagen(nombre_cientifico, "https://en.wikipedia.org")
-        if imagen:
-            return imagen
-        
-        # Intentar en español con nombre científico
-        imagen = buscar_imagen_con_titulo(nombre_cientifico, "https://es.wikipedia.org")
-        if imagen:
-            return imagen
-        
-        imagen = buscar_articulo_y_obtener_imagen(nombre_cientifico, "https://es.wikipedia.org")
+    
+    return None
+
+
+@con_refresco(imagenes, sincrona=buscar_imagen_wikipedia)
+async def buscar_imagen_wikipedia_async(nombre_cientifico: str, nombre_comun: str = None) -> str:
+    """Versión asíncrona de buscar_imagen_wikipedia (mismo orden de búsqueda)."""
+    cliente = cliente_http()
+    
+    async def consultar(wiki_base: str, params: dict, descripcion: str) -> dict:
+        try:
+            with tramo('http', servicio='wikipedia'):
+                response = await cliente.get(f"{wiki_base}/w/api.php", params=params, headers=HEADERS, timeout=5)
+            if response.status_code != 200:
+                print(f"Error HTTP {response.status_code} {descripcion}")
+                return None
+            return response.json()
+        except ValueError as e:
+            print(f"Error parseando JSON {descripcion}: {e}")
+        except Exception as e:
+            print(f"Error de conexión {descripcion}: {e}")
+        return None
+    
+    for paso, termino, wiki_base in pasos_busqueda(nombre_cientifico, nombre_comun):
+        if paso == 'busqueda':
+            data = await consultar(wiki_base, parametros_busqueda(termino), f"buscando '{termino}'")
+            termino = extraer_titulo(data) if data else None
+            if not termino:
+                continue
+        img_data = await consultar(wiki_base, parametros_imagen(termino), f"para '{termino}'")
+        imagen = extraer_miniatura(img_data) if img_data else None
         if imagen:
             return imagen
     
-    # ESTRATEGIA 2: Si el nombre científico falló, intentar con nombre común
-    # pero agregando contexto para evitar ambigüedades
-    if nombre_comun:
-        # Añadir contexto biológico para búsqueda más precisa
-        terminos_busqueda = [
-            f"{nombre_comun} insecto",
-            f"{nombre_comun} animal",
-            nombre_comun
-        ]
-        
-        for termino in terminos_busqueda:
-            for wiki_base in ["https://en.wikipedia.org", "https://es.wikipedia.org"]:
-                imagen = buscar_articulo_y_obtener_imagen(termino, wiki_base)
-                if imagen:
-                    return imagen
-    
     return None
 
 
@@ -154,6 +211,7 @@ def buscar_imagen_alternativa(consulta: str, tipo: str = "insecto") -> str:
         return "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 100'%3E%3Ccircle cx='50' cy='50' r='45' fill='%2334A853'/%3E%3Ctext x='50' y='60' font-size='40' text-anchor='middle' fill='white'%3E🌿%3C/text%3E%3C/svg%3E"
 
 
+@coalescido
 def obtener_imagen_especie(nombre_cientifico: str, nombre_comun: str = None, tipo: str = "insecto") -> str:
     """
     Obtiene la mejor imagen disponible para una especie.
@@ -175,3 +233,13 @@ def obtener_imagen_especie(nombre_cientifico: str, nombre_comun: str = None, tip
     # Si no hay imagen, usar placeholder
     return buscar_imagen_alternativa(nombre_comun or nombre_cientifico, tipo)
 
+
+@coalescido
+async def obtener_imagen_especie_async(nombre_cientifico: str, nombre_comun: str = None, tipo: str = "insecto") -> str:
+    """Versión asíncrona de obtener_imagen_especie."""
+    imagen = await buscar_imagen_wikipedia_async(nombre_cientifico, nombre_comun)
+    
+    if imagen:
+        return imagen
+    
+    return buscar_imagen_alternativa(nombre_comun or nombre_cientifico, tipo)
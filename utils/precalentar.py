@@ -0,0 +1,154 @@
+"""
+NaturIA Chile - Precalentamiento de cachés
+Después de un despliegue (o de vaciar las cachés) los primeros usuarios
+pagarían Gemini + Wikipedia + Xeno-Canto completos por cada especie
+popular. `flask precalentar` resuelve de antemano, con un pool de hilos
+acotado y un límite de peticiones por segundo:
+
+- la búsqueda por texto de Gemini (como /buscar), y la imagen y el sonido
+  de la especie que devuelve;
+- la imagen y el sonido de las especies con nombre científico conocido
+  (catálogo, AVES_CHILE y las más descubiertas).
+
+Las llamadas son las mismas (y con los mismos argumentos) que hacen las
+rutas, así que llenan exactamente las entradas que después se consultan.
+El avance se guarda en un archivo: si se corta, se retoma donde quedó.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import enriquecimiento
+from utils.gemini_client import buscar_por_texto
+from utils.image_search import obtener_imagen_especie
+from utils.sound_search import AVES_CHILE, SONIDOS_INSECTOS, buscar_sonido
+
+
+class LimiteTasa:
+    """Cubeta de fichas compartida por los hilos: como máximo `por_segundo` llamadas por segundo."""
+
+    def __init__(self, por_segundo: float):
+        self.intervalo = 1 / por_segundo if por_segundo > 0 else 0
+        self._proxima = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        if not self.intervalo:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._proxima)
+            self._proxima = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+def especies_a_precalentar(catalogo: list, populares: list) -> list:
+    """
+    (nombre, nombre_cientifico o None, tipo) sin repetir, en orden de
+    prioridad: más descubiertas, catálogo, AVES_CHILE y SONIDOS_INSECTOS.
+    """
+    candidatas = list(populares)
+    candidatas += [(e['nombre_comun'], e['nombre_cientifico'], e['tipo']) for e in catalogo]
+    candidatas += [(nombre, cientifico, 'ave') for nombre, cientifico in AVES_CHILE.items()]
+    candidatas += [(nombre, None, 'insecto') for nombre in SONIDOS_INSECTOS]
+    vistas, especies = set(), []
+    for nombre, cientifico, tipo in candidatas:
+        clave = (nombre.strip().lower(), tipo)
+        if clave not in vistas:
+            vistas.add(clave)
+            especies.append((nombre, cientifico, tipo))
+    return especies
+
+
+def id_tarea(especie) -> str:
+    nombre, cientifico, tipo = especie
+    return f'{tipo}:{nombre.strip().lower()}:{(cientifico or "").strip().lower()}'
+
+
+def precalentar_especie(especie, limite: LimiteTasa, con_gemini: bool = True):
+    """
+    Resuelve búsqueda, imagen y sonido de una especie. Retorna cuántas
+    llamadas hizo; si Gemini falló lanza RuntimeError (queda pendiente).
+    """
+    nombre, cientifico, tipo = especie
+    pares, error_gemini = [], None
+    if con_gemini:
+        limite.esperar()
+        resultado = buscar_por_texto(nombre, tipo)
+        if 'error' in resultado:
+            error_gemini = resultado['error']
+        else:
+            pares.append((resultado.get('cientifico', ''), resultado.get('nombre', '')))
+    if cientifico:
+        pares.append((cientifico, nombre))
+
+    llamadas = int(con_gemini)
+    for cientifico_par, nombre_par in dict.fromkeys(pares):
+        limite.esperar()
+        obtener_imagen_especie(cientifico_par, nombre_par, tipo)
+        llamadas += 1
+        if tipo != 'planta':
+            limite.esperar()
+            buscar_sonido(nombre_par, cientifico_par, tipo)
+            llamadas += 1
+    if error_gemini:
+        raise RuntimeError(error_gemini)
+    return llamadas
+
+
+def precalentar(especies: list, archivo_avance: str, archivo_cache: str, hilos: int = 4,
+                por_segundo: float = 2.0, con_gemini: bool = True, reiniciar: bool = False,
+                informar=print) -> dict:
+    """
+    Precalienta las especies pendientes y vuelca las cachés a `archivo_cache`
+    cada pocos segundos y al terminar. Retorna un resumen.
+    """
+    hechas = set()
+    if not reiniciar and os.path.exists(archivo_avance):
+        with open(archivo_avance, encoding='utf-8') as f:
+            hechas = set(json.load(f).get('hechas', []))
+    pendientes = [e for e in especies if id_tarea(e) not in hechas]
+    informar(f"🔥 {len(pendientes)} especies pendientes ({len(hechas)} ya hechas), "
+             f"{hilos} hilos, {por_segundo:g} llamadas/s")
+
+    def guardar_avance():
+        enriquecimiento.guardar_archivo(archivo_cache)
+        temporal = f'{archivo_avance}.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({'hechas': sorted(hechas)}, f)
+        os.replace(temporal, archivo_avance)
+
+    limite = LimiteTasa(por_segundo)
+    inicio = ultimo_guardado = ultimo_informe = time.monotonic()
+    completadas = llamadas = errores = 0
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='precalentar') as pool:
+        futuros = {pool.submit(precalentar_especie, e, limite, con_gemini): e for e in pendientes}
+        for futuro in as_completed(futuros):
+            especie = futuros[futuro]
+            try:
+                llamadas += futuro.result()
+                hechas.add(id_tarea(especie))
+            except Exception as e:
+                errores += 1
+                informar(f"⚠️  {especie[0]} ({especie[2]}): {e}")
+            completadas += 1
+
+            ahora = time.monotonic()
+            if ahora - ultimo_informe >= 2 or completadas == len(pendientes):
+                ultimo_informe = ahora
+                transcurrido = max(ahora - inicio, 1e-6)
+                informar(f"   {completadas}/{len(pendientes)} ({completadas / len(pendientes):.0%}) · "
+                         f"{completadas / transcurrido:.1f} especies/s · "
+                         f"{llamadas / transcurrido:.1f} llamadas/s · {errores} errores")
+            if ahora - ultimo_guardado >= 10:
+                ultimo_guardado = ahora
+                guardar_avance()
+
+    guardar_avance()
+    duracion = time.monotonic() - inicio
+    return {'especies': completadas, 'llamadas': llamadas, 'errores': errores,
+            'segundos': round(duracion, 1), 'pendientes': len(pendientes) - completadas + errores}
@@ -0,0 +1,270 @@
+"""
+NaturIA Chile - Escritura diferida de puntos (write-behind)
+El frontend llama a /sincronizar_puntos cada vez que gana puntos, con su
+total actual. Escribir cada llamada en su propia transacción serializa a
+todos los workers en SQLite, así que los totales se acumulan en memoria
+(gana el último por usuario) y se escriben juntos en una sola transacción
+cada PUNTOS_FLUSH_MS milisegundos, o antes si hay PUNTOS_FLUSH_MAXIMO
+usuarios pendientes.
+
+- Lectura de lo propio, por worker: pendiente(user_id) entrega el total aún
+  no escrito que recibió este proceso, y la app lo superpone al usuario
+  cargado. Otro worker ve el valor de la base hasta que se escribe el lote
+  (a lo más PUNTOS_FLUSH_MS después).
+- Durabilidad: con una carpeta de log, cada total se agrega primero a un
+  archivo del proceso (puntos-<pid>-<n>.log); el segmento se borra cuando
+  su lote queda escrito. Al arrancar se recuperan los segmentos de procesos
+  que ya no existen (p. ej. un worker que se cayó). Cada proceso mantiene un
+  flock sobre sus segmentos hasta borrarlos: un segmento se da por huérfano
+  solo si se puede bloquear, así que un PID reciclado no lo confunde, y como
+  el bloqueo es también el reclamo, dos workers que arrancan a la vez no
+  recuperan el mismo segmento. Sin fcntl (Windows) se revisa el PID y el
+  segmento se reclama renombrándolo.
+- Al apagar (atexit) se escribe lo pendiente.
+- PUNTOS_FLUSH_MS=0 desactiva el buffer: cada total se escribe al llegar.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+PUNTOS_FLUSH_MS = float(os.getenv('PUNTOS_FLUSH_MS', 500))
+PUNTOS_FLUSH_MAXIMO = int(os.getenv('PUNTOS_FLUSH_MAXIMO', 100))
+PUNTOS_LOG_DIR = os.getenv('PUNTOS_LOG_DIR')
+
+logger = logging.getLogger(__name__)
+
+
+def _proceso_vivo(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+class BufferPuntos:
+    """Totales de puntos por usuario pendientes de escribir, con log opcional."""
+
+    def __init__(self, escribir_lote, intervalo_ms: float = PUNTOS_FLUSH_MS,
+                 maximo: int = PUNTOS_FLUSH_MAXIMO, carpeta_log: str = PUNTOS_LOG_DIR):
+        # escribir_lote({user_id: total}) debe escribir todo en una transacción o lanzar
+        self.escribir_lote = escribir_lote
+        self.intervalo_ms = intervalo_ms
+        self.maximo = maximo
+        self.carpeta_log = carpeta_log
+        self._pendientes = {}
+        # Lote que se está escribiendo: sigue visible para pendiente() hasta el commit
+        self._escribiendo = {}
+        self._lock = threading.Lock()
+        self._lock_escritura = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._pid = None
+        self._segmento = 0
+        self._reclamos = 0
+        self._log = None
+        self.lotes = 0
+        self.escritos = 0
+
+    # ----- Log -----
+
+    def _ruta_segmento(self, numero):
+        return os.path.join(self.carpeta_log, f'puntos-{os.getpid()}-{numero}.log')
+
+    def _abrir_segmento(self):
+        """
+        Abre el siguiente segmento y retorna el anterior, que queda abierto (y
+        bloqueado) hasta que _cerrar_segmento lo borre.
+        """
+        anterior = self._log
+        self._segmento += 1
+        self._log = open(self._ruta_segmento(self._segmento), 'a', encoding='utf-8')
+        if fcntl is not None:
+            fcntl.flock(self._log, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return anterior
+
+    @staticmethod
+    def _cerrar_segmento(segmento):
+        # Se borra antes de cerrar: el bloqueo cubre el archivo hasta que ya no existe
+        os.remove(segmento.name)
+        segmento.close()
+
+    def _reclamar(self, ruta):
+        """Abre un segmento huérfano para recuperarlo, o None si tiene dueño o ya lo reclamó otro."""
+        if fcntl is None:
+            try:
+                pid = int(os.path.basename(ruta).split('-')[1])
+            except (IndexError, ValueError):
+                return None
+            if pid == os.getpid() or _proceso_vivo(pid):
+                return None
+            self._reclamos += 1
+            reclamada = self._ruta_segmento(f'r{self._reclamos}')
+            try:
+                # Atómico: si dos procesos lo intentan, solo uno encuentra el archivo
+                os.rename(ruta, reclamada)
+            except FileNotFoundError:
+                return None
+            return open(reclamada, encoding='utf-8')
+        try:
+            segmento = open(ruta, encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(segmento, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Si el dueño lo borró entre el open y el flock, el bloqueo es de un archivo que ya no está
+            if os.fstat(segmento.fileno()).st_ino != os.stat(ruta).st_ino:
+                raise FileNotFoundError(ruta)
+        except (BlockingIOError, FileNotFoundError):
+            segmento.close()
+            return None
+        return segmento
+
+    def _anotar(self, user_id, puntos):
+        if self.carpeta_log:
+            if self._log is None:
+                os.makedirs(self.carpeta_log, exist_ok=True)
+                self._abrir_segmento()
+            self._log.write(json.dumps({'u': user_id, 'p': puntos}) + '\n')
+            # Sin fsync: sobrevive a la caída del proceso (no a un corte de luz)
+            self._log.flush()
+
+    def recuperar(self) -> int:
+        """Carga los segmentos de procesos muertos como pendientes. Retorna cuántos usuarios."""
+        if not self.carpeta_log:
+            return 0
+        recuperados = {}
+        segmentos = []
+        rutas = []
+        for ruta in glob.glob(os.path.join(self.carpeta_log, 'puntos-*.log')):
+            try:
+                rutas.append((os.path.getmtime(ruta), ruta))
+            except FileNotFoundError:
+                continue  # Lo borró su dueño o lo reclamó otro worker
+        for _, ruta in sorted(rutas):
+            segmento = self._reclamar(ruta)
+            if segmento is None:
+                continue
+            for linea in segmento:
+                try:
+                    registro = json.loads(linea)
+                    recuperados[registro['u']] = registro['p']
+                except (ValueError, KeyError):
+                    continue  # Última línea a medio escribir
+            segmentos.append(segmento)
+        with self._lock:
+            for user_id, puntos in recuperados.items():
+                # Lo recibido en este proceso es más nuevo que lo recuperado
+                if user_id not in self._pendientes:
+                    self._pendientes[user_id] = puntos
+                    self._anotar(user_id, puntos)
+        # Ya están anotados en el segmento propio
+        for segmento in segmentos:
+            self._cerrar_segmento(segmento)
+        if recuperados:
+            logger.warning('Recuperados puntos pendientes de %d usuarios', len(recuperados))
+            self._asegurar_hilo()
+        return len(recuperados)
+
+    # ----- Buffer -----
+
+    def registrar(self, user_id: int, puntos: int):
+        """Anota el total de un usuario; se escribirá en el próximo lote."""
+        if self.intervalo_ms <= 0:
+            self.escribir_lote({user_id: puntos})
+            return
+        with self._lock:
+            self._pendientes[user_id] = puntos
+            self._anotar(user_id, puntos)
+            lleno = len(self._pendientes) >= self.maximo
+        self._asegurar_hilo()
+        if lleno:
+            self._despertar.set()
+
+    def pendiente(self, user_id: int):
+        """Total aún no escrito de un usuario, o None."""
+        puntos = self._pendientes.get(user_id)
+        return self._escribiendo.get(user_id) if puntos is None else puntos
+
+    def vaciar(self) -> int:
+        """Escribe lo pendiente en una transacción. Retorna cuántos usuarios escribió."""
+        with self._lock_escritura:
+            with self._lock:
+                if not self._pendientes:
+                    return 0
+                lote, self._pendientes = self._pendientes, {}
+                self._escribiendo = lote
+                # Lo que llegue desde ahora va a un segmento nuevo; este se borra al escribir el lote
+                segmento = self._abrir_segmento() if self._log is not None else None
+            try:
+                self.escribir_lote(lote)
+            except Exception:
+                with self._lock:
+                    self._escribiendo = {}
+                    # Se reintenta en el próximo lote, salvo lo que ya llegó más nuevo
+                    for user_id, puntos in lote.items():
+                        if user_id not in self._pendientes:
+                            self._pendientes[user_id] = puntos
+                            self._anotar(user_id, puntos)
+                if segmento:
+                    self._cerrar_segmento(segmento)
+                raise
+            self._escribiendo = {}
+            if segmento:
+                self._cerrar_segmento(segmento)
+            self.lotes += 1
+            self.escritos += len(lote)
+            return len(lote)
+
+    # ----- Hilo de fondo -----
+
+    def _asegurar_hilo(self):
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe en el hijo
+        if self._hilo is not None and self._pid == os.getpid() and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._hilo is not None and self._pid == os.getpid() and self._hilo.is_alive():
+                return
+            self._pid = os.getpid()
+            self._hilo = threading.Thread(target=self._bucle, name='puntos-diferidos', daemon=True)
+            self._hilo.start()
+
+    def _bucle(self):
+        while not self._detener.is_set() and self.intervalo_ms > 0:
+            self._despertar.wait(self.intervalo_ms / 1000)
+            self._despertar.clear()
+            try:
+                self.vaciar()
+            except Exception:
+                logger.exception('Error escribiendo puntos pendientes')
+
+    def detener(self):
+        """Detiene el hilo y escribe lo pendiente (al apagar el proceso)."""
+        self._detener.set()
+        self._despertar.set()
+        if self._hilo is not None and self._pid == os.getpid():
+            self._hilo.join(timeout=5)
+        try:
+            self.vaciar()
+        except Exception:
+            logger.exception('No se pudieron escribir los puntos pendientes al apagar')
+        if self._log is not None:
+            if os.path.getsize(self._log.name) == 0:
+                os.remove(self._log.name)
+            self._log.close()
+            self._log = None
+
+    def instalar_atexit(self):
+        atexit.register(self.detener)
@@ -0,0 +1,180 @@
+"""
+NaturIA Chile - Ranking de exploradores
+Mantiene las tablas de posiciones precalculadas (global, semanal y mensual)
+y las actualiza de forma incremental cuando cambian los puntos.
+
+Si hay REDIS_URL se usan sorted sets de Redis, compartidos por todos los
+workers de gunicorn. Sin Redis se usa una estructura ordenada en memoria
+por proceso, que se reconstruye periódicamente desde la base de datos.
+"""
+
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+
+VENTANAS = ('global', 'semana', 'mes')
+
+# Prefijo de las claves en Redis
+PREFIJO = 'naturia:ranking:'
+
+
+def clave_ventana(ventana: str, fecha: datetime = None) -> str:
+    """Devuelve la clave de la tabla para la ventana que contiene la fecha dada."""
+    if ventana == 'global':
+        return 'global'
+    fecha = fecha or datetime.utcnow()
+    if ventana == 'semana':
+        anio, semana, _ = fecha.isocalendar()
+        return f'semana:{anio}-W{semana:02d}'
+    if ventana == 'mes':
+        return f'mes:{fecha:%Y-%m}'
+    raise ValueError(f'Ventana desconocida: {ventana}')
+
+
+def inicio_ventana(ventana: str, fecha: datetime = None) -> datetime:
+    """Primer instante de la ventana que contiene la fecha (None para 'global')."""
+    fecha = fecha or datetime.utcnow()
+    dia = fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+    if ventana == 'semana':
+        return dia - timedelta(days=dia.weekday())
+    if ventana == 'mes':
+        return dia.replace(day=1)
+    return None
+
+
+class RankingMemoria:
+    """
+    Tablas de posiciones en memoria del proceso.
+    Cada tabla es una lista ordenada de (-puntos, user_id) más un dict de
+    puntajes, así que la posición de un usuario se obtiene con bisect en O(log n).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tablas = {}
+        self._ultima_reconstruccion = 0.0
+
+    def _tabla(self, clave):
+        if clave not in self._tablas:
+            self._tablas[clave] = ([], {})
+        return self._tablas[clave]
+
+    def _fijar(self, clave, user_id, puntos):
+        orden, puntajes = self._tabla(clave)
+        anterior = puntajes.get(user_id)
+        if anterior is not None:
+            del orden[bisect.bisect_left(orden, (-anterior, user_id))]
+        puntajes[user_id] = puntos
+        bisect.insort(orden, (-puntos, user_id))
+
+    def fijar(self, clave, user_id, puntos):
+        with self._lock:
+            self._fijar(clave, user_id, int(puntos))
+
+    def incrementar(self, clave, user_id, delta):
+        with self._lock:
+            _, puntajes = self._tabla(clave)
+            self._fijar(clave, user_id, puntajes.get(user_id, 0) + int(delta))
+
+    def posicion(self, clave, user_id):
+        """Retorna (posición, puntos) o None. Los empates comparten posición."""
+        with self._lock:
+            orden, puntajes = self._tabla(clave)
+            puntos = puntajes.get(user_id)
+            if puntos is None:
+                return None
+            return bisect.bisect_left(orden, (-puntos,)) + 1, puntos
+
+    def top(self, clave, limite):
+        with self._lock:
+            orden, _ = self._tabla(clave)
+            return [(user_id, -neg) for neg, user_id in orden[:limite]]
+
+    def reemplazar(self, tablas: dict):
+        """Sustituye todas las tablas por las recalculadas {clave: {user_id: puntos}}."""
+        nuevas = {}
+        for clave, puntajes in tablas.items():
+            orden = sorted((-int(p), uid) for uid, p in puntajes.items())
+            nuevas[clave] = (orden, {uid: int(p) for uid, p in puntajes.items()})
+        with self._lock:
+            self._tablas = nuevas
+
+    def reclamar_reconstruccion(self, intervalo):
+        """True si este proceso debe reconstruir (nunca lo hizo o pasó el intervalo)."""
+        with self._lock:
+            ahora = time.time()
+            if ahora - self._ultima_reconstruccion < intervalo:
+                return False
+            self._ultima_reconstruccion = ahora
+            return True
+
+
+class RankingRedis:
+    """Tablas de posiciones en sorted sets de Redis, compartidas entre workers."""
+
+    # Las ventanas cerradas se conservan un tiempo y luego expiran solas
+    TTL_VENTANA = 60 * 60 * 24 * 62
+
+    def __init__(self, cliente):
+        self._r = cliente
+
+    def _expirar(self, pipe, clave):
+        if clave != 'global':
+            pipe.expire(PREFIJO + clave, self.TTL_VENTANA)
+
+    def fijar(self, clave, user_id, puntos):
+        pipe = self._r.pipeline()
+        pipe.zadd(PREFIJO + clave, {str(user_id): int(puntos)})
+        self._expirar(pipe, clave)
+        pipe.execute()
+
+    def incrementar(self, clave, user_id, delta):
+        pipe = self._r.pipeline()
+        pipe.zincrby(PREFIJO + clave, int(delta), str(user_id))
+        self._expirar(pipe, clave)
+        pipe.execute()
+
+    def posicion(self, clave, user_id):
+        puntos = self._r.zscore(PREFIJO + clave, str(user_id))
+        if puntos is None:
+            return None
+        # ZCOUNT sobre un sorted set es O(log n)
+        mayores = self._r.zcount(PREFIJO + clave, f'({puntos}', '+inf')
+        return mayores + 1, int(puntos)
+
+    def top(self, clave, limite):
+        filas = self._r.zrevrange(PREFIJO + clave, 0, limite - 1, withscores=True)
+        return [(int(uid), int(puntos)) for uid, puntos in filas]
+
+    def reemplazar(self, tablas: dict):
+        # Se escribe en claves temporales y se renombra para no exponer tablas a medias
+        pipe = self._r.pipeline()
+        for clave, puntajes in tablas.items():
+            temporal = f'{PREFIJO}{clave}:reconstruyendo'
+            pipe.delete(temporal)
+            if puntajes:
+                pipe.zadd(temporal, {str(uid): int(p) for uid, p in puntajes.items()})
+                pipe.rename(temporal, PREFIJO + clave)
+                self._expirar(pipe, clave)
+            else:
+                pipe.delete(PREFIJO + clave)
+        pipe.execute()
+
+    def reclamar_reconstruccion(self, intervalo):
+        # SET NX con expiración: solo un worker reconstruye por intervalo
+        return bool(self._r.set(PREFIJO + 'reconstruccion', str(time.time()),
+                                nx=True, ex=max(1, int(intervalo))))
+
+
+def crear_ranking(redis_url: str = None):
+    """Crea el ranking con Redis si está configurado, o en memoria si no."""
+    if redis_url:
+        try:
+            import redis
+            cliente = redis.Redis.from_url(redis_url, decode_responses=True)
+            cliente.ping()
+            return RankingRedis(cliente)
+        except Exception as e:
+            print(f"⚠️  Ranking sin Redis ({e}), usando memoria del proceso")
+    return RankingMemoria()
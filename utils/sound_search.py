@@ -5,12 +5,17 @@ Integración con Xeno-Canto API para sonidos de aves
 
 import requests
 import urllib.parse
+from utils.coalescencia import coalescido
+from utils.enriquecimiento import con_refresco, sonidos
+from utils.http_async import cliente_http
+from utils.trazas import tramo
+from utils.upstream_simulado import url_servicio
 
 # Base URL de la API de Xeno-Canto (v3 requiere API Key, v2 está descontinuada)
-XENO_CANTO_API = "https://xeno-canto.org/api/3/recordings"
+XENO_CANTO_API = url_servicio('XENO_CANTO_API', "https://xeno-canto.org/api/3/recordings")
 
 # Endpoint de Wikimedia Commons para búsqueda de archivos
-WIKIMEDIA_API = "https://commons.wikimedia.org/w/api.php"
+WIKIMEDIA_API = url_servicio('WIKIMEDIA_API', "https://commons.wikimedia.org/w/api.php")
 
 # Headers para las peticiones (Wikimedia requiere User-Agent)
 HEADERS = {
@@ -102,6 +107,73 @@ SONIDOS_INSECTOS = {
 }
 
 
+def resolver_cientifico_ave(nombre_especie, nombre_cientifico=None):
+    """
+    Determina el nombre científico de un ave: el recibido, el del mapeo
+    AVES_CHILE o una coincidencia parcial en él. None si no hay.
+    """
+    # Determinar el nombre científico
+    cientifico = nombre_cientifico
+    
+    # Si no tenemos nombre científico, buscarlo en el mapeo
+    if not cientifico:
+        nombre_lower = nombre_especie.lower().strip()
+        cientifico = AVES_CHILE.get(nombre_lower)
+        
+        # Buscar coincidencia parcial
+        if not cientifico:
+            for nombre, sci in AVES_CHILE.items():
+                if nombre in nombre_lower or nombre_lower in nombre:
+                    cientifico = sci
+                    break
+    return cientifico
+
+
+def url_xeno_canto(query, solo_chile=True):
+    """URL de búsqueda en Xeno-Canto; "cnt:chile" filtra grabaciones de Chile."""
+    query_encoded = urllib.parse.quote(f"{query} cnt:chile" if solo_chile else query)
+    return f"{XENO_CANTO_API}?query={query_encoded}"
+
+
+def sin_grabaciones(data):
+    """True si la respuesta de Xeno-Canto no trae grabaciones."""
+    return data.get('numRecordings', '0') == '0' or not data.get('recordings')
+
+
+def resultado_xeno_canto(data, nombre_especie):
+    """Elige la grabación de mejor calidad y la traduce al formato de la app."""
+    # Obtener el primer resultado de buena calidad
+    recordings = data.get('recordings', [])
+    
+    # Ordenar por calidad (A es mejor que E)
+    quality_order = {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4}
+    recordings.sort(key=lambda x: quality_order.get(x.get('q', 'E'), 5))
+    
+    # Tomar el mejor resultado
+    recording = recordings[0]
+    
+    # Construir la URL del archivo de audio
+    # Xeno-Canto provee URLs en formato: //xeno-canto.org/sounds/uploaded/...
+    file_url = recording.get('file')
+    if file_url and not file_url.startswith('http'):
+        file_url = 'https:' + file_url
+    
+    return {
+        'url': file_url,
+        'nombre': recording.get('en', nombre_especie),  # Nombre en inglés
+        'nombre_cientifico': recording.get('gen', '') + ' ' + recording.get('sp', ''),
+        'tipo_sonido': recording.get('type', 'canto'),
+        'ubicacion': recording.get('loc', 'Desconocido'),
+        'grabador': recording.get('rec', 'Desconocido'),
+        'calidad': recording.get('q', 'C'),
+        'duracion': recording.get('length', ''),
+        'licencia': recording.get('lic', 'CC BY-NC-SA 4.0'),
+        'xeno_canto_id': recording.get('id', ''),
+        'fuente': 'Xeno-Canto'
+    }
+
+
+@con_refresco(sonidos)
 def buscar_sonido_ave(nombre_especie, nombre_cientifico=None):
     """
     Busca un sonido de ave en la API de Xeno-Canto.
@@ -113,76 +185,32 @@ def buscar_sonido_ave(nombre_especie, nombre_cientifico=None):
     Returns:
         dict con información del sonido o None si no se encuentra
     """
+    cientifico = None
     try:
-        # Determinar el nombre científico
-        cientifico = nombre_cientifico
-        
-        # Si no tenemos nombre científico, buscarlo en el mapeo
-        if not cientifico:
-            nombre_lower = nombre_especie.lower().strip()
-            cientifico = AVES_CHILE.get(nombre_lower)
-            
-            # Buscar coincidencia parcial
-            if not cientifico:
-                for nombre, sci in AVES_CHILE.items():
-                    if nombre in nombre_lower or nombre_lower in nombre:
-                        cientifico = sci
-                        break
+        cientifico = resolver_cientifico_ave(nombre_especie, nombre_cientifico)
         
         # Si aún no tenemos, usar el nombre común directamente
         query = cientifico if cientifico else nombre_especie
         
-        # Preparar la consulta - agregar "cnt:chile" para filtrar por Chile
-        query_encoded = urllib.parse.quote(f"{query} cnt:chile")
-        url = f"{XENO_CANTO_API}?query={query_encoded}"
-        
         # Hacer la petición
-        response = requests.get(url, headers=HEADERS, timeout=10)
+        with tramo('http', servicio='xeno-canto'):
+            response = requests.get(url_xeno_canto(query), headers=HEADERS, timeout=10)
         response.raise_for_status()
         
         data = response.json()
         
         # Verificar si hay resultados
-        if data.get('numRecordings', '0') == '0' or not data.get('recordings'):
+        if sin_grabaciones(data):
             # Intentar sin filtro de país
-            query_encoded = urllib.parse.quote(query)
-            url = f"{XENO_CANTO_API}?query={query_encoded}"
-            response = requests.get(url, headers=HEADERS, timeout=10)
+            with tramo('http', servicio='xeno-canto'):
+                response = requests.get(url_xeno_canto(query, solo_chile=False), headers=HEADERS, timeout=10)
             response.raise_for_status()
             data = response.json()
             
-            if data.get('numRecordings', '0') == '0' or not data.get('recordings'):
+            if sin_grabaciones(data):
                 return None
         
-        # Obtener el primer resultado de buena calidad
-        recordings = data.get('recordings', [])
-        
-        # Ordenar por calidad (A es mejor que E)
-        quality_order = {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4}
-        recordings.sort(key=lambda x: quality_order.get(x.get('q', 'E'), 5))
-        
-        # Tomar el mejor resultado
-        recording = recordings[0]
-        
-        # Construir la URL del archivo de audio
-        # Xeno-Canto provee URLs en formato: //xeno-canto.org/sounds/uploaded/...
-        file_url = recording.get('file')
-        if file_url and not file_url.startswith('http'):
-            file_url = 'https:' + file_url
-        
-        return {
-            'url': file_url,
-            'nombre': recording.get('en', nombre_especie),  # Nombre en inglés
-            'nombre_cientifico': recording.get('gen', '') + ' ' + recording.get('sp', ''),
-            'tipo_sonido': recording.get('type', 'canto'),
-            'ubicacion': recording.get('loc', 'Desconocido'),
-            'grabador': recording.get('rec', 'Desconocido'),
-            'calidad': recording.get('q', 'C'),
-            'duracion': recording.get('length', ''),
-            'licencia': recording.get('lic', 'CC BY-NC-SA 4.0'),
-            'xeno_canto_id': recording.get('id', ''),
-            'fuente': 'Xeno-Canto'
-        }
+        return resultado_xeno_canto(data, nombre_especie)
         
     except requests.exceptions.RequestException as e:
         print(f"Error buscando sonido en Xeno-Canto: {e}")
@@ -192,6 +220,88 @@ def buscar_sonido_ave(nombre_especie, nombre_cientifico=None):
         return buscar_en_wikimedia(cientifico if cientifico else nombre_especie)
 
 
+@con_refresco(sonidos, sincrona=buscar_sonido_ave)
+async def buscar_sonido_ave_async(nombre_especie, nombre_cientifico=None):
+    """Versión asíncrona de buscar_sonido_ave."""
+    cientifico = None
+    try:
+        cientifico = resolver_cientifico_ave(nombre_especie, nombre_cientifico)
+        query = cientifico if cientifico else nombre_especie
+        cliente = cliente_http()
+        
+        with tramo('http', servicio='xeno-canto'):
+            response = await cliente.get(url_xeno_canto(query), headers=HEADERS, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        
+        if sin_grabaciones(data):
+            with tramo('http', servicio='xeno-canto'):
+                response = await cliente.get(url_xeno_canto(query, solo_chile=False), headers=HEADERS, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+            
+            if sin_grabaciones(data):
+                return None
+        
+        return resultado_xeno_canto(data, nombre_especie)
+        
+    except Exception as e:
+        print(f"Error buscando sonido en Xeno-Canto: {e}")
+        return await buscar_en_wikimedia_async(cientifico if cientifico else nombre_especie)
+
+
+def parametros_busqueda_wikimedia(q):
+    """Parámetros para buscar archivos en Wikimedia Commons."""
+    return {
+        "action": "query",
+        "format": "json",
+        "list": "search",
+        "srsearch": q,
+        "srnamespace": 6,  # Solo espacio de nombres de archivos
+        "srlimit": 5
+    }
+
+
+def parametros_archivo_wikimedia(file_title):
+    """Parámetros para obtener la URL real y metadatos de un archivo."""
+    return {
+        "action": "query",
+        "format": "json",
+        "prop": "imageinfo",
+        "iiprop": "url|extmetadata",
+        "titles": file_title
+    }
+
+
+def filtrar_audios(data):
+    """Resultados de búsqueda cuyo título tiene una extensión de audio común."""
+    results = data.get("query", {}).get("search", [])
+    return [
+        res for res in results
+        if any(ext in res.get("title", "").lower() for ext in ['.mp3', '.ogg', '.wav', '.flac'])
+    ]
+
+
+def resultado_wikimedia(data_file, query):
+    """Traduce la respuesta de imageinfo al formato de la app, o None."""
+    pages = data_file.get("query", {}).get("pages", {})
+    for page_id in pages:
+        info = pages[page_id].get("imageinfo", [{}])[0]
+        url = info.get("url")
+        if url:
+            metadata = info.get("extmetadata", {})
+            return {
+                'url': url,
+                'nombre': query,
+                'tipo_sonido': 'grabación',
+                'fuente': 'Wikimedia Commons',
+                'licencia': metadata.get('LicenseShortName', {}).get('value', 'CC BY-SA'),
+                'grabador': metadata.get('Artist', {}).get('value', 'Colaborador de Wikimedia')
+            }
+    return None
+
+
+@con_refresco(sonidos)
 def buscar_en_wikimedia(query):
     """
     Busca un archivo de audio en Wikimedia Commons como fallback.
@@ -208,26 +318,12 @@ def buscar_en_wikimedia(query):
         
         search_results = []
         for q in search_queries:
-            params = {
-                "action": "query",
-                "format": "json",
-                "list": "search",
-                "srsearch": q,
-                "srnamespace": 6,  # Solo espacio de nombres de archivos
-                "srlimit": 5
-            }
-            
-            response = requests.get(WIKIMEDIA_API, params=params, headers=HEADERS, timeout=10)
+            with tramo('http', servicio='wikimedia'):
+                response = requests.get(WIKIMEDIA_API, params=parametros_busqueda_wikimedia(q), headers=HEADERS, timeout=10)
             response.raise_for_status()
-            data = response.json()
             
-            results = data.get("query", {}).get("search", [])
             # Filtrar por extensiones de audio comunes
-            for res in results:
-                title = res.get("title", "").lower()
-                if any(ext in title for ext in ['.mp3', '.ogg', '.wav', '.flac']):
-                    search_results.append(res)
-            
+            search_results = filtrar_audios(response.json())
             if search_results:
                 break
             
@@ -239,34 +335,39 @@ def buscar_en_wikimedia(query):
             return None
             
         # Obtener la URL real del archivo
-        params_file = {
-            "action": "query",
-            "format": "json",
-            "prop": "imageinfo",
-            "iiprop": "url|extmetadata",
-            "titles": file_title
-        }
-        
-        response_file = requests.get(WIKIMEDIA_API, params=params_file, headers=HEADERS, timeout=10)
+        with tramo('http', servicio='wikimedia'):
+            response_file = requests.get(WIKIMEDIA_API, params=parametros_archivo_wikimedia(file_title), headers=HEADERS, timeout=10)
         response_file.raise_for_status()
-        data_file = response_file.json()
-        
-        pages = data_file.get("query", {}).get("pages", {})
-        for page_id in pages:
-            info = pages[page_id].get("imageinfo", [{}])[0]
-            url = info.get("url")
-            if url:
-                metadata = info.get("extmetadata", {})
-                return {
-                    'url': url,
-                    'nombre': query,
-                    'tipo_sonido': 'grabación',
-                    'fuente': 'Wikimedia Commons',
-                    'licencia': metadata.get('LicenseShortName', {}).get('value', 'CC BY-SA'),
-                    'grabador': metadata.get('Artist', {}).get('value', 'Colaborador de Wikimedia')
-                }
         
+        return resultado_wikimedia(response_file.json(), query)
+    except Exception as e:
+        print(f"Error buscando en Wikimedia: {e}")
         return None
+
+
+@con_refresco(sonidos, sincrona=buscar_en_wikimedia)
+async def buscar_en_wikimedia_async(query):
+    """Versión asíncrona de buscar_en_wikimedia."""
+    try:
+        cliente = cliente_http()
+        search_results = []
+        for q in [f"{query} audio", f"{query} sound", query]:
+            with tramo('http', servicio='wikimedia'):
+                response = await cliente.get(WIKIMEDIA_API, params=parametros_busqueda_wikimedia(q), headers=HEADERS, timeout=10)
+            response.raise_for_status()
+            search_results = filtrar_audios(response.json())
+            if search_results:
+                break
+        
+        if not search_results or not search_results[0].get("title"):
+            return None
+        
+        with tramo('http', servicio='wikimedia'):
+            response_file = await cliente.get(WIKIMEDIA_API, params=parametros_archivo_wikimedia(search_results[0]["title"]),
+                                              headers=HEADERS, timeout=10)
+        response_file.raise_for_status()
+        
+        return resultado_wikimedia(response_file.json(), query)
     except Exception as e:
         print(f"Error buscando en Wikimedia: {e}")
         return None
@@ -297,6 +398,7 @@ def buscar_sonido_insecto(nombre_especie):
     return None
 
 
+@coalescido
 def buscar_sonido(nombre_especie, nombre_cientifico=None, tipo='insecto'):
     """
     Busca un sonido para la especie dada.
@@ -329,6 +431,26 @@ def buscar_sonido(nombre_especie, nombre_cientifico=None, tipo='insecto'):
     return buscar_en_wikimedia(nombre_cientifico if nombre_cientifico else nombre_especie)
 
 
+@coalescido
+async def buscar_sonido_async(nombre_especie, nombre_cientifico=None, tipo='insecto'):
+    """Versión asíncrona de buscar_sonido (mismas reglas por tipo)."""
+    if tipo == 'planta':
+        return None
+    
+    if tipo == 'ave':
+        return await buscar_sonido_ave_async(nombre_especie, nombre_cientifico)
+    
+    if tipo == 'animal':
+        return await buscar_en_wikimedia_async(nombre_cientifico if nombre_cientifico else nombre_especie)
+    
+    # Los sonidos locales de insectos no requieren red
+    resultado_local = buscar_sonido_insecto(nombre_especie)
+    if resultado_local:
+        return resultado_local
+    
+    return await buscar_en_wikimedia_async(nombre_cientifico if nombre_cientifico else nombre_especie)
+
+
 # Para pruebas
 if __name__ == '__main__':
     print("Probando búsqueda de sonidos...")
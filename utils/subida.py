@@ -0,0 +1,204 @@
+"""
+NaturIA Chile - Validación de imágenes subidas
+Revisa la imagen mientras llega: el tipo real se reconoce por los primeros
+bytes (no por la extensión) y el ancho y alto se leen de la cabecera sin
+decodificar la imagen. Un archivo que no es imagen o que tiene demasiados
+píxeles (p. ej. una "bomba de descompresión") se rechaza antes de recibir
+el resto del cuerpo. Lo aceptado se guarda en memoria solo hasta
+SUBIDA_MEMORIA_BYTES; lo más grande va a un archivo temporal.
+"""
+
+import os
+import struct
+import tempfile
+
+from flask import Request
+
+MAX_PIXELES = int(os.getenv('SUBIDA_MAX_PIXELES', 40_000_000))
+SUBIDA_MEMORIA_BYTES = int(os.getenv('SUBIDA_MEMORIA_BYTES', 512 * 1024))
+
+# Un JPEG puede traer EXIF/ICC antes del tamaño; más allá de esto se rechaza
+CABECERA_MAXIMA = 256 * 1024
+
+FIRMAS = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+# Marcadores SOF de JPEG (los que llevan el tamaño del cuadro)
+MARCADORES_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ErrorSubida(Exception):
+    """Imagen rechazada; el mensaje es apto para mostrar al usuario."""
+
+    def __init__(self, mensaje: str, codigo: int = 400):
+        super().__init__(mensaje)
+        self.mensaje = mensaje
+        self.codigo = codigo
+
+
+NO_ES_IMAGEN = '¡Ups! Ese archivo no parece una imagen. Solo acepto PNG, JPG, GIF o WEBP.'
+IMAGEN_DANADA = '¡Ups! No pude leer la imagen, parece estar dañada. Intenta con otra.'
+
+
+def detectar_formato(datos: bytes):
+    """Formato según los bytes mágicos, o None si todavía no alcanza para saberlo."""
+    for firma, formato in FIRMAS:
+        if datos.startswith(firma):
+            return formato
+    if len(datos) >= 12 and datos[:4] == b'RIFF' and datos[8:12] == b'WEBP':
+        return 'webp'
+    if len(datos) < 12:
+        return None
+    raise ErrorSubida(NO_ES_IMAGEN)
+
+
+def _dimensiones_jpeg(datos: bytes):
+    posicion = 2
+    while posicion + 4 <= len(datos):
+        if datos[posicion] != 0xFF:
+            raise ErrorSubida(IMAGEN_DANADA)
+        marcador = datos[posicion + 1]
+        if marcador == 0xFF:  # Relleno entre segmentos
+            posicion += 1
+            continue
+        if marcador in (0x01, 0xD8) or 0xD0 <= marcador <= 0xD7:
+            posicion += 2
+            continue
+        if marcador in (0xD9, 0xDA):  # Fin o inicio de datos sin haber visto el tamaño
+            raise ErrorSubida(IMAGEN_DANADA)
+        if marcador in MARCADORES_SOF:
+            if posicion + 9 > len(datos):
+                return None
+            alto, ancho = struct.unpack('>HH', datos[posicion + 5:posicion + 9])
+            return ancho, alto
+        posicion += 2 + struct.unpack('>H', datos[posicion + 2:posicion + 4])[0]
+    return None
+
+
+def _dimensiones_webp(datos: bytes):
+    if len(datos) < 30:
+        return None
+    bloque = datos[12:16]
+    if bloque == b'VP8 ':
+        ancho, alto = struct.unpack('<HH', datos[26:30])
+        return ancho & 0x3FFF, alto & 0x3FFF
+    if bloque == b'VP8L':
+        bits = struct.unpack('<I', datos[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if bloque == b'VP8X':
+        return (int.from_bytes(datos[24:27], 'little') + 1,
+                int.from_bytes(datos[27:30], 'little') + 1)
+    raise ErrorSubida(IMAGEN_DANADA)
+
+
+def leer_cabecera(datos: bytes):
+    """
+    Retorna (formato, ancho, alto) a partir del comienzo del archivo, o None
+    si hacen falta más bytes. Lanza ErrorSubida si no es una imagen aceptada.
+    """
+    formato = detectar_formato(datos)
+    if formato is None:
+        return None
+    if formato == 'png':
+        if len(datos) < 24:
+            return None
+        if datos[12:16] != b'IHDR':
+            raise ErrorSubida(IMAGEN_DANADA)
+        dimensiones = struct.unpack('>II', datos[16:24])
+    elif formato == 'gif':
+        dimensiones = struct.unpack('<HH', datos[6:10]) if len(datos) >= 10 else None
+    elif formato == 'webp':
+        dimensiones = _dimensiones_webp(datos)
+    else:
+        dimensiones = _dimensiones_jpeg(datos)
+    if dimensiones is None:
+        return None
+    return (formato,) + tuple(dimensiones)
+
+
+def validar_dimensiones(ancho: int, alto: int, max_pixeles: int = MAX_PIXELES):
+    if ancho <= 0 or alto <= 0:
+        raise ErrorSubida(IMAGEN_DANADA)
+    if ancho * alto > max_pixeles:
+        raise ErrorSubida(f'¡Ups! La imagen es demasiado grande '
+                          f'(máximo {max_pixeles // 1_000_000} megapíxeles).', 413)
+
+
+class ImagenEntrante:
+    """
+    Destino de escritura para el parser multipart: valida la cabecera con
+    los primeros fragmentos y guarda el archivo en un SpooledTemporaryFile.
+    Se usa como un archivo normal (read, seek...) una vez recibido.
+    """
+
+    def __init__(self, max_pixeles: int = MAX_PIXELES):
+        self.archivo = tempfile.SpooledTemporaryFile(max_size=SUBIDA_MEMORIA_BYTES)
+        self.max_pixeles = max_pixeles
+        self.formato = None
+        self.dimensiones = None
+        self._cabecera = b''
+
+    def write(self, datos: bytes):
+        if self.formato is None:
+            self._cabecera += datos[:CABECERA_MAXIMA - len(self._cabecera)]
+            self._revisar(final=len(self._cabecera) >= CABECERA_MAXIMA)
+        return self.archivo.write(datos)
+
+    def _revisar(self, final: bool):
+        cabecera = leer_cabecera(self._cabecera)
+        if cabecera is None:
+            if final:
+                raise ErrorSubida(NO_ES_IMAGEN if len(self._cabecera) < 12 else IMAGEN_DANADA)
+            return
+        self.formato, ancho, alto = cabecera
+        validar_dimensiones(ancho, alto, self.max_pixeles)
+        self.dimensiones = (ancho, alto)
+        self._cabecera = b''
+
+    def finalizar(self):
+        """Para archivos que terminaron antes de completar la cabecera."""
+        if self.formato is None:
+            self._revisar(final=True)
+        self.archivo.seek(0)
+        return self
+
+    def __getattr__(self, nombre):
+        return getattr(self.archivo, nombre)
+
+
+def validar_archivo(archivo, max_pixeles: int = MAX_PIXELES):
+    """
+    Valida un archivo ya recibido (p. ej. el UploadFile del modo ASGI)
+    leyendo solo su cabecera. Retorna (formato, ancho, alto) y lo rebobina.
+    """
+    datos = b''
+    while len(datos) < CABECERA_MAXIMA:
+        fragmento = archivo.read(16 * 1024)
+        datos += fragmento
+        cabecera = leer_cabecera(datos)
+        if cabecera:
+            archivo.seek(0)
+            validar_dimensiones(cabecera[1], cabecera[2], max_pixeles)
+            return cabecera
+        if not fragmento:
+            break
+    raise ErrorSubida(NO_ES_IMAGEN if len(datos) < 12 else IMAGEN_DANADA)
+
+
+class SolicitudConImagenes(Request):
+    """
+    Request de Flask cuyos archivos, en los endpoints de endpoints_imagen, se
+    reciben con ImagenEntrante: un archivo inválido corta el parseo del
+    multipart (ErrorSubida) en vez de leerse completo.
+    """
+
+    endpoints_imagen = {'analizar'}
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in self.endpoints_imagen:
+            return ImagenEntrante()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
@@ -0,0 +1,182 @@
+"""
+NaturIA Chile - Trazas por petición
+Mide cuánto tarda cada paso de una petición (intentos con cada modelo de
+Gemini, llamadas HTTP a Wikipedia/Wikimedia/Xeno-Canto y consultas a la
+base de datos) y lo devuelve en la cabecera Server-Timing, visible en la
+pestaña Red del navegador. Opcionalmente cada traza se agrega como una línea
+JSON a TRAZAS_ARCHIVO.
+
+Solo se traza una fracción de las peticiones (TRAZAS_MUESTREO); en las
+demás tramo() no hace nada más que leer una ContextVar. Una petición con la
+cabecera X-Naturia-Traza se traza siempre, pero solo si la cabecera trae
+TRAZAS_SECRETO (o vale 1 con la app en modo debug): si no, cualquiera podría
+llenar TRAZAS_ARCHIVO y leer los tiempos internos en Server-Timing.
+"""
+
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TRAZAS_MUESTREO = float(os.getenv('TRAZAS_MUESTREO', 0.05))
+TRAZAS_ARCHIVO = os.getenv('TRAZAS_ARCHIVO')
+TRAZAS_SECRETO = os.getenv('TRAZAS_SECRETO')
+CABECERA_FORZAR = 'X-Naturia-Traza'
+
+_traza_actual = ContextVar('traza_actual', default=None)
+_lock_archivo = threading.Lock()
+
+
+class Traza:
+    """Tramos medidos durante una petición."""
+
+    def __init__(self, ruta: str = '', metodo: str = ''):
+        self.id = uuid.uuid4().hex[:16]
+        self.ruta = ruta
+        self.metodo = metodo
+        self.inicio = time.perf_counter()
+        self.tramos = []
+
+    def agregar(self, nombre: str, inicio: float, fin: float, etiquetas: dict):
+        self.tramos.append({
+            'nombre': nombre,
+            'inicio_ms': round((inicio - self.inicio) * 1000, 2),
+            'duracion_ms': round((fin - inicio) * 1000, 2),
+            **etiquetas
+        })
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.inicio) * 1000
+
+    def server_timing(self) -> str:
+        """
+        Valor de la cabecera Server-Timing. Las consultas SQL se resumen en
+        una sola entrada para no inflar la cabecera.
+        """
+        partes, db_ms, db_n = [], 0.0, 0
+        for t in self.tramos:
+            if t['nombre'] == 'db':
+                db_ms += t['duracion_ms']
+                db_n += 1
+                continue
+            desc = t.get('modelo') or t.get('servicio') or ''
+            if t.get('error'):
+                desc = f'{desc} error'.strip()
+            partes.append(f'{t["nombre"]};dur={t["duracion_ms"]:.1f}' + (f';desc="{desc}"' if desc else ''))
+        if db_n:
+            partes.append(f'db;dur={db_ms:.1f};desc="{db_n} consultas"')
+        partes.append(f'total;dur={self.total_ms():.1f}')
+        return ', '.join(partes)
+
+    def a_dict(self, estado: int = None) -> dict:
+        return {
+            'id': self.id,
+            'ruta': self.ruta,
+            'metodo': self.metodo,
+            'estado': estado,
+            'total_ms': round(self.total_ms(), 2),
+            'tramos': self.tramos,
+        }
+
+
+def traza_forzada(valor: str, depuracion: bool = False) -> bool:
+    """True si la cabecera X-Naturia-Traza trae el secreto configurado (o '1' en modo debug)."""
+    if not valor:
+        return False
+    if TRAZAS_SECRETO and hmac.compare_digest(valor.encode('utf-8'), TRAZAS_SECRETO.encode('utf-8')):
+        return True
+    return depuracion and valor == '1'
+
+
+def debe_trazar(forzar: bool = False, muestreo: float = None) -> bool:
+    muestreo = TRAZAS_MUESTREO if muestreo is None else muestreo
+    return forzar or (muestreo > 0 and random.random() < muestreo)
+
+
+def iniciar_traza(ruta: str = '', metodo: str = ''):
+    """Activa una traza en el contexto actual (hilo o tarea asyncio) y la retorna."""
+    traza = Traza(ruta, metodo)
+    _traza_actual.set(traza)
+    return traza
+
+
+def terminar_traza(estado: int = None):
+    """Desactiva la traza actual, la escribe en TRAZAS_ARCHIVO si hay, y la retorna."""
+    traza = _traza_actual.get()
+    if traza is None:
+        return None
+    _traza_actual.set(None)
+    if TRAZAS_ARCHIVO:
+        linea = json.dumps(traza.a_dict(estado), ensure_ascii=False)
+        with _lock_archivo:
+            with open(TRAZAS_ARCHIVO, 'a', encoding='utf-8') as f:
+                f.write(linea + '\n')
+    return traza
+
+
+def traza_actual():
+    return _traza_actual.get()
+
+
+@contextmanager
+def tramo(nombre: str, **etiquetas):
+    """
+    Mide el bloque como un tramo de la traza actual (si la petición se está
+    trazando). Entrega el dict de etiquetas para marcar, p. ej., error=True.
+    """
+    traza = _traza_actual.get()
+    if traza is None:
+        yield etiquetas
+        return
+    inicio = time.perf_counter()
+    try:
+        yield etiquetas
+    except BaseException:
+        etiquetas['error'] = True
+        raise
+    finally:
+        traza.agregar(nombre, inicio, time.perf_counter(), etiquetas)
+
+
+def instalar_en_flask(app):
+    """Traza las peticiones de Flask y agrega la cabecera Server-Timing."""
+    from flask import request
+
+    @app.before_request
+    def _iniciar_traza():
+        if debe_trazar(traza_forzada(request.headers.get(CABECERA_FORZAR), app.debug)):
+            iniciar_traza(request.path, request.method)
+
+    @app.after_request
+    def _agregar_server_timing(response):
+        traza = terminar_traza(response.status_code)
+        if traza is not None:
+            response.headers['Server-Timing'] = traza.server_timing()
+        return response
+
+    @app.teardown_request
+    def _limpiar_traza(exc):
+        # Si hubo una excepción no se llega a after_request
+        _traza_actual.set(None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _traza_actual.get() is not None:
+        context._naturia_inicio = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    traza = _traza_actual.get()
+    inicio = getattr(context, '_naturia_inicio', None)
+    if traza is not None and inicio is not None:
+        traza.agregar('db', inicio, time.perf_counter(), {'sql': statement.split(None, 1)[0].upper()})
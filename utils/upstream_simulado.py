@@ -0,0 +1,215 @@
+"""
+NaturIA Chile - Servidor que reemplaza a Wikipedia, Wikimedia y Xeno-Canto
+Para benchmarks y pruebas sin red y con resultados repetibles.
+
+- Reproducción (por defecto): responde desde las grabaciones guardadas en
+  data/grabaciones/<servicio>.json, con latencia y tasa de errores
+  configurables. Lo que no está grabado responde 404.
+- Grabación (--grabar): reenvía cada petición al servicio real, la responde
+  y guarda la respuesta en la grabación.
+
+La app se redirige al servidor con una sola variable de entorno:
+    NATURIA_UPSTREAM_SIMULADO=http://127.0.0.1:8765
+que cambia XENO_CANTO_API, WIKIMEDIA_API, WIKIPEDIA_EN y WIKIPEDIA_ES (una
+variable propia definida explícitamente sigue teniendo prioridad).
+
+data/grabaciones trae una grabación de ejemplo (chincol, Zonotrichia
+capensis) que usan los benchmarks; --grabar la amplía con respuestas reales.
+
+Uso:
+    python -m utils.upstream_simulado --puerto 8765 --latencia-ms 200 --errores 0.05
+    python -m utils.upstream_simulado --puerto 8765 --grabar
+En pytest: `with servidor_simulado(...) as url:`.
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CARPETA_GRABACIONES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   'data', 'grabaciones')
+
+# Prefijo de ruta en el servidor simulado → origen real
+SERVICIOS = {
+    'wikipedia-en': 'https://en.wikipedia.org',
+    'wikipedia-es': 'https://es.wikipedia.org',
+    'wikimedia': 'https://commons.wikimedia.org',
+    'xeno-canto': 'https://xeno-canto.org',
+}
+
+# Parámetros que no forman parte de la clave (credenciales, etc.)
+PARAMETROS_IGNORADOS = {'key'}
+
+USER_AGENT = 'NaturIA-Chile/1.0 (grabación de pruebas)'
+
+
+def url_servicio(variable: str, defecto: str) -> str:
+    """
+    URL de un servicio externo: la variable propia si está definida; si no,
+    el servidor simulado (si hay NATURIA_UPSTREAM_SIMULADO); si no, la real.
+    """
+    if os.getenv(variable):
+        return os.getenv(variable)
+    simulado = os.getenv('NATURIA_UPSTREAM_SIMULADO')
+    if not simulado:
+        return defecto
+    return url_simulada(simulado, defecto)
+
+
+def url_simulada(base: str, url_real: str) -> str:
+    """Traduce una URL real a la del servidor simulado en `base`."""
+    partes = urllib.parse.urlsplit(url_real)
+    origen = f'{partes.scheme}://{partes.netloc}'
+    for servicio, origen_real in SERVICIOS.items():
+        if origen_real == origen:
+            return f"{base.rstrip('/')}/{servicio}{partes.path}"
+    raise ValueError(f'Servicio sin simulación: {url_real}')
+
+
+def clave_peticion(ruta: str, consulta: str) -> str:
+    """Clave estable de una petición: ruta + parámetros ordenados (sin credenciales)."""
+    parametros = sorted((k, v) for k, v in urllib.parse.parse_qsl(consulta, keep_blank_values=True)
+                        if k not in PARAMETROS_IGNORADOS)
+    return f'{ruta}?{urllib.parse.urlencode(parametros)}' if parametros else ruta
+
+
+class ServidorSimulado(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, direccion, carpeta=CARPETA_GRABACIONES, grabar=False, latencia_ms=0,
+                 variacion_ms=0, tasa_errores=0.0, semilla=0, origenes=None):
+        super().__init__(direccion, ManejadorSimulado)
+        self.carpeta = carpeta
+        self.grabar = grabar
+        self.latencia_ms = latencia_ms
+        self.variacion_ms = variacion_ms
+        self.tasa_errores = tasa_errores
+        self.origenes = {**SERVICIOS, **(origenes or {})}
+        # Generador con semilla: misma secuencia de latencias y errores en cada corrida
+        self._azar = random.Random(semilla)
+        self._lock = threading.Lock()
+        self.grabaciones = {servicio: self._leer(servicio) for servicio in self.origenes}
+
+    def _ruta(self, servicio):
+        return os.path.join(self.carpeta, f'{servicio}.json')
+
+    def _leer(self, servicio):
+        try:
+            with open(self._ruta(servicio), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def guardar(self, servicio, clave, respuesta):
+        with self._lock:
+            self.grabaciones[servicio][clave] = respuesta
+            os.makedirs(self.carpeta, exist_ok=True)
+            temporal = self._ruta(servicio) + '.tmp'
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(self.grabaciones[servicio], f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(temporal, self._ruta(servicio))
+
+    def sortear(self):
+        """(demora en segundos, si se inyecta un error) para la próxima respuesta."""
+        with self._lock:
+            variacion = self._azar.uniform(-self.variacion_ms, self.variacion_ms) if self.variacion_ms else 0
+            error = self.tasa_errores > 0 and self._azar.random() < self.tasa_errores
+        return max(0.0, self.latencia_ms + variacion) / 1000, error
+
+
+class ManejadorSimulado(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        servidor = self.server
+        partes = urllib.parse.urlsplit(self.path)
+        servicio, _, ruta = partes.path.lstrip('/').partition('/')
+        if servicio not in servidor.origenes:
+            return self._responder(404, 'application/json', {'error': f'Servicio desconocido: {servicio}'})
+        clave = clave_peticion('/' + ruta, partes.query)
+
+        if servidor.grabar:
+            return self._grabar(servicio, clave, f'{servidor.origenes[servicio]}/{ruta}', partes.query)
+
+        demora, error = servidor.sortear()
+        time.sleep(demora)
+        if error:
+            return self._responder(503, 'application/json', {'error': 'Error inyectado'})
+        grabada = servidor.grabaciones[servicio].get(clave)
+        if grabada is None:
+            print(f'Sin grabación: {servicio} {clave}')
+            return self._responder(404, 'application/json', {'error': 'Sin grabación', 'clave': clave})
+        self._responder(grabada['estado'], grabada['tipo'], grabada['cuerpo'])
+
+    def _grabar(self, servicio, clave, url, consulta):
+        import requests
+        try:
+            real = requests.get(f'{url}?{consulta}' if consulta else url,
+                                headers={'User-Agent': self.headers.get('User-Agent') or USER_AGENT}, timeout=15)
+        except requests.exceptions.RequestException as e:
+            return self._responder(502, 'application/json', {'error': str(e)})
+        tipo = real.headers.get('Content-Type', 'application/octet-stream').split(';')[0]
+        try:
+            cuerpo = real.json() if tipo == 'application/json' else real.text
+        except ValueError:
+            cuerpo = real.text
+        self.server.guardar(servicio, clave, {'estado': real.status_code, 'tipo': tipo, 'cuerpo': cuerpo})
+        self._responder(real.status_code, tipo, cuerpo)
+
+    def _responder(self, estado, tipo, cuerpo):
+        datos = (json.dumps(cuerpo, ensure_ascii=False) if not isinstance(cuerpo, str) else cuerpo).encode('utf-8')
+        self.send_response(estado)
+        self.send_header('Content-Type', f'{tipo}; charset=utf-8')
+        self.send_header('Content-Length', str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def servidor_simulado(**opciones):
+    """Levanta el servidor en un hilo (puerto libre) y entrega su URL base."""
+    servidor = ServidorSimulado(('127.0.0.1', 0), **opciones)
+    hilo = threading.Thread(target=servidor.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    hilo.start()
+    try:
+        yield f'http://127.0.0.1:{servidor.server_address[1]}'
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--carpeta', default=CARPETA_GRABACIONES)
+    parser.add_argument('--grabar', action='store_true', help='reenviar a los servicios reales y guardar')
+    parser.add_argument('--latencia-ms', type=float, default=0)
+    parser.add_argument('--variacion-ms', type=float, default=0, help='± aleatorio (con semilla) sobre la latencia')
+    parser.add_argument('--errores', type=float, default=0.0, help='fracción de respuestas 503 inyectadas')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    servidor = ServidorSimulado(('127.0.0.1', args.puerto), carpeta=args.carpeta, grabar=args.grabar,
+                                latencia_ms=args.latencia_ms, variacion_ms=args.variacion_ms,
+                                tasa_errores=args.errores, semilla=args.semilla)
+    modo = 'grabando' if args.grabar else 'reproduciendo'
+    print(f'🎙️  Servidor simulado {modo} en http://127.0.0.1:{args.puerto} ({args.carpeta})')
+    print(f'   export NATURIA_UPSTREAM_SIMULADO=http://127.0.0.1:{args.puerto}')
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()